@@ -1,8 +1,10 @@
+from datetime import datetime, timedelta
+
 import werkzeug
 if not hasattr(werkzeug, "__version__"):
     werkzeug.__version__ = "3"
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory
 
 from middleware.auth import generate_token, authenticate_token, authorize_roles
 from controllers import approval, verification
@@ -10,6 +12,9 @@ from controllers.approval import bp as approval_bp
 from controllers.verification import bp as verification_bp
 from controllers.statistics import bp as statistics_bp
 import storage
+from storage.backup import iter_backup
+from workflow import Workflow, compile_condition
+from workflow.assign import POLICIES as ASSIGN_POLICIES
 
 app = Flask(__name__)
 app.register_blueprint(approval_bp)
@@ -17,7 +22,28 @@ app.register_blueprint(verification_bp)
 app.register_blueprint(statistics_bp)
 
 storage.init_defaults()
-data = storage.data()
+if approval.WORKFLOW_TIMER_INTERVAL > 0:
+    approval.start_timer_thread(approval.WORKFLOW_TIMER_INTERVAL)
+
+
+@app.before_request
+def sync_storage():
+    # pick up what other worker processes saved (STORAGE_MULTIPROCESS)
+    storage.sync()
+
+
+@app.after_request
+def wait_durable(response):
+    # with write-behind enabled, clients may ask to wait until their
+    # changes are on disk before getting a response
+    if request.headers.get('X-Durable-Write'):
+        storage.wait_durable()
+    return response
+
+
+@app.teardown_appcontext
+def close_storage(exc):
+    storage.close()
 
 
 @app.get('/admin')
@@ -26,13 +52,13 @@ def admin_page():
 
 
 def reset_data():
-    data['organizations'] = [{'id': 1, 'name': 'Org1'}]
-    data['departments'] = [{'id': 1, 'name': 'Dept1', 'org_id': 1}]
-    data['users'] = [
+    storage.put('organizations', [{'id': 1, 'name': 'Org1'}])
+    storage.put('departments', [{'id': 1, 'name': 'Dept1', 'org_id': 1}])
+    storage.put('users', [
         {'id': 1, 'username': 'admin', 'password': 'admin', 'role': 'admin', 'org_id': 1, 'dept_id': 1},
         {'id': 2, 'username': 'user', 'password': 'user', 'role': 'user', 'org_id': 1, 'dept_id': 1}
-    ]
-    data['templates'] = []
+    ])
+    storage.put('templates', [])
     approval.reset_data()
     verification.reset_data()
     storage.save()
@@ -40,7 +66,7 @@ def reset_data():
 @app.post('/login')
 def login():
     payload = request.get_json() or {}
-    user = next((u for u in data['users'] if u['username'] == payload.get('username') and u['password'] == payload.get('password')), None)
+    user = storage.find('users', username=payload.get('username'), password=payload.get('password'))
     if not user:
         return '', 401
     token = generate_token(user)
@@ -52,7 +78,7 @@ def login():
 def get_user(user_id):
     if request.user['role'] != 'admin' and request.user['id'] != user_id:
         return '', 403
-    user = next((u for u in data['users'] if u['id'] == user_id), None)
+    user = storage.get('users', user_id)
     if not user:
         return '', 404
     return jsonify(user)
@@ -63,10 +89,10 @@ def get_user(user_id):
 def update_user(user_id):
     if request.user['role'] != 'admin' and request.user['id'] != user_id:
         return '', 403
-    user = next((u for u in data['users'] if u['id'] == user_id), None)
+    user = storage.get('users', user_id)
     if not user:
         return '', 404
-    user.update(request.get_json() or {})
+    storage.update('users', user, request.get_json() or {})
     storage.save()
     return jsonify(user)
 
@@ -75,7 +101,7 @@ def update_user(user_id):
 @authenticate_token
 @authorize_roles('admin')
 def list_users():
-    return jsonify(data['users'])
+    return jsonify(storage.all_rows('users'))
 
 
 @app.post('/admin/users')
@@ -83,8 +109,8 @@ def list_users():
 @authorize_roles('admin')
 def create_user():
     new_user = request.get_json() or {}
-    new_user['id'] = max([u['id'] for u in data['users']], default=0) + 1
-    data['users'].append(new_user)
+    new_user['id'] = storage.next_id('users')
+    storage.insert('users', new_user)
     storage.save()
     return jsonify(new_user), 201
 
@@ -93,10 +119,10 @@ def create_user():
 @authenticate_token
 @authorize_roles('admin')
 def admin_update_user(user_id):
-    user = next((u for u in data['users'] if u['id'] == user_id), None)
+    user = storage.get('users', user_id)
     if not user:
         return '', 404
-    user.update(request.get_json() or {})
+    storage.update('users', user, request.get_json() or {})
     storage.save()
     return jsonify(user)
 
@@ -105,7 +131,7 @@ def admin_update_user(user_id):
 @authenticate_token
 @authorize_roles('admin')
 def delete_user(user_id):
-    data['users'] = [u for u in data['users'] if u['id'] != user_id]
+    storage.delete('users', user_id)
     storage.save()
     return '', 204
 
@@ -114,7 +140,7 @@ def delete_user(user_id):
 @authenticate_token
 @authorize_roles('admin')
 def list_orgs():
-    return jsonify(data['organizations'])
+    return jsonify(storage.all_rows('organizations'))
 
 
 @app.post('/admin/orgs')
@@ -122,8 +148,8 @@ def list_orgs():
 @authorize_roles('admin')
 def create_org():
     org = request.get_json() or {}
-    org['id'] = max([o['id'] for o in data['organizations']], default=0) + 1
-    data['organizations'].append(org)
+    org['id'] = storage.next_id('organizations')
+    storage.insert('organizations', org)
     storage.save()
     return jsonify(org), 201
 
@@ -132,10 +158,10 @@ def create_org():
 @authenticate_token
 @authorize_roles('admin')
 def update_org(org_id):
-    org = next((o for o in data['organizations'] if o['id'] == org_id), None)
+    org = storage.get('organizations', org_id)
     if not org:
         return '', 404
-    org.update(request.get_json() or {})
+    storage.update('organizations', org, request.get_json() or {})
     storage.save()
     return jsonify(org)
 
@@ -144,7 +170,7 @@ def update_org(org_id):
 @authenticate_token
 @authorize_roles('admin')
 def delete_org(org_id):
-    data['organizations'] = [o for o in data['organizations'] if o['id'] != org_id]
+    storage.delete('organizations', org_id)
     storage.save()
     return '', 204
 
@@ -153,7 +179,7 @@ def delete_org(org_id):
 @authenticate_token
 @authorize_roles('admin')
 def list_depts():
-    return jsonify(data['departments'])
+    return jsonify(storage.all_rows('departments'))
 
 
 @app.post('/admin/depts')
@@ -161,8 +187,8 @@ def list_depts():
 @authorize_roles('admin')
 def create_dept():
     dept = request.get_json() or {}
-    dept['id'] = max([d['id'] for d in data['departments']], default=0) + 1
-    data['departments'].append(dept)
+    dept['id'] = storage.next_id('departments')
+    storage.insert('departments', dept)
     storage.save()
     return jsonify(dept), 201
 
@@ -171,10 +197,10 @@ def create_dept():
 @authenticate_token
 @authorize_roles('admin')
 def update_dept(dept_id):
-    dept = next((d for d in data['departments'] if d['id'] == dept_id), None)
+    dept = storage.get('departments', dept_id)
     if not dept:
         return '', 404
-    dept.update(request.get_json() or {})
+    storage.update('departments', dept, request.get_json() or {})
     storage.save()
     return jsonify(dept)
 
@@ -183,7 +209,7 @@ def update_dept(dept_id):
 @authenticate_token
 @authorize_roles('admin')
 def delete_dept(dept_id):
-    data['departments'] = [d for d in data['departments'] if d['id'] != dept_id]
+    storage.delete('departments', dept_id)
     storage.save()
     return '', 204
 
@@ -192,19 +218,28 @@ def delete_dept(dept_id):
 @authenticate_token
 @authorize_roles('admin')
 def list_templates():
-    return jsonify(data['templates'])
+    return jsonify(storage.all_rows('templates'))
+
+
+def _is_user_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
 
 
 def _normalize_template(payload, require_config=False):
     """Validate and normalize template structure.
 
     Accepts either legacy `steps` or new `workflow_config` formats and
-    converts them into the standard `workflow_config` structure.
+    converts them into the standard `workflow_config` structure. The nodes
+    are analysed as a graph (see ``workflow.plan``): links to unknown nodes,
+    loops a form can never leave, forks without a join and invalid
+    ``require`` settings are rejected. Returns the payload and
+    the warnings of the analysis, such as unreachable nodes.
     """
     steps = payload.pop('steps', None)
     if steps is not None:
         payload['workflow_config'] = {'nodes': steps}
 
+    warnings = []
     if 'workflow_config' in payload:
         wf_cfg = payload['workflow_config']
         if not isinstance(wf_cfg, dict):
@@ -215,10 +250,45 @@ def _normalize_template(payload, require_config=False):
         for node in nodes:
             if not isinstance(node, dict) or 'id' not in node or 'type' not in node:
                 raise ValueError('each node requires id and type')
+            # shapes Workflow.from_template relies on
+            if not isinstance(node['id'], str) or not isinstance(node['type'], str):
+                raise ValueError('node id and type must be strings')
+            if node.get('next') is not None and not isinstance(node['next'], str):
+                raise ValueError('next must be a node id')
+            for name in ('approvers', 'delegates', 'push'):
+                users = node.get(name, [])
+                if not isinstance(users, list) or not all(_is_user_id(u) for u in users):
+                    raise ValueError(f'{name} must be a list of user ids')
+            conditions = node.get('conditions', [])
+            if not isinstance(conditions, list) or not all(isinstance(c, dict) for c in conditions):
+                raise ValueError('conditions must be a list of objects')
+            if any(c.get('next') is not None and not isinstance(c['next'], str) for c in conditions):
+                raise ValueError('condition next must be a node id')
+            branches = node.get('branches', [])
+            if not isinstance(branches, list) or not all(isinstance(b, str) for b in branches):
+                raise ValueError('branches must be a list of node ids')
+            if node.get('assign') is not None and node['assign'] not in ASSIGN_POLICIES:
+                raise ValueError(f"assign must be one of {', '.join(ASSIGN_POLICIES)}")
+            for name in ('remind_after', 'escalate_after'):
+                delay = node.get(name)
+                if delay is not None and (isinstance(delay, bool) or not isinstance(delay, (int, float)) or delay <= 0):
+                    raise ValueError(f'{name} must be a positive number of seconds')
+            for condition in conditions:
+                # conditions without a target are never routed but must
+                # still be valid; the others are compiled with the workflow
+                if condition.get('expr') is not None and condition.get('next') is None:
+                    compile_condition(condition['expr'])
+        # compiles the conditions, raising ConditionError (a ValueError)
+        # for unsafe expressions
+        plan = Workflow.from_template(nodes, require_approvers=False).plan
+        problems = plan.errors()
+        if problems:
+            raise ValueError(problems[0])
+        warnings = plan.warnings()
     elif require_config:
         raise ValueError('workflow_config required')
 
-    return payload
+    return payload, warnings
 
 
 @app.post('/admin/templates')
@@ -227,43 +297,79 @@ def _normalize_template(payload, require_config=False):
 def create_template():
     tpl = request.get_json() or {}
     try:
-        tpl = _normalize_template(tpl, require_config=True)
+        tpl, warnings = _normalize_template(tpl, require_config=True)
     except ValueError:
         return '', 400
-    tpl['id'] = max([t['id'] for t in data['templates']], default=0) + 1
-    data['templates'].append(tpl)
-    approval._refresh_refs()
+    tpl['id'] = storage.next_id('templates')
+    storage.insert('templates', tpl)
     storage.save()
-    return jsonify(tpl), 201
+    return jsonify(dict(tpl, warnings=warnings) if warnings else tpl), 201
+
+
+@app.post('/admin/templates/<int:template_id>/preview')
+@authenticate_token
+@authorize_roles('admin')
+def preview_template(template_id):
+    """Show where the template's in-progress forms go once their current node is approved.
+
+    The body may carry changed ``steps``/``workflow_config`` to preview
+    them before saving; all forms are routed in one batch.
+    """
+    tpl = storage.get('templates', template_id)
+    if not tpl:
+        return '', 404
+    payload = request.get_json(silent=True) or {}
+    try:
+        payload, _ = _normalize_template(payload)
+        if 'workflow_config' in payload:
+            wf = Workflow.from_template(payload['workflow_config']['nodes'])
+        else:
+            wf = approval._compiled(tpl)
+    except ValueError:
+        return '', 400
+    forms = [
+        f for f in storage.find_all('approval_forms', template_id=template_id, status='in_progress')
+        if f.get('workflow_state')
+    ]
+    if wf is None or not forms:
+        return jsonify([])
+    current = [f['workflow_state']['current'] for f in forms]
+    upcoming = wf.next_approval_batch(current, [f.get('data') for f in forms])
+    return jsonify([
+        {
+            'form_id': f['id'],
+            'current': node_id,
+            'next': next_id,
+            'approvers': wf.get_node(next_id).approvers if next_id else [],
+        }
+        for f, node_id, next_id in zip(forms, current, upcoming)
+    ])
 
 
 @app.put('/admin/templates/<int:template_id>')
 @authenticate_token
 @authorize_roles('admin')
 def update_template(template_id):
-    tpl = next((t for t in data['templates'] if t['id'] == template_id), None)
+    tpl = storage.get('templates', template_id)
     if not tpl:
         return '', 404
     payload = request.get_json() or {}
     try:
-        payload = _normalize_template(payload)
+        payload, warnings = _normalize_template(payload)
     except ValueError:
         return '', 400
-    tpl.update(payload)
+    storage.update('templates', tpl, payload)
+    approval.workflow_cache.invalidate(template_id)
     storage.save()
-    return jsonify(tpl)
+    return jsonify(dict(tpl, warnings=warnings) if warnings else tpl)
 
 
 @app.delete('/admin/templates/<int:template_id>')
 @authenticate_token
 @authorize_roles('admin')
 def delete_template(template_id):
-    templates = data['templates']
-    for i, t in enumerate(templates):
-        if t['id'] == template_id:
-            del templates[i]
-            break
-    approval._refresh_refs()
+    storage.delete('templates', template_id)
+    approval.workflow_cache.invalidate(template_id)
     storage.save()
     return '', 204
 
@@ -284,7 +390,7 @@ def add_verifier():
     if uid is None:
         return '', 400
     verification.authorized_verifiers.add(uid)
-    data['authorized_verifiers'] = sorted(verification.authorized_verifiers)
+    storage.put('authorized_verifiers', sorted(verification.authorized_verifiers))
     storage.save()
     return jsonify({'user_id': uid}), 201
 
@@ -294,11 +400,52 @@ def add_verifier():
 @authorize_roles('admin')
 def remove_verifier(user_id):
     verification.authorized_verifiers.discard(user_id)
-    data['authorized_verifiers'] = sorted(verification.authorized_verifiers)
+    storage.put('authorized_verifiers', sorted(verification.authorized_verifiers))
     storage.save()
     return '', 204
 
 
+@app.post('/admin/archive')
+@authenticate_token
+@authorize_roles('admin')
+def archive_forms():
+    """归档长期未变动的已结束审批单"""
+    payload = request.get_json(silent=True) or {}
+    days = payload.get('days', storage.ARCHIVE_AFTER_DAYS)
+    if not isinstance(days, (int, float)) or days < 0:
+        return '', 400
+    before = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    return jsonify({'archived': storage.archive_forms(before)})
+
+
+@app.post('/admin/timers/run')
+@authenticate_token
+@authorize_roles('admin')
+def run_timers():
+    """触发已到期的审批时限提醒与升级"""
+    fired = approval.run_timers()
+    return jsonify({'fired': [{'form_id': form_id, 'kind': kind} for form_id, kind in fired]})
+
+
+@app.get('/admin/backup')
+@authenticate_token
+@authorize_roles('admin')
+def backup():
+    """在线备份：以 gzip 流导出某一时刻的一致性快照"""
+    view = storage.snapshot_view()
+
+    def generate():
+        with view:
+            yield from iter_backup(view)
+
+    name = f"backup-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.json.gz"
+    return Response(
+        generate(),
+        mimetype='application/gzip',
+        headers={'Content-Disposition': f'attachment; filename={name}'},
+    )
+
+
 @app.get('/verify/<code>')
 @authenticate_token
 def verify_form_by_code(code):
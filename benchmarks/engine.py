@@ -0,0 +1,221 @@
+"""Throughput of the workflow engine, replayed from a JSONL trace.
+
+Run from the repository root::
+
+    python -m benchmarks.engine generate trace.jsonl --forms 200000
+    python -m benchmarks.engine replay trace.jsonl [--fail-below RATE]
+    python -m benchmarks.engine run --forms 20000     # both, in memory
+
+A trace holds one event per line. ``start`` events create a form on one of
+the synthetic templates with its form data; ``act`` events are
+``WorkflowInstance.act`` calls (which include ``Workflow.notify``)::
+
+    {"op": "start", "form": 7, "template": "branching", "data": {"amount": 12000, "dept": "ops"}}
+    {"op": "act", "form": 7, "actor": 11, "result": "approved"}
+
+The generator drives the engine itself to pick a permitted actor for every
+step, so a trace is only valid for the engine that generated it; forms are
+interleaved like concurrent traffic. Replay reports transitions per
+second, p50/p99 latency of ``act`` and peak memory, and with
+``--fail-below`` exits with status 1 under a given rate, so it can gate a
+CI job. Notifications are recorded by the ``notifications`` module in a
+list, which the replay clears as it goes.
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from array import array
+from typing import Dict, Iterable, Iterator, List
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - not on Windows
+    resource = None
+
+import notifications
+from workflow import Workflow, WorkflowInstance
+
+
+def linear(length=6):
+    """Approval nodes one after the other."""
+    return Workflow.from_template([
+        {'id': f'a{i}', 'type': 'approval', 'approvers': [i + 1], 'delegates': [100 + i],
+         'next': f'a{i + 1}' if i + 1 < length else None}
+        for i in range(length)
+    ])
+
+
+def branching():
+    """Conditions on amount and department choose one of three routes."""
+    return Workflow.from_template([
+        {'id': 'manager', 'type': 'approval', 'approvers': [1], 'delegates': [2], 'next': 'finance',
+         'conditions': [
+             {'expr': 'amount > 10000 and dept == "ops"', 'next': 'ops'},
+             {'expr': 'amount > 10000', 'next': 'director'},
+         ]},
+        {'id': 'ops', 'type': 'approval', 'approvers': [3], 'next': 'director'},
+        {'id': 'director', 'type': 'approval', 'approvers': [4], 'next': 'cfo',
+         'conditions': [{'expr': 'amount <= 50000', 'next': 'finance'}]},
+        {'id': 'cfo', 'type': 'approval', 'approvers': [5], 'next': 'finance'},
+        {'id': 'finance', 'type': 'approval', 'approvers': [6, 7]},
+    ])
+
+
+def push_chain(depth=20):
+    """Approvals separated by long chains of push nodes.
+
+    Notifying an approval walks the push chain to find the next approvers.
+    The engine stops at a push node, so forms end at the first chain.
+    """
+    steps = [{'id': 'a0', 'type': 'approval', 'approvers': [1], 'next': 'p0'}]
+    steps += [
+        {'id': f'p{i}', 'type': 'push', 'push': [50 + i % 5], 'next': f'p{i + 1}' if i + 1 < depth else 'a1'}
+        for i in range(depth)
+    ]
+    steps.append({'id': 'a1', 'type': 'approval', 'approvers': [2]})
+    return Workflow.from_template(steps)
+
+
+TEMPLATES = {'linear': linear, 'branching': branching, 'push_chain': push_chain}
+
+
+def _form_data(rng):
+    return {'amount': rng.choice((500, 8000, 20000, 90000)), 'dept': rng.choice(('ops', 'sales', 'hr'))}
+
+
+def generate(forms: int, templates: List[str], seed: int = 1, concurrency: int = 1000) -> Iterator[dict]:
+    """Yield the events of ``forms`` synthetic forms, ``concurrency`` at a time."""
+    rng = random.Random(seed)
+    workflows = {name: TEMPLATES[name]() for name in templates}
+    open_forms: List[tuple] = []  # (form id, instance)
+    started = 0
+    while started < forms or open_forms:
+        while started < forms and len(open_forms) < concurrency:
+            started += 1
+            name = rng.choice(templates)
+            data = _form_data(rng)
+            open_forms.append((started, WorkflowInstance(workflows[name], context=data, auto_notify_start=False)))
+            yield {'op': 'start', 'form': started, 'template': name, 'data': data}
+        i = rng.randrange(len(open_forms))
+        form_id, inst = open_forms[i]
+        node = inst.current_node()
+        if inst.status != 'pending' or node is None or node.type != 'approval':
+            # swap with the last one and drop it
+            open_forms[i] = open_forms[-1]
+            open_forms.pop()
+            continue
+        actor = rng.choice(node.approvers + node.delegates)
+        result = 'rejected' if rng.random() < 0.03 else 'approved'
+        inst.act(actor_id=actor, result=result)
+        notifications.reset()
+        yield {'op': 'act', 'form': form_id, 'actor': actor, 'result': result}
+
+
+def replay(events: Iterable[dict]) -> dict:
+    """Replay ``events`` and return the measurements."""
+    workflows = {name: factory() for name, factory in TEMPLATES.items()}
+    instances: Dict[int, WorkflowInstance] = {}
+    latencies = array('d')
+    clock = time.perf_counter
+    started = clock()
+    for n, event in enumerate(events):
+        if event['op'] == 'start':
+            instances[event['form']] = WorkflowInstance(
+                workflows[event['template']], context=event['data'], auto_notify_start=False)
+            continue
+        inst = instances[event['form']]
+        before = clock()
+        inst.act(actor_id=event['actor'], result=event['result'])
+        latencies.append(clock() - before)
+        node = inst.current_node()
+        if inst.status != 'pending' or node is None or node.type != 'approval':
+            del instances[event['form']]
+        if n % 1024 == 0:
+            notifications.reset()
+    elapsed = clock() - started
+    notifications.reset()
+    ordered = sorted(latencies)
+    count = len(ordered)
+    engine = sum(ordered)
+    return {
+        'transitions': count,
+        'seconds': elapsed,
+        'per_second': count / engine if engine else 0.0,
+        'wall_per_second': count / elapsed if elapsed else 0.0,
+        'p50_us': ordered[count // 2] * 1e6 if count else 0.0,
+        'p99_us': ordered[min(count - 1, count * 99 // 100)] * 1e6 if count else 0.0,
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def read_trace(path: str) -> Iterator[dict]:
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_trace(path: str, events: Iterable[dict]) -> int:
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for event in events:
+            f.write(json.dumps(event, separators=(',', ':')) + '\n')
+            count += 1
+    return count
+
+
+def report(stats: dict) -> str:
+    peak = f"{stats['peak_rss_mb']:.0f} MB" if stats['peak_rss_mb'] is not None else 'n/a'
+    return '\n'.join([
+        f"{stats['transitions']} transitions in {stats['seconds']:.2f} s",
+        f"  engine      {stats['per_second']:10.0f} transitions/s ({stats['wall_per_second']:.0f}/s wall clock)",
+        f"  latency     p50 {stats['p50_us']:.1f} us, p99 {stats['p99_us']:.1f} us",
+        f"  peak RSS    {peak}",
+    ])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name in ('generate', 'run'):
+        command = commands.add_parser(name)
+        if name == 'generate':
+            command.add_argument('trace')
+        command.add_argument('--forms', type=int, default=100000)
+        command.add_argument('--templates', default=','.join(TEMPLATES))
+        command.add_argument('--seed', type=int, default=1)
+    for name in ('replay', 'run'):
+        command = commands.choices.get(name) or commands.add_parser(name)
+        if name == 'replay':
+            command.add_argument('trace')
+        command.add_argument('--fail-below', type=float, help='exit with status 1 below this many transitions/s')
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        count = write_trace(args.trace, generate(args.forms, args.templates.split(','), args.seed))
+        print(f'{count} events written to {args.trace}')
+        return 0
+    if args.command == 'replay':
+        stats = replay(read_trace(args.trace))
+    else:
+        stats = replay(list(generate(args.forms, args.templates.split(','), args.seed)))
+    print(report(stats))
+    if args.fail_below is not None and stats['per_second'] < args.fail_below:
+        print(f'below {args.fail_below:.0f} transitions/s', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
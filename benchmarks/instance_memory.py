@@ -0,0 +1,81 @@
+"""Memory held per rehydrated workflow instance.
+
+Run from the repository root::
+
+    python -m benchmarks.instance_memory [instances] [records per instance]
+
+Instances are rebuilt from their persisted state, as the approval
+controller does, and the memory they retain is measured with
+``tracemalloc``. The shared compiled workflow and the form data (owned by
+the stored form) are excluded.
+
+On CPython 3.11 an instance with two records took 544 bytes with
+dataclass records and 448 with the slotted ones (176 -> 136 bytes without
+records). The flow_state caches add 48 bytes of slots, plus the cached
+flow once it has been displayed: 496 bytes, about 500 MB for a million
+forms in flight. The fork/join, countersign and assignment slots add 32
+bytes; the branches of a fork and the signatures only take memory while
+open.
+"""
+
+import gc
+import json
+import sys
+import time
+import tracemalloc
+
+from workflow import Workflow, WorkflowInstance
+
+
+def build_workflow():
+    return Workflow.from_template([
+        {'id': 'manager', 'type': 'approval', 'approvers': [1], 'delegates': [2], 'next': 'finance'},
+        {'id': 'finance', 'type': 'approval', 'approvers': [3], 'next': 'director'},
+        {'id': 'director', 'type': 'approval', 'approvers': [4], 'next': 'archive'},
+        {'id': 'archive', 'type': 'push', 'push': [9]},
+    ])
+
+
+def sample_states(wf, count, records):
+    inst = WorkflowInstance(wf, auto_notify_start=False)
+    for i in range(records):
+        inst.act(actor_id=inst.current_node().approvers[0], result='approved',
+                 attachments=['receipt.pdf'] if i == 0 else None)
+    state = json.dumps(inst.to_state())
+    # decoded separately, like states read from storage
+    return [json.loads(state) for _ in range(count)]
+
+
+def main(count=100000, records=2):
+    wf = build_workflow()
+    states = sample_states(wf, count, records)
+    context = {'amount': 100}
+    # timed without tracemalloc, which slows every allocation down
+    started = time.perf_counter()
+    instances = [WorkflowInstance.from_state(wf, s, context=context) for s in states]
+    elapsed = time.perf_counter() - started
+    del instances
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    instances = [WorkflowInstance.from_state(wf, s, context=context) for s in states]
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    sample = instances[:10000]
+    timings = []
+    # first call resolves the flow, the second one finds it cached
+    for _ in range(2):
+        started = time.perf_counter()
+        for inst in sample:
+            inst.to_dict()
+        timings.append((time.perf_counter() - started) / len(sample))
+    print(f'{count} instances with {records} records each')
+    print(f'  memory      {held / count:8.0f} bytes/instance')
+    print(f'  rehydrate   {elapsed / count * 1e6:8.2f} us/instance')
+    print(f'  to_dict     {timings[0] * 1e6:8.2f} us/instance, {timings[1] * 1e6:.2f} us again')
+
+
+if __name__ == '__main__':
+    main(*(int(a) for a in sys.argv[1:]))
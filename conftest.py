@@ -0,0 +1,48 @@
+import pytest
+
+import storage
+
+# where the store keeps its files
+FILES = ('DATA_FILE', 'JOURNAL_FILE', 'SEGMENT_DIR', 'SNAPSHOT_FILE', 'CODEC_FILE', 'ARCHIVE_DIR', 'FEED_DIR')
+# settings and per-process state tests switch
+SETTINGS = ('MODE', 'SNAPSHOT_FORMAT', 'CODEC', 'FLUSH_WINDOW', 'MULTIPROCESS', 'ARCHIVE_AFTER_DAYS',
+            'CHANGE_FEED', 'DATABASE_URL', '_sql', '_leases', '_journal_id', '_journal_pos')
+
+
+def _redirect(monkeypatch, path):
+    monkeypatch.chdir(path)  # qr_codes/ and other relative paths
+    for name in FILES:
+        monkeypatch.setattr(storage, name, str(path / getattr(storage, name)))
+
+
+@pytest.fixture(autouse=True)
+def isolated_storage(tmp_path, monkeypatch):
+    """Keep the files of every test in ``tmp_path``, never in the repo.
+
+    The storage settings a test changes are put back afterwards and the
+    default data is rebuilt, still inside ``tmp_path``.
+    """
+    path = tmp_path / 'store'
+    path.mkdir()
+    for name in SETTINGS:
+        monkeypatch.setattr(storage, name, getattr(storage, name))
+    _redirect(monkeypatch, path)
+    storage.reset_all()
+    yield path
+    storage.flush()
+    monkeypatch.undo()
+    _redirect(monkeypatch, path)
+    storage.reset_all()
+
+
+@pytest.fixture
+def shared_store(isolated_storage, monkeypatch):
+    """A journal shared by worker processes, as with ``STORAGE_MULTIPROCESS=1``."""
+    pytest.importorskip('fcntl')
+    monkeypatch.setattr(storage, 'MODE', 'journal')
+    monkeypatch.setattr(storage, 'MULTIPROCESS', True)
+    monkeypatch.setattr(storage, '_leases', {})
+    monkeypatch.setattr(storage, '_journal_id', None)
+    monkeypatch.setattr(storage, '_journal_pos', 0)
+    storage.reset_all()
+    yield isolated_storage
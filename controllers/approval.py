@@ -1,5 +1,9 @@
 from datetime import datetime
+from functools import wraps
 import os
+import threading
+import time
+import traceback
 
 try:
     import qrcode
@@ -9,109 +13,474 @@ except Exception:  # pragma: no cover - fallback if qrcode isn't installed
 from flask import Blueprint, jsonify, request
 
 from middleware.auth import authenticate_token
+from models.approval_record import ActionType
+from notifications import send as send_notification
 import storage
-from workflow import Workflow, WorkflowInstance
+from workflow import ExecutionRecord, InstanceCache, StaleInstanceError, WorkflowCache, WorkflowInstance
+from workflow.assign import ApproverPool
+from workflow.inbox import Inbox
+from workflow.timers import TimerQueue
 
 bp = Blueprint('approval', __name__, url_prefix='/approvals')
 
-data = storage.data()
-
-# 全局变量
-workflow_templates = []
-workflow_instances = {}
-
-
-def _refresh_refs():
-    global approval_forms, submission_records, approval_records, verification_records, workflow_templates
-    approval_forms = data.setdefault('approval_forms', [])
-    submission_records = data.setdefault('submission_records', [])
-    approval_records = data.setdefault('approval_records', [])
-    verification_records = data.setdefault('verification_records', [])
-    workflow_templates = data.setdefault('templates', [])
+# Workflow state is persisted as events (the form's ``approval_records``)
+# plus a snapshot in the form's ``workflow_state``; instances are rehydrated
+# on demand and only the most recently used are kept.
+WORKFLOW_CACHE_SIZE = int(os.environ.get('WORKFLOW_CACHE_SIZE', '1024'))
+# events replayed at most before a new snapshot is written
+WORKFLOW_SNAPSHOT_EVERY = int(os.environ.get('WORKFLOW_SNAPSHOT_EVERY', '8'))
+workflow_instances = InstanceCache(WORKFLOW_CACHE_SIZE)
+# compiled workflows shared by all instances of a template version
+workflow_cache = WorkflowCache()
+# seconds between SLA timer runs in a background thread; 0 leaves running
+# them to POST /admin/timers/run
+WORKFLOW_TIMER_INTERVAL = float(os.environ.get('WORKFLOW_TIMER_INTERVAL', '0'))
+# SLA deadlines of forms waiting at nodes with ``remind_after`` or
+# ``escalate_after``, keyed by (form id, 'remind' | 'escalate'). They are
+# persisted in the forms' ``workflow_state`` and loaded on first use.
+sla_timers = TimerQueue()
+_timers_loaded = False
+_timers_lock = threading.Lock()
+# forms waiting per approver at nodes that assign each form to one approver
+# (``assign``); the assignments are persisted in the forms'
+# ``workflow_state`` and loaded on first use.
+approver_pool = ApproverPool()
+_pool_loaded = False
+# form id -> {node id: approver} counted in approver_pool, so that forms
+# other worker processes move are counted again
+_assigned = {}
+_pool_lock = threading.Lock()
+# user id -> forms waiting for that user at an active node, for the
+# ``scope=actor`` listing; the users of every form are persisted in its
+# ``workflow_state`` and loaded on first use.
+inbox = Inbox()
+_inbox_loaded = False
+_inbox_lock = threading.Lock()
 
 
 def reset_data():
-    data['approval_forms'] = []
-    data['submission_records'] = []
-    data['approval_records'] = []
-    data['verification_records'] = []
-    data['templates'] = []
-    data['next_id'] = 1
-    data['next_code'] = 1
+    storage.put('approval_forms', [])
+    storage.put('submission_records', [])
+    storage.put('approval_records', [])
+    storage.put('verification_records', [])
+    storage.put('templates', [])
+    storage.put('next_id', 1)
+    storage.put('next_code', 1)
     # Clear any in-memory workflow instances as well
     workflow_instances.clear()
-    _refresh_refs()
+    workflow_cache.clear()
+    _load_timers()
+    _load_assignments()
+    _load_inbox()
     storage.save()
 
 
-_refresh_refs()
-
-
 def _find_form(form_id):
-    return next((f for f in approval_forms if f['id'] == form_id), None)
+    """Return a form, looking in the archive if it is not hot."""
+    form = storage.get('approval_forms', form_id)
+    if form is not None:
+        return form
+    return storage.archived_form(form_id)
+
+
+def _hot(form):
+    """Return the hot copy of ``form``, moving it back from the archive.
+
+    Handlers that modify a form call this once the caller is known to be
+    allowed to, so a denied request never restores anything.
+    """
+    return storage.get('approval_forms', form['id']) or storage.restore_form(form['id'])
+
+
+def _instance(form):
+    """Return the workflow instance of ``form``, or ``None`` if it has none.
+
+    The instance is rebuilt from the snapshot in ``workflow_state`` and the
+    form's approval records written after it. In-flight forms follow the
+    template as it is now: a cached instance built against an older
+    version of the template is rebuilt against the current one.
+    """
+    state = form.get('workflow_state')
+    if not state:
+        return None
+    wf = _compiled(_find_template(state.get('template_id')))
+    if wf is None:
+        return None
+
+    def load():
+        snapshot = state.get('snapshot')
+        if snapshot is None:
+            # saved whole, before events were recorded
+            inst = WorkflowInstance.from_state(wf, state, context=form.get('data'))
+        else:
+            inst = WorkflowInstance.from_state(wf, snapshot, context=form.get('data'))
+            for event in _events(form['id'], after=snapshot['version']):
+                inst.apply(_execution_record(event))
+        inst.assignees = state.get('assignees')
+        return inst
+
+    return workflow_instances.get(form['id'], (state['version'], wf), load)
+
+
+def _events(form_id, after=0):
+    """Return the workflow events of a form with a sequence number above ``after``.
+
+    Every approval record written with a workflow step carries ``seq``,
+    the ``workflow_state`` version it produced.
+    """
+    events = [r for r in storage.find_all('approval_records', form_id=form_id) if r.get('seq', 0) > after]
+    return sorted(events, key=lambda r: r['seq'])
+
+
+def _execution_record(event):
+    return ExecutionRecord(
+        node_id=event['node_id'],
+        actor_id=event['approver_id'],
+        result=event['result'],
+        comments=event.get('comments'),
+        attachments=event.get('attachments'),
+        acted_at=datetime.fromisoformat(event['acted_at']),
+    )
+
+
+def _save_instance(form, inst, event=None, **changes):
+    """Persist ``inst`` into ``form`` together with ``changes``.
+
+    ``event`` is the approval record of the step just taken; it is stored
+    with its sequence number and only the version of ``workflow_state``
+    moves. A new snapshot is written when the workflow starts or ends, and
+    after WORKFLOW_SNAPSHOT_EVERY events, so rehydration stays bounded.
+    """
+    previous = form.get('workflow_state') or {}
+    version = previous.get('version', 0) + 1
+    snapshot = previous.get('snapshot')
+    if (event is None or snapshot is None or inst.status != 'pending'
+            or version - snapshot['version'] >= WORKFLOW_SNAPSHOT_EVERY):
+        snapshot = dict(inst.to_state(), version=version)
+    if event is not None:
+        record = inst.records[-1]
+        event.update(node_id=record.node_id, seq=version, acted_at=record.acted_at.isoformat())
+        storage.insert('approval_records', event)
+    # ``current`` lets listings see where a form is without rehydrating it
+    state = {'template_id': form.get('template_id'), 'version': version, 'current': inst.current_id, 'snapshot': snapshot}
+    timers = _deadlines(inst)
+    if timers:
+        state['timers'] = timers
+    inst.assignees = _assign(form, inst, previous.get('assignees')) or None
+    if inst.assignees:
+        state['assignees'] = inst.assignees
+        _assigned[form['id']] = dict(inst.assignees)
+    else:
+        _assigned.pop(form['id'], None)
+    waiting = inst.awaiting()
+    if waiting:
+        state['inbox'] = waiting
+    storage.update('approval_forms', form, workflow_state=state, **changes)
+    workflow_instances.put(form['id'], (version, inst.workflow), inst)
+    _schedule(form['id'], state)
+    _inbox().set(form['id'], waiting)
+
+
+def _assign(form, inst, previous):
+    """Return ``{node id: approver}`` for the active nodes that assign forms.
+
+    A node the form still waits at keeps its approver. Forms entering a
+    node are assigned through ``approver_pool`` and the approver notified;
+    assignments of nodes the form left are released. Countersign nodes
+    need several approvers and are not assigned.
+    """
+    previous = previous or {}
+    wf = inst.workflow
+    assignees = {}
+    if inst.status == 'pending':
+        for node_id in inst.active:
+            node = wf.get_node(node_id)
+            if node is None or node.type != 'approval' or not node.assign or wf.plan.required.get(node_id, 1) > 1:
+                continue
+            if previous.get(node_id) in node.approvers:
+                assignees[node_id] = previous[node_id]
+                continue
+            approver = _pool().assign((form.get('template_id'), node_id), node.approvers, node.assign,
+                                      form.get('applicant_id'))
+            assignees[node_id] = approver
+            send_notification([approver], f'{node_id} pending', None)
+    for node_id, approver in previous.items():
+        if assignees.get(node_id) != approver:
+            _pool().release(approver)
+    return assignees
+
+
+def _load_assignments():
+    """Fill the approver pool from the forms in progress (an index lookup)."""
+    global _pool_loaded, _assigned
+    assignments = []
+    assigned = {}
+    for form in storage.find_all('approval_forms', status='in_progress'):
+        state = form.get('workflow_state') or {}
+        if state.get('assignees'):
+            assigned[form['id']] = dict(state['assignees'])
+        for node_id, approver in state.get('assignees', {}).items():
+            assignments.append(((form.get('template_id'), node_id), approver, form.get('applicant_id')))
+    approver_pool.load(assignments)
+    _assigned = assigned
+    _pool_loaded = True
+
+
+def _pool():
+    if not _pool_loaded:
+        with _pool_lock:
+            if not _pool_loaded:
+                _load_assignments()
+    return approver_pool
+
+
+def _load_inbox():
+    """Fill the inbox index from the forms in progress (an index lookup).
+
+    Forms without recorded users (saved before they were recorded, or
+    waiting for nobody) are rehydrated.
+    """
+    global _inbox_loaded
+    inbox.load((form['id'], _waiting(form)) for form in storage.find_all('approval_forms', status='in_progress'))
+    _inbox_loaded = True
+
+
+def _waiting(form):
+    """Return the users ``form`` waits for, as recorded in its ``workflow_state``."""
+    if not form or form.get('status') != 'in_progress':
+        return ()
+    state = form.get('workflow_state') or {}
+    if 'inbox' in state:
+        return state['inbox']
+    inst = _instance(form)
+    return inst.awaiting() if inst else ()
+
+
+def _inbox():
+    if not _inbox_loaded:
+        with _inbox_lock:
+            if not _inbox_loaded:
+                _load_inbox()
+    return inbox
+
+
+def _forms_synced(rows):
+    """Bring the inbox, approver pool and SLA timers up to date with forms
+    other worker processes saved."""
+    global _inbox_loaded, _pool_loaded, _timers_loaded
+    with _inbox_lock:
+        if rows is None:
+            _inbox_loaded = False
+        elif _inbox_loaded:
+            for form_id, form in rows.items():
+                inbox.set(form_id, _waiting(form))
+    with _pool_lock:
+        if rows is None:
+            _pool_loaded = False
+        elif _pool_loaded:
+            for form_id, form in rows.items():
+                _sync_assignments(form_id, form)
+    with _timers_lock:
+        if rows is None:
+            _timers_loaded = False
+        elif _timers_loaded:
+            for form_id, form in rows.items():
+                in_progress = form and form.get('status') == 'in_progress'
+                _schedule(form_id, (form.get('workflow_state') or {}) if in_progress else {})
+
+
+def _sync_assignments(form_id, form):
+    # called with _pool_lock held
+    in_progress = form and form.get('status') == 'in_progress'
+    assignees = ((form.get('workflow_state') or {}).get('assignees') or {}) if in_progress else {}
+    counted = _assigned.pop(form_id, {})
+    for node_id, approver in counted.items():
+        if assignees.get(node_id) != approver:
+            approver_pool.release(approver)
+    for node_id, approver in assignees.items():
+        if counted.get(node_id) != approver:
+            approver_pool.add((form.get('template_id'), node_id), approver, form.get('applicant_id'))
+    if assignees:
+        _assigned[form_id] = dict(assignees)
+
+
+storage.watch('approval_forms', _forms_synced)
+
+
+def _deadlines(inst):
+    """Return the SLA deadlines (epoch seconds) of the node ``inst`` waits at."""
+    node = inst.current_node()
+    if inst.status != 'pending' or node is None or node.type != 'approval':
+        return {}
+    now = time.time()
+    delays = (('remind', node.remind_after), ('escalate', node.escalate_after))
+    return {kind: now + delay for kind, delay in delays if delay is not None}
+
+
+def _schedule(form_id, state):
+    """Replace the queued SLA timers of a form with those of ``state``."""
+    queue = _timers()
+    timers = state.get('timers', {})
+    for kind in ('remind', 'escalate'):
+        if kind in timers:
+            queue.schedule((form_id, kind), timers[kind], state['version'])
+        else:
+            queue.cancel((form_id, kind))
+
+
+def _load_timers():
+    """Fill the timer queue from the forms in progress (an index lookup)."""
+    global _timers_loaded
+    timers = []
+    for form in storage.find_all('approval_forms', status='in_progress'):
+        state = form.get('workflow_state') or {}
+        for kind, due in state.get('timers', {}).items():
+            timers.append(((form['id'], kind), due, state['version']))
+    sla_timers.load(timers)
+    _timers_loaded = True
+
+
+def _timers():
+    if not _timers_loaded:
+        with _timers_lock:
+            if not _timers_loaded:
+                _load_timers()
+    return sla_timers
+
+
+def run_timers(now=None, limit=None):
+    """Fire the SLA timers due at ``now``; return ``[(form id, kind)]`` fired.
+
+    A reminder notifies the approvers of the node the form waits at (its
+    assigned approver, if the node assigns forms); an
+    escalation notifies ``Workflow.escalation_targets`` (the delegates, or
+    the next approval node's approvers). Timers of forms that moved on in
+    the meantime are dropped. Fired timers are removed from the form's
+    ``workflow_state`` so they do not fire again after a restart.
+    Timers other worker processes scheduled are synced in first.
+    """
+    storage.sync()
+    now = time.time() if now is None else now
+    fired = []
+    for (form_id, kind), due, version in _timers().pop_due(now, limit):
+        with storage.row_lock('approval_forms', form_id):
+            form = storage.get('approval_forms', form_id)
+            state = (form or {}).get('workflow_state') or {}
+            timers = state.get('timers', {})
+            if state.get('version') != version or timers.get(kind) != due:
+                continue
+            wf = _compiled(_find_template(state.get('template_id')))
+            node = wf.get_node(state.get('current')) if wf else None
+            if node is not None:
+                if kind == 'remind':
+                    assignee = state.get('assignees', {}).get(node.id)
+                    recipients = [assignee] if assignee is not None else node.approvers
+                else:
+                    recipients = wf.escalation_targets(node.id, form.get('data'))
+                if recipients:
+                    send_notification(recipients, f'{node.id} {kind}: {form["code"]} overdue', None)
+            remaining = {k: v for k, v in timers.items() if k != kind}
+            storage.update('approval_forms', form, workflow_state=dict(state, timers=remaining))
+            fired.append((form_id, kind))
+    if fired:
+        storage.save()
+    return fired
+
+
+def start_timer_thread(interval):
+    """Run :func:`run_timers` every ``interval`` seconds in a daemon thread."""
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                run_timers()
+            except Exception:  # keep the thread alive for the next run
+                traceback.print_exc()
+
+    thread = threading.Thread(target=loop, name='workflow-timers', daemon=True)
+    thread.start()
+    return thread
 
 
 def _find_submission_record(form_id):
-    return next((r for r in submission_records if r['form_id'] == form_id), None)
+    """Return the latest submission of a form."""
+    records = storage.find_all('submission_records', form_id=form_id)
+    return records[-1] if records else None
 
 
 def _find_template(template_id):
-    return next((t for t in workflow_templates if t['id'] == template_id), None)
+    return storage.get('templates', template_id)
 
 
-def _can_approve(user_id, template):
-    """检查用户是否有权限审批"""
+def _compiled(template):
+    """Return the shared compiled workflow of ``template``, if it has one.
+
+    Templates whose approval nodes lack approvers are accepted by the admin
+    API but cannot run; they are treated as having no workflow.
+    """
     if not template:
-        return False
-    
-    nodes = template.get('workflow_config', {}).get('nodes', [])
-    for node in nodes:
-        if node.get('type') == 'approval':
-            # 检查是否是审批人
-            if user_id in node.get('approvers', []):
-                return True
-            # 检查是否是代审批人
-            if user_id in node.get('delegates', []):
-                return True
-    
-    return False
+        return None
+    try:
+        return workflow_cache.get(template['id'], template.get('workflow_config'))
+    except ValueError:
+        return None
+
+
+def _form_locked(f):
+    """Serialize handlers that read-modify-write the same form."""
+    @wraps(f)
+    def decorated(form_id, *args, **kwargs):
+        with storage.row_lock('approval_forms', form_id):
+            return f(form_id, *args, **kwargs)
+    return decorated
+
+
+def _can_approve(user_id, template):
+    """检查用户是否有权限审批（审批人或代审批人）"""
+    wf = _compiled(template)
+    return wf is not None and wf.can_act(user_id)
 
 
 @bp.get('')
 @authenticate_token
 def list_forms():
-    """Return approval forms visible to the current user."""
-    def _actor_forms(uid):
-        # 获取用户需要审批的表单
-        actor_forms = []
-        for form in approval_forms:
-            if form['status'] in ['pending', 'in_progress']:
-                template = _find_template(form.get('template_id'))
-                if template and _can_approve(uid, template):
-                    actor_forms.append(form)
-        return actor_forms
+    """Return approval forms visible to the current user.
 
+    ``scope=actor`` lists the forms waiting for the user at an active node,
+    a page read from the inbox index.
+    """
     scope = request.args.get('scope')
-    forms = approval_forms
-    if request.user.get('role') == 'admin':
-        if scope == 'actor':
-            forms = _actor_forms(request.user['id'])
-    else:
-        if scope == 'actor':
-            forms = _actor_forms(request.user['id'])
-        else:
-            forms = [f for f in forms if f['applicant_id'] == request.user['id']]
-    
     status = request.args.get('status')
-    if status:
-        forms = [f for f in forms if f.get('status') == status]
-    
+    criteria = {'status': status} if status else {}
+
     # 添加分页支持
     page = int(request.args.get('page', 1))
     size = int(request.args.get('size', 10))
     start = (page - 1) * size
     end = start + size
-    
+
+    if scope == 'actor':
+        # 获取用户需要审批的表单
+        uid = request.user['id']
+        index = _inbox()
+        if status and status != 'in_progress':
+            form_ids, total = [], 0
+        else:
+            form_ids, total = index.page(uid, start, size), index.count(uid)
+        items = []
+        for form_id in form_ids:
+            form = storage.get('approval_forms', form_id)
+            state = (form or {}).get('workflow_state') or {}
+            # skip forms another worker process moved on in the meantime
+            if form and form.get('status') == 'in_progress' and uid in state.get('inbox', (uid,)):
+                items.append(form)
+        return jsonify({'items': items, 'total': total, 'page': page, 'size': size})
+
+    if request.user.get('role') == 'admin':
+        forms = storage.find_all('approval_forms', **criteria)
+    else:
+        forms = storage.find_all('approval_forms', applicant_id=request.user['id'], **criteria)
+
     return jsonify({
         'items': forms[start:end],
         'total': len(forms),
@@ -125,7 +494,7 @@ def list_forms():
 def create_form():
     payload = request.get_json() or {}
     form = {
-        'id': data['next_id'],
+        'id': storage.allocate('next_id'),
         'data': payload.get('data', {}),
         'template_id': payload.get('template_id'),
         'applicant_id': request.user['id'],
@@ -133,7 +502,7 @@ def create_form():
         'dept_id': request.user.get('dept_id'),
         'status': 'draft',
         'submitted_at': None,
-        'code': f"APP{data['next_code']:06d}",
+        'code': f"APP{storage.allocate('next_code'):06d}",
         'created_at': datetime.utcnow().isoformat()
     }
     
@@ -148,64 +517,68 @@ def create_form():
             f.write(b'')
     form['qr_code_path'] = qr_path
 
-    approval_forms.append(form)
-    data['next_id'] += 1
-    data['next_code'] += 1
+    storage.insert('approval_forms', form)
     storage.save()
     return jsonify(form), 201
 
 
 @bp.put('/<int:form_id>')
 @authenticate_token
+@_form_locked
 def update_form(form_id):
     form = _find_form(form_id)
     if not form:
         return '', 404
     if form['applicant_id'] != request.user['id'] or form['status'] not in ('draft', 'rejected'):
         return '', 403
+    form = _hot(form)
     payload = request.get_json() or {}
     if 'data' in payload:
-        form['data'] = payload['data']
+        storage.update('approval_forms', form, data=payload['data'])
     storage.save()
     return jsonify(form)
 
 
 @bp.post('/<int:form_id>/submit')
 @authenticate_token
+@_form_locked
 def submit_form(form_id):
     form = _find_form(form_id)
     if not form:
         return '', 404
+    if form['applicant_id'] != request.user['id']:
+        return '', 403
+    form = _hot(form)
     
     now = datetime.utcnow().isoformat()
-    form['status'] = 'submitted'
-    form['submitted_at'] = now
+    status = 'submitted'
     
     record = {
-        'id': len(submission_records) + 1,
+        'id': storage.next_id('submission_records'),
         'form_id': form_id,
         'submitter_id': request.user['id'],
         'submitted_at': now
     }
-    submission_records.append(record)
+    storage.insert('submission_records', record)
 
     # 创建工作流实例
-    template = _find_template(form.get('template_id'))
-    nodes = template.get('workflow_config', {}).get('nodes') if template else None
-    if nodes:
-        wf = Workflow.from_template(nodes)
+    wf = _compiled(_find_template(form.get('template_id')))
+    if wf:
         inst = WorkflowInstance(wf, context=form.get('data'))
-        workflow_instances[form_id] = inst
         node = inst.current_node()
         if node and node.type == 'approval':
-            form['status'] = 'in_progress'
-
+            status = 'in_progress'
+        _save_instance(form, inst, status=status, submitted_at=now)
+    else:
+        storage.update('approval_forms', form, status=status, submitted_at=now)
+        _inbox().set(form_id, ())
     storage.save()
     return jsonify(form)
 
 
 @bp.post('/<int:form_id>/reject')
 @authenticate_token
+@_form_locked
 def reject_form(form_id):
     form = _find_form(form_id)
     if not form:
@@ -215,6 +588,7 @@ def reject_form(form_id):
     template = _find_template(form.get('template_id'))
     if template and not _can_approve(request.user['id'], template):
         return '', 403
+    form = _hot(form)
     
     payload = request.get_json() or {}
     now = datetime.utcnow().isoformat()
@@ -223,29 +597,37 @@ def reject_form(form_id):
     attachments = payload.get('attachments', [])
     comments = payload.get('comments')
 
-    inst = workflow_instances.get(form_id)
-    if inst:
-        inst.act(
-            actor_id=request.user['id'],
-            result='rejected',
-            comments=comments,
-            attachments=attachments,
-        )
-        form['status'] = inst.status
-    else:
-        form['status'] = 'rejected'
-
     record = {
-        'id': len(approval_records) + 1,
+        'id': storage.next_id('approval_records'),
         'form_id': form_id,
         'approver_id': request.user['id'],
         'submission_id': sr['id'] if sr else None,
-        'result': 'rejected',
+        'result': ActionType.REJECTED.value,
         'comments': comments,
         'attachments': attachments,
         'acted_at': now,
     }
-    approval_records.append(record)
+    inst = _instance(form)
+    if inst:
+        try:
+            inst.act(
+                actor_id=request.user['id'],
+                result=record['result'],
+                comments=comments,
+                attachments=attachments,
+                node_id=payload.get('node_id'),
+            )
+        except StaleInstanceError:
+            # the template lost the nodes the form is at; an admin must fix it
+            return '', 409
+        except ValueError:
+            # e.g. the form is assigned to another approver
+            return '', 403
+        _save_instance(form, inst, record, status=inst.status)
+    else:
+        storage.update('approval_forms', form, status='rejected')
+        _inbox().set(form_id, ())
+        storage.insert('approval_records', record)
 
     resp = dict(form)
     if inst:
@@ -256,6 +638,7 @@ def reject_form(form_id):
 
 @bp.post('/<int:form_id>/approve')
 @authenticate_token
+@_form_locked
 def approve_form(form_id):
     form = _find_form(form_id)
     if not form:
@@ -265,6 +648,7 @@ def approve_form(form_id):
     template = _find_template(form.get('template_id'))
     if template and not _can_approve(request.user['id'], template):
         return '', 403
+    form = _hot(form)
     
     payload = request.get_json() or {}
     now = datetime.utcnow().isoformat()
@@ -273,34 +657,43 @@ def approve_form(form_id):
     attachments = payload.get('attachments', [])
     comments = payload.get('comments')
 
-    inst = workflow_instances.get(form_id)
-    if inst:
-        inst.act(
-            actor_id=request.user['id'],
-            result='approved',
-            comments=comments,
-            attachments=attachments,
-        )
-        if inst.status == 'approved':
-            form['status'] = 'approved'
-        elif inst.status == 'rejected':
-            form['status'] = 'rejected'
-        else:
-            form['status'] = 'in_progress'
-    else:
-        form['status'] = 'approved'
-
     record = {
-        'id': len(approval_records) + 1,
+        'id': storage.next_id('approval_records'),
         'form_id': form_id,
         'approver_id': request.user['id'],
         'submission_id': sr['id'] if sr else None,
-        'result': 'approved',
+        'result': ActionType.APPROVED.value,
         'comments': comments,
         'attachments': attachments,
         'acted_at': now,
     }
-    approval_records.append(record)
+    inst = _instance(form)
+    if inst:
+        try:
+            inst.act(
+                actor_id=request.user['id'],
+                result=record['result'],
+                comments=comments,
+                attachments=attachments,
+                node_id=payload.get('node_id'),
+            )
+        except StaleInstanceError:
+            # the template lost the nodes the form is at; an admin must fix it
+            return '', 409
+        except ValueError:
+            # e.g. the form is assigned to another approver
+            return '', 403
+        if inst.status == 'approved':
+            status = 'approved'
+        elif inst.status == 'rejected':
+            status = 'rejected'
+        else:
+            status = 'in_progress'
+        _save_instance(form, inst, record, status=status)
+    else:
+        storage.update('approval_forms', form, status='approved')
+        _inbox().set(form_id, ())
+        storage.insert('approval_records', record)
 
     resp = dict(form)
     if inst:
@@ -322,7 +715,7 @@ def get_form(form_id):
         result['template'] = template
         result['can_approve'] = _can_approve(request.user['id'], template)
 
-    inst = workflow_instances.get(form_id)
+    inst = _instance(form)
     if inst:
         result['workflow'] = inst.to_dict()
 
@@ -1,3 +1,4 @@
+from contextlib import nullcontext
 from datetime import datetime
 import csv
 import io
@@ -5,7 +6,7 @@ import io
 from flask import Blueprint, request, jsonify, send_file
 
 from middleware.auth import authenticate_token
-from . import approval
+import storage
 
 try:  # optional excel support
     from openpyxl import Workbook
@@ -24,11 +25,9 @@ def _parse_date(value):
         return None
 
 
-def _filter_forms(forms, status=None, start=None, end=None):
+def _filter_forms(forms, start=None, end=None):
     result = []
     for form in forms:
-        if status and form.get('status') != status:
-            continue
         submitted_at = form.get('submitted_at')
         if start and (not submitted_at or datetime.fromisoformat(submitted_at) < start):
             continue
@@ -38,6 +37,11 @@ def _filter_forms(forms, status=None, start=None, end=None):
     return result
 
 
+def _source(export):
+    """Read exports from a snapshot view so they don't hold up writers."""
+    return storage.snapshot_view() if export else nullcontext(storage)
+
+
 def _paginate(items, page, per_page):
     start = (page - 1) * per_page
     end = start + per_page
@@ -85,13 +89,13 @@ def _export_approvals(data, fmt):
 @authenticate_token
 def dashboard_stats():
     """获取仪表板统计数据"""
-    forms = approval.approval_forms
-    
-    # 统计各状态的数量
+    # 统计各状态的数量（含归档审批单）
     status_counts = {}
     total_amount = 0
+    total_count = 0
     
-    for form in forms:
+    for form in storage.iter_rows('approval_forms'):
+        total_count += 1
         status = form.get('status', 'draft')
         status_counts[status] = status_counts.get(status, 0) + 1
         
@@ -105,7 +109,7 @@ def dashboard_stats():
         'approved': status_counts.get('approved', 0),
         'rejected': status_counts.get('rejected', 0),
         'totalAmount': total_amount,
-        'totalCount': len(forms)
+        'totalCount': total_count
     })
 
 
@@ -116,10 +120,12 @@ def approval_stats():
     start = _parse_date(request.args.get('start_date'))
     end = _parse_date(request.args.get('end_date'))
 
-    filtered = _filter_forms(approval.approval_forms, status, start, end)
+    criteria = {'status': status} if status else {}
+    export = request.args.get('export')
+    with _source(export) as source:
+        filtered = _filter_forms(source.iter_rows('approval_forms', **criteria), start, end)
     total_amount = sum(f.get('data', {}).get('amount', 0) for f in filtered)
 
-    export = request.args.get('export')
     if export:
         return _export_approvals(filtered, export)
 
@@ -136,11 +142,9 @@ def approval_stats():
     })
 
 
-def _filter_verifications(records, status=None, start=None, end=None):
+def _filter_verifications(records, start=None, end=None):
     result = []
     for record in records:
-        if status and record.get('status') != status:
-            continue
         verified_at = record.get('verified_at')
         if start and (not verified_at or datetime.fromisoformat(verified_at) < start):
             continue
@@ -194,15 +198,17 @@ def verification_stats():
     start = _parse_date(request.args.get('start_date'))
     end = _parse_date(request.args.get('end_date'))
 
-    filtered = _filter_verifications(approval.verification_records, status, start, end)
-
+    criteria = {'status': status} if status else {}
     export = request.args.get('export')
+    with _source(export) as source:
+        filtered = _filter_verifications(source.iter_rows('verification_records', **criteria), start, end)
+
     if export:
         return _export_verifications(filtered, export)
 
     total_amount = 0
     for r in filtered:
-        form = next((f for f in approval.approval_forms if f['id'] == r['form_id']), None)
+        form = storage.get('approval_forms', r['form_id']) or storage.archived_form(r['form_id'])
         if form:
             total_amount += form.get('data', {}).get('amount', 0)
 
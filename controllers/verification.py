@@ -3,24 +3,21 @@ from datetime import datetime
 from flask import Blueprint, jsonify, request
 
 from middleware.auth import authenticate_token
-from . import approval
 import storage
 
 bp = Blueprint('verification', __name__, url_prefix='/verification')
 
-data = storage.data()
-
 
 # set of user IDs allowed to verify forms
 authorized_verifiers = set()
 
 def _refresh_verifiers():
     global authorized_verifiers
-    authorized_verifiers = set(data.get('authorized_verifiers', []))
+    authorized_verifiers = set(storage.value('authorized_verifiers', []))
 
 
 def reset_data():
-    data['authorized_verifiers'] = [1]
+    storage.put('authorized_verifiers', [1])
     _refresh_verifiers()
     storage.save()
 
@@ -40,11 +37,14 @@ reset_data()
 
 
 def _find_form_by_code(code):
-    return next((f for f in approval.approval_forms if f.get('code') == code), None)
+    form = storage.find('approval_forms', code=code)
+    if form is not None:
+        return form
+    return storage.archived_form(code=code)
 
 
 def _find_verification_record(form_id):
-    return next((r for r in approval.verification_records if r['form_id'] == form_id), None)
+    return storage.find('verification_records', form_id=form_id)
 
 
 @bp.get('/<code>')
@@ -64,33 +64,43 @@ def verify_form(code):
         return '', 404
     if request.user['id'] not in authorized_verifiers:
         return '', 403
+    # only now move an archived form back into the hot store
+    form = storage.get('approval_forms', form['id']) or storage.restore_form(form['id'])
     payload = request.get_json() or {}
     result = payload.get('result', 'verified')
     comments = payload.get('comments')
     now = datetime.utcnow().isoformat()
 
-    record = _find_verification_record(form['id'])
-    if record:
-        record.update({
-            'verifier_id': request.user['id'],
-            'status': result,
-            'verified_at': now,
-            'comments': comments,
-        })
-    else:
-        record = {
-            'id': len(approval.verification_records) + 1,
-            'form_id': form['id'],
-            'verifier_id': request.user['id'],
-            'status': result,
-            'verified_at': now,
-            'comments': comments,
-        }
-        approval.verification_records.append(record)
-
-    form['status'] = 'verified' if result == 'verified' else 'verification_failed'
-    form['verified_at'] = now
-    form['verifier_id'] = request.user['id']
-    form['verification_comments'] = comments
+    # find-or-create of the record must not race with another verifier
+    with storage.row_lock('approval_forms', form['id']):
+        record = _find_verification_record(form['id'])
+        if record:
+            storage.update(
+                'verification_records',
+                record,
+                verifier_id=request.user['id'],
+                status=result,
+                verified_at=now,
+                comments=comments,
+            )
+        else:
+            record = {
+                'id': storage.next_id('verification_records'),
+                'form_id': form['id'],
+                'verifier_id': request.user['id'],
+                'status': result,
+                'verified_at': now,
+                'comments': comments,
+            }
+            storage.insert('verification_records', record)
+
+        storage.update(
+            'approval_forms',
+            form,
+            status='verified' if result == 'verified' else 'verification_failed',
+            verified_at=now,
+            verifier_id=request.user['id'],
+            verification_comments=comments,
+        )
     storage.save()
     return jsonify(record)
@@ -10,6 +10,8 @@ from sqlalchemy import (
 )
 from sqlalchemy.orm import relationship
 
+from workflow.plan import node_map, reachable
+
 from .base import Base, TimestampMixin
 
 
@@ -55,19 +57,27 @@ class ApprovalTemplate(TimestampMixin, Base):
         nodes = self.get_workflow_nodes()
         return [node for node in nodes if node.get('type') == NodeType.APPROVAL.value]
     
+    def get_node_map(self):
+        """获取节点ID到节点的索引（流程配置不变时复用）"""
+        nodes = self.get_workflow_nodes()
+        cached = getattr(self, '_node_map', None)
+        if cached is None or cached[0] is not nodes:
+            cached = self._node_map = (nodes, node_map(nodes))
+        return cached[1]
+
     def get_node_by_id(self, node_id):
         """根据ID获取节点"""
-        nodes = self.get_workflow_nodes()
-        return next((node for node in nodes if node.get('id') == node_id), None)
+        return self.get_node_map().get(node_id)
     
     def get_next_nodes(self, current_node_id):
         """获取当前节点的下一个节点"""
-        current_node = self.get_node_by_id(current_node_id)
+        index = self.get_node_map()
+        current_node = index.get(current_node_id)
         if not current_node:
             return []
         
         next_node_ids = current_node.get('next', [])
-        return [self.get_node_by_id(node_id) for node_id in next_node_ids if self.get_node_by_id(node_id)]
+        return [index[node_id] for node_id in next_node_ids if node_id in index]
     
     def validate_workflow(self):
         """验证流程配置"""
@@ -86,11 +96,18 @@ class ApprovalTemplate(TimestampMixin, Base):
             return False, "必须有至少一个结束节点"
         
         # 检查节点连接
-        node_ids = {node.get('id') for node in nodes}
+        index = self.get_node_map()
         for node in nodes:
             next_ids = node.get('next', [])
             for next_id in next_ids:
-                if next_id not in node_ids:
+                if next_id not in index:
                     return False, f"节点 {node.get('id')} 连接到不存在的节点 {next_id}"
+
+        # 检查所有节点均可从开始节点到达
+        edges = {node_id: node.get('next', []) for node_id, node in index.items()}
+        found = reachable(start_nodes[0].get('id'), edges)
+        for node in nodes:
+            if node.get('id') not in found:
+                return False, f"节点 {node.get('id')} 无法从开始节点到达"
         
         return True, "流程配置有效"
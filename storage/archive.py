@@ -0,0 +1,159 @@
+"""Append-only cold tier for forms that no longer change.
+
+An archived form is stored together with the rows that reference it as
+one *bundle*: a JSON line ``{"approval_forms": form, "<collection>": [rows
+with form_id == form['id']], ...}`` appended to the current segment file
+``segment-NNNNNN.jsonl`` in the archive directory. A new segment is started
+once the current one outgrows SEGMENT_BYTES.
+
+``index.jsonl`` is appended to after the bundles are durable and maps each
+form id (and code) to the segment, offset and length of its latest
+bundle. A line without a segment marks a form that was restored to the
+hot store. Only the index is kept in memory.
+"""
+
+import json
+import os
+import shutil
+import threading
+
+from . import journal
+
+SEGMENT_BYTES = 64 * 1024 * 1024
+INDEX = 'index.jsonl'
+
+
+def _segment_name(number):
+    return f'segment-{number:06d}.jsonl'
+
+
+def encode(bundle):
+    return journal.encode(bundle).encode('utf-8') + b'\n'
+
+
+class Archive:
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self._lock = threading.RLock()
+        self._entries = {}
+        self._codes = {}
+        self._index_pos = 0
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _refresh(self):
+        # other processes may have appended to the index
+        path = self._path(INDEX)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size == self._index_pos:
+            return
+        if size < self._index_pos:
+            # the archive was cleared
+            self._entries.clear()
+            self._codes.clear()
+            self._index_pos = 0
+            if not size:
+                return
+        entries, self._index_pos = journal.read_from(path, self._index_pos)
+        for entry in entries:
+            old = self._entries.pop(entry['id'], None)
+            if old is not None:
+                self._codes.pop(old[3], None)
+            if entry.get('s') is not None:
+                self._entries[entry['id']] = (entry['s'], entry['o'], entry['n'], entry.get('code'))
+                if entry.get('code') is not None:
+                    self._codes[entry['code']] = entry['id']
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._entries)
+
+    def __contains__(self, form_id):
+        with self._lock:
+            self._refresh()
+            return form_id in self._entries
+
+    def read(self, form_id=None, code=None):
+        """Return the bundle of a form by id or code, or ``None``."""
+        with self._lock:
+            self._refresh()
+            if form_id is None:
+                form_id = self._codes.get(code)
+            location = self._entries.get(form_id)
+        if location is None:
+            return None
+        segment, offset, length, _ = location
+        with open(self._path(_segment_name(segment)), 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.read(length))
+
+    def add(self, bundles):
+        """Durably append encoded bundles given as ``(form, line)`` pairs."""
+        if not bundles:
+            return
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            segment = self._current_segment()
+            path = self._path(_segment_name(segment))
+            payload = b''.join(line for _, line in bundles)
+            offset = journal.write(path, payload) - len(payload)
+            index = []
+            for form, line in bundles:
+                index.append({'id': form['id'], 'code': form.get('code'), 's': segment, 'o': offset, 'n': len(line)})
+                offset += len(line)
+            journal.append(self._path(INDEX), index)
+            self._refresh()
+
+    def forget(self, form_ids):
+        """Drop forms from the index, e.g. once they are hot again."""
+        if not form_ids:
+            return
+        with self._lock:
+            journal.append(self._path(INDEX), [{'id': i, 's': None} for i in form_ids])
+            self._refresh()
+
+    def _current_segment(self):
+        numbers = [
+            int(name[8:14]) for name in os.listdir(self.directory)
+            if name.startswith('segment-') and name.endswith('.jsonl')
+        ]
+        if not numbers:
+            return 1
+        last = max(numbers)
+        if os.path.getsize(self._path(_segment_name(last))) >= self.segment_bytes:
+            return last + 1
+        return last
+
+    def bundles(self):
+        """Yield the current bundle of every archived form, segment by segment.
+
+        Segments are streamed line by line; bundles that were superseded or
+        restored are skipped.
+        """
+        with self._lock:
+            self._refresh()
+        if not os.path.isdir(self.directory):
+            return
+        names = sorted(n for n in os.listdir(self.directory) if n.startswith('segment-'))
+        for name in names:
+            segment = int(name[8:14])
+            offset = 0
+            with open(self._path(name), 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    bundle = json.loads(line)
+                    location = self._entries.get(bundle['approval_forms']['id'])
+                    if location is not None and location[:2] == (segment, offset):
+                        yield bundle
+                    offset += len(line)
+
+    def clear(self):
+        with self._lock:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self._entries.clear()
+            self._codes.clear()
+            self._index_pos = 0
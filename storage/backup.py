@@ -0,0 +1,71 @@
+"""Online backups of the data store.
+
+A backup is a gzip-compressed JSON document with the layout of
+``data.json`` (so ``gunzip`` restores a json-mode data file). It is
+written from a :func:`storage.snapshot_view`, so it reflects a single
+point in time while approvals keep being saved. Collections are streamed
+chunk by chunk and never serialized as a whole. The archive directory
+(see ``storage.archive``) is append-only and is not part of the backup;
+copy it alongside.
+
+From the command line::
+
+    python -m storage.backup backup-2024-01-01.json.gz
+"""
+
+import json
+import sys
+import zlib
+
+
+def iter_backup(view, level=6):
+    """Yield the compressed backup of ``view`` in chunks."""
+    # wbits=31 selects the gzip container
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    collections = set(view.collections())
+    for piece in _pieces(view, collections):
+        chunk = compressor.compress(piece.encode('utf-8'))
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
+def _pieces(view, collections):
+    yield '{'
+    for i, key in enumerate(view.keys()):
+        yield (',' if i else '') + json.dumps(key) + ':'
+        if key not in collections:
+            yield json.dumps(view.value(key))
+            continue
+        yield '['
+        for j, row in enumerate(view.rows(key)):
+            yield (',' if j else '') + json.dumps(row)
+        yield ']'
+    yield '}'
+
+
+def write_backup(path, view):
+    """Write the backup of ``view`` to ``path``; returns the byte count."""
+    size = 0
+    with open(path, 'wb') as f:
+        for chunk in iter_backup(view):
+            f.write(chunk)
+            size += len(chunk)
+    return size
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        print('usage: python -m storage.backup OUTPUT.json.gz', file=sys.stderr)
+        return 2
+    import storage
+
+    with storage.snapshot_view() as view:
+        size = write_backup(argv[0], view)
+    print(f'wrote {size} bytes to {argv[0]}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
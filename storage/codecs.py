@@ -0,0 +1,278 @@
+"""Serialization codecs for full snapshots of the data dictionary.
+
+``json``
+    the plain ``data.json`` document.
+``compact``
+    JSON with key-dictionary encoding: the rows of a collection are stored
+    as value arrays next to a table of their key tuples ("shapes"), so
+    field names are written once per collection instead of once per row.
+    Decoded rows of one shape share their key strings.
+``binary``
+    a tagged binary encoding with zigzag varint integers and a string
+    table: dict keys and short strings (statuses, node ids, ...) are
+    written once and referenced by index afterwards, and decode to one
+    shared (interned) string object.
+
+Any codec can be wrapped in zlib compression by appending ``+zlib`` to its
+name, e.g. ``binary+zlib``. Encoded documents other than ``json`` start
+with a magic number, so :func:`loads` needs no configuration and a store
+can switch codecs at any time.
+
+On typical approval data ``compact`` is about half the size of ``json``,
+saves faster and loads as fast. ``binary`` is smaller still but is
+encoded in pure Python and therefore slower; ``+zlib`` trades time for
+roughly a tenth of the size.
+
+Codecs encode ``(key, value)`` pairs as they are produced, which lets the
+caller hold a per-key lock while that key is encoded.
+"""
+
+import contextlib
+import gc
+import json
+import struct
+import sys
+import zlib
+
+# strings up to this length are put in the binary string table
+INTERN_MAX = 32
+
+
+class JSONCodec:
+    name = 'json'
+    magic = b''
+
+    def dumps(self, items):
+        parts = [f'{json.dumps(k)}:{json.dumps(v)}' for k, v in items]
+        return ('{' + ','.join(parts) + '}').encode('utf-8')
+
+    def loads(self, payload):
+        return json.loads(payload)
+
+
+class CompactCodec:
+    name = 'compact'
+    magic = b'GPCJ'
+
+    def dumps(self, items):
+        parts = []
+        for key, value in items:
+            if isinstance(value, list) and value and all(type(r) is dict for r in value):
+                value = self._pack_rows(value)
+            else:
+                value = {'v': value}
+            parts.append(f'{json.dumps(key)}:{json.dumps(value, separators=(",", ":"))}')
+        return self.magic + ('{' + ','.join(parts) + '}').encode('utf-8')
+
+    @staticmethod
+    def _pack_rows(rows):
+        shapes = {}
+        ids = []
+        values = []
+        for row in rows:
+            shape = tuple(row)
+            ids.append(shapes.setdefault(shape, len(shapes)))
+            values.append(list(row.values()))
+        return {
+            'k': [list(shape) for shape in shapes],
+            # one shape for every row is by far the common case
+            's': ids[0] if len(shapes) == 1 else ids,
+            'r': values,
+        }
+
+    def loads(self, payload):
+        data = {}
+        for key, value in json.loads(payload[len(self.magic):]).items():
+            if 'v' in value:
+                data[key] = value['v']
+                continue
+            shapes = [tuple(sys.intern(k) for k in shape) for shape in value['k']]
+            if isinstance(value['s'], int):
+                shape = shapes[value['s']]
+                data[key] = [dict(zip(shape, row)) for row in value['r']]
+            else:
+                data[key] = [dict(zip(shapes[s], row)) for s, row in zip(value['s'], value['r'])]
+        return data
+
+
+# binary codec tags
+_NONE, _FALSE, _TRUE, _INT, _FLOAT, _STR, _REF, _LIST, _DICT = range(9)
+_DOUBLE = struct.Struct('<d')
+
+
+class BinaryCodec:
+    name = 'binary'
+    magic = b'GPCB'
+
+    def dumps(self, items):
+        out = bytearray(self.magic)
+        table = {}
+        for key, value in items:
+            self._string(out, table, key)
+            self._value(out, table, value)
+        return bytes(out)
+
+    @staticmethod
+    def _varint(out, n):
+        while n > 0x7f:
+            out.append((n & 0x7f) | 0x80)
+            n >>= 7
+        out.append(n)
+
+    def _string(self, out, table, s):
+        ref = table.get(s)
+        if ref is not None:
+            out.append(_REF)
+            self._varint(out, ref)
+            return
+        raw = s.encode('utf-8')
+        out.append(_STR)
+        self._varint(out, len(raw))
+        out += raw
+        if len(s) <= INTERN_MAX:
+            table[s] = len(table)
+
+    def _value(self, out, table, value):
+        if value is None:
+            out.append(_NONE)
+        elif value is True:
+            out.append(_TRUE)
+        elif value is False:
+            out.append(_FALSE)
+        elif isinstance(value, int):
+            out.append(_INT)
+            # zigzag: small negative numbers stay small
+            self._varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+        elif isinstance(value, float):
+            out.append(_FLOAT)
+            out += _DOUBLE.pack(value)
+        elif isinstance(value, str):
+            self._string(out, table, value)
+        elif isinstance(value, (list, tuple)):
+            out.append(_LIST)
+            self._varint(out, len(value))
+            for item in value:
+                self._value(out, table, item)
+        elif isinstance(value, dict):
+            out.append(_DICT)
+            self._varint(out, len(value))
+            for k, v in value.items():
+                self._string(out, table, k)
+                self._value(out, table, v)
+        else:
+            raise TypeError(f'cannot encode {type(value).__name__}')
+
+    def loads(self, payload):
+        return _BinaryReader(payload, len(self.magic)).document()
+
+
+class _BinaryReader:
+    def __init__(self, buf, pos):
+        self.buf = buf
+        self.pos = pos
+        self.table = []
+
+    def varint(self):
+        buf = self.buf
+        result = shift = 0
+        while True:
+            b = buf[self.pos]
+            self.pos += 1
+            result |= (b & 0x7f) << shift
+            if b < 0x80:
+                return result
+            shift += 7
+
+    def document(self):
+        data = {}
+        while self.pos < len(self.buf):
+            key = self.value()
+            data[key] = self.value()
+        return data
+
+    def value(self):
+        tag = self.buf[self.pos]
+        self.pos += 1
+        if tag == _REF:
+            return self.table[self.varint()]
+        if tag == _STR:
+            size = self.varint()
+            s = self.buf[self.pos:self.pos + size].decode('utf-8')
+            self.pos += size
+            if len(s) <= INTERN_MAX:
+                s = sys.intern(s)
+                self.table.append(s)
+            return s
+        if tag == _INT:
+            n = self.varint()
+            return n >> 1 if not n & 1 else -((n + 1) >> 1)
+        if tag == _DICT:
+            return {self.value(): self.value() for _ in range(self.varint())}
+        if tag == _LIST:
+            return [self.value() for _ in range(self.varint())]
+        if tag == _NONE:
+            return None
+        if tag == _TRUE:
+            return True
+        if tag == _FALSE:
+            return False
+        if tag == _FLOAT:
+            value = _DOUBLE.unpack_from(self.buf, self.pos)[0]
+            self.pos += _DOUBLE.size
+            return value
+        raise ValueError(f'unknown tag {tag} at offset {self.pos - 1}')
+
+
+class ZlibCodec:
+    magic = b'GPCZ'
+
+    def __init__(self, inner, level=6):
+        self.inner = inner
+        self.level = level
+        self.name = inner.name + '+zlib'
+
+    def dumps(self, items):
+        return self.magic + zlib.compress(self.inner.dumps(items), self.level)
+
+    def loads(self, payload):
+        return loads(payload)
+
+
+_CODECS = {c.name: c for c in (JSONCodec(), CompactCodec(), BinaryCodec())}
+
+
+def get(name):
+    """Return the codec called ``name`` (e.g. ``compact`` or ``binary+zlib``)."""
+    base, _, wrapper = name.partition('+')
+    if base not in _CODECS or wrapper not in ('', 'zlib'):
+        raise ValueError(f'unknown codec {name!r}')
+    codec = _CODECS[base]
+    return ZlibCodec(codec) if wrapper else codec
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    # decoding allocates millions of acyclic containers; letting the cyclic
+    # collector rescan them as they pile up costs more than the decoding
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def loads(payload):
+    """Decode a document written by any codec, told apart by its magic."""
+    with _gc_paused():
+        return _loads(payload)
+
+
+def _loads(payload):
+    if payload.startswith(ZlibCodec.magic):
+        payload = zlib.decompress(payload[len(ZlibCodec.magic):])
+    for codec in (_CODECS['compact'], _CODECS['binary']):
+        if payload.startswith(codec.magic):
+            return codec.loads(payload)
+    return _CODECS['json'].loads(payload)
@@ -0,0 +1,15 @@
+"""Matching rows against lookup criteria, shared by the storage backends."""
+
+
+def matches(row, criteria):
+    """Return whether ``row`` has every field of ``criteria``.
+
+    A list, tuple or set value matches any of its elements.
+    """
+    for name, value in criteria.items():
+        if isinstance(value, (list, tuple, set)):
+            if row.get(name) not in value:
+                return False
+        elif row.get(name) != value:
+            return False
+    return True
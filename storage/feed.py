@@ -0,0 +1,184 @@
+"""Ordered change feed (change data capture) of the data store.
+
+Every mutation made through the storage API becomes one event::
+
+    {"seq": 17, "op": "update", "collection": "approval_forms", "id": 5,
+     "before": {...}, "after": {...}}
+
+``op`` is ``insert``, ``update`` or ``delete``; ``archive`` and ``restore``
+mark rows moving to and from the cold tier (see ``storage.archive``) and
+``reset`` a collection replaced as a whole, after which consumers should
+rebuild from a full scan. Events are appended when the changes they
+describe are persisted, with strictly increasing sequence numbers.
+
+The feed lives in a directory of segment files ``changes-<first seq>.jsonl``.
+Each consumer has a named cursor in ``cursor-<name>.json`` that survives
+restarts; segments every cursor has moved past are removed by
+:meth:`ChangeFeed.trim`.
+"""
+
+import json
+import os
+import threading
+
+from . import journal
+
+SEGMENT_BYTES = 16 * 1024 * 1024
+# bytes read from the end of a segment at first to find the last event
+_TAIL_BYTES = 64 * 1024
+_PREFIX = 'changes-'
+_CURSOR = 'cursor-'
+
+
+class ChangeFeed:
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _segments(self):
+        """Return ``(first seq, path)`` of every segment, oldest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        found = []
+        for name in os.listdir(self.directory):
+            if name.startswith(_PREFIX) and name.endswith('.jsonl'):
+                found.append((int(name[len(_PREFIX):-6]), self._path(name)))
+        return sorted(found)
+
+    def last_seq(self):
+        """Return the sequence number of the newest event (0 if none)."""
+        segments = self._segments()
+        if not segments:
+            return 0
+        first, path = segments[-1]
+        with open(path, 'rb') as f:
+            pos = f.seek(0, os.SEEK_END)
+            step = _TAIL_BYTES
+            tail = b''
+            # read backwards until a complete event line is in ``tail``
+            while pos > 0:
+                step = min(step, pos)
+                pos -= step
+                f.seek(pos)
+                tail = f.read(step) + tail
+                lines = tail[:tail.rfind(b'\n') + 1].split(b'\n')[:-1]
+                if pos:
+                    # the first line may have started before ``pos``
+                    lines = lines[1:]
+                for line in reversed(lines):
+                    try:
+                        return json.loads(line)['seq']
+                    except ValueError:  # torn by a crash
+                        continue
+                step *= 2
+        return first - 1
+
+    def append(self, events):
+        """Number ``events`` and append them durably; returns the last seq.
+
+        Callers appending from several processes must serialize the calls.
+        """
+        with self._lock:
+            seq = self.last_seq()
+            if not events:
+                return seq
+            os.makedirs(self.directory, exist_ok=True)
+            segments = self._segments()
+            if segments and os.path.getsize(segments[-1][1]) < self.segment_bytes:
+                path = segments[-1][1]
+            else:
+                path = self._path(f'{_PREFIX}{seq + 1:012d}.jsonl')
+            numbered = []
+            for event in events:
+                seq += 1
+                numbered.append(dict(event, seq=seq))
+            journal.append(path, numbered)
+            return seq
+
+    def read(self, after=0, limit=1000):
+        """Return up to ``limit`` events with a sequence number above ``after``."""
+        segments = self._segments()
+        start = 0
+        for i, (first, _) in enumerate(segments):
+            if first <= after + 1:
+                start = i
+        events = []
+        for _, path in segments[start:]:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    event = json.loads(line)
+                    if event['seq'] > after:
+                        events.append(event)
+                        if len(events) >= limit:
+                            return events
+        return events
+
+    def cursor(self, name):
+        path = self._path(f'{_CURSOR}{name}.json')
+        if not os.path.exists(path):
+            return 0
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)['seq']
+
+    def commit(self, name, seq):
+        """Durably move the cursor of consumer ``name`` to ``seq``."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(f'{_CURSOR}{name}.json')
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'seq': seq}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def trim(self):
+        """Remove segments that every cursor has consumed.
+
+        Returns the number of segments removed. Without any cursor nothing
+        is removed.
+        """
+        if not os.path.isdir(self.directory):
+            return 0
+        cursors = [
+            self.cursor(name[len(_CURSOR):-5]) for name in os.listdir(self.directory)
+            if name.startswith(_CURSOR) and name.endswith('.json')
+        ]
+        if not cursors:
+            return 0
+        done = min(cursors)
+        segments = self._segments()
+        removed = 0
+        # a segment is consumed once the next one starts at or before done + 1
+        for (_, path), (following, _) in zip(segments, segments[1:]):
+            if following - 1 > done:
+                break
+            os.remove(path)
+            removed += 1
+        return removed
+
+
+class Subscription:
+    """A named consumer of the feed.
+
+    ``poll`` returns the events after the consumer's cursor; ``commit``
+    records how far the consumer got, so after a restart polling resumes
+    from there.
+    """
+
+    def __init__(self, feed, name):
+        self.feed = feed
+        self.name = name
+        self.position = feed.cursor(name)
+
+    def poll(self, limit=1000):
+        return self.feed.read(self.position, limit)
+
+    def commit(self, seq):
+        self.feed.commit(self.name, seq)
+        self.position = seq
@@ -0,0 +1,77 @@
+"""In-memory hash indexes over the collections of the data dictionary.
+
+Every collection is indexed by row id; the fields listed in ``FIELDS`` get
+an additional ``value -> {row_id: row}`` map. Buckets keep insertion order,
+so lookups return rows in the order they were added to the collection.
+
+An index remembers which list it was built from and how long it was. A
+collection that was replaced, or appended to behind the storage API's
+back, no longer matches and is re-indexed on the next lookup.
+"""
+
+FIELDS = {
+    'users': ('username',),
+    'approval_forms': ('code', 'applicant_id', 'status'),
+    'submission_records': ('form_id',),
+    'approval_records': ('form_id',),
+    'verification_records': ('form_id',),
+}
+
+# types a lookup value must have to be answered from an index
+HASHABLE = (str, int, float, type(None))
+
+
+class CollectionIndex:
+    def __init__(self, fields=()):
+        self.fields = fields
+        self.rows = None
+        self.size = 0
+        self.by_id = {}
+        self.by_field = {}
+
+    def current(self, rows):
+        return rows is not None and rows is self.rows and len(rows) == self.size
+
+    def rebuild(self, rows):
+        self.rows = rows
+        self.size = 0
+        self.by_id = {}
+        self.by_field = {name: {} for name in self.fields}
+        for row in rows:
+            self.add(row)
+
+    def invalidate(self):
+        self.rows = None
+
+    def add(self, row):
+        self.size += 1
+        self.by_id[row.get('id')] = row
+        for name in self.fields:
+            self.by_field[name].setdefault(row.get(name), {})[row.get('id')] = row
+
+    def remove(self, row):
+        self.size -= 1
+        self.by_id.pop(row.get('id'), None)
+        for name in self.fields:
+            self._unlink(name, row)
+
+    def change(self, row, fields):
+        """Move ``row`` to the buckets of ``fields`` before they are applied."""
+        for name in self.fields:
+            if name in fields and fields[name] != row.get(name):
+                self._unlink(name, row)
+                self.by_field[name].setdefault(fields[name], {})[row.get('id')] = row
+
+    def _unlink(self, name, row):
+        bucket = self.by_field[name].get(row.get(name))
+        if bucket is not None:
+            bucket.pop(row.get('id'), None)
+            if not bucket:
+                del self.by_field[name][row.get(name)]
+
+    def lookup(self, name, value):
+        """Return the rows whose ``name`` equals ``value``."""
+        if name == 'id':
+            row = self.by_id.get(value)
+            return [] if row is None else [row]
+        return list(self.by_field[name].get(value, {}).values())
@@ -0,0 +1,145 @@
+"""Append-only mutation journal.
+
+Each line of the journal is one compact JSON entry describing a single
+mutation of the shared data dictionary:
+
+``{"o": "put", "c": <collection>, "r": <row>}``
+    insert or replace the row with ``row['id']`` in ``collection``
+``{"o": "del", "c": <collection>, "i": <id>}``
+    remove the row with the given id from ``collection``
+``{"o": "set", "k": <key>, "v": <value>}``
+    replace a top-level key (counters, whole collections)
+
+Every entry carries the full new value of what it touches, so replaying a
+journal on top of a snapshot that already contains some of its entries
+yields the same result as replaying it on the older snapshot.
+"""
+
+import json
+import os
+
+
+def encode(entry):
+    return json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+
+
+def dumps(entries):
+    """Encode ``entries`` as the bytes appended to a journal."""
+    return ''.join(encode(e) + '\n' for e in entries).encode('utf-8')
+
+
+def append(path, entries):
+    """Append ``entries`` to the journal at ``path`` and fsync it."""
+    write(path, dumps(entries))
+
+
+def write(path, payload):
+    """Append already encoded entries to the journal at ``path``.
+
+    The entries start on a fresh line even after a torn write, so a
+    partial line left by a crash never swallows the next entry. Returns
+    the offset just past the entries.
+    """
+    if not payload:
+        return os.path.getsize(path) if os.path.exists(path) else 0
+    with open(path, 'a+b') as f:
+        end = f.seek(0, os.SEEK_END)
+        if end:
+            f.seek(end - 1)
+            if f.read(1) != b'\n':
+                payload = b'\n' + payload
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    return end + len(payload)
+
+
+def _position(positions, data, collection, row_id):
+    index = positions.get(collection)
+    rows = data.get(collection)
+    if index is None:
+        index = {r.get('id'): i for i, r in enumerate(rows or [])}
+        positions[collection] = index
+    return index.get(row_id)
+
+
+def apply(data, entry, positions):
+    """Apply a single journal entry to ``data``.
+
+    ``positions`` caches ``id -> list index`` maps per collection so that a
+    replay of many entries does not rescan the collections.
+    """
+    op = entry.get('o')
+    if op == 'set':
+        data[entry['k']] = entry['v']
+        positions.pop(entry['k'], None)
+    elif op == 'put':
+        collection, row = entry['c'], entry['r']
+        rows = data.setdefault(collection, [])
+        pos = _position(positions, data, collection, row.get('id'))
+        if pos is None:
+            positions[collection][row.get('id')] = len(rows)
+            rows.append(row)
+        else:
+            rows[pos] = row
+    elif op == 'del':
+        collection = entry['c']
+        pos = _position(positions, data, collection, entry['i'])
+        if pos is not None:
+            del data[collection][pos]
+            # positions after the removed row have shifted
+            positions.pop(collection, None)
+
+
+def replay(path, data):
+    """Replay the journal at ``path`` into ``data``.
+
+    Returns the number of entries applied. A torn trailing line left by a
+    crash during append is cut off the file, and lines torn by an earlier
+    crash (ended by the next append) are skipped.
+    """
+    if not os.path.exists(path):
+        return 0
+    positions = {}
+    count = 0
+    end = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            end += len(line)
+            entry = _decode(line)
+            if entry is not None:
+                apply(data, entry, positions)
+                count += 1
+    if end < os.path.getsize(path):
+        with open(path, 'r+b') as f:
+            f.truncate(end)
+            f.flush()
+            os.fsync(f.fileno())
+    return count
+
+
+def read_from(path, offset):
+    """Return ``(entries, end)`` for the complete entries after ``offset``.
+
+    ``end`` is the offset just past the last complete entry.
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        chunk = f.read()
+    end = chunk.rfind(b'\n') + 1
+    entries = []
+    for line in chunk[:end].splitlines():
+        entry = _decode(line)
+        if entry is not None:
+            entries.append(entry)
+    return entries, offset + end
+
+
+def _decode(line):
+    # ``None`` for a line torn by a crash
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
@@ -0,0 +1,81 @@
+"""Per-collection segment files.
+
+A segment directory holds, for every collection, a base file
+``<collection>.json`` with the full list of rows and a delta file
+``<collection>.delta`` with journal entries (see ``storage.journal``)
+recorded since the base was written. Top-level values that are not
+collections live together in ``_meta.json``.
+
+Saving a change to one collection therefore appends a few lines to that
+collection's delta and leaves every other file untouched. A delta that
+outgrows its base is folded back into a new base.
+"""
+
+import json
+import os
+
+from . import journal
+
+META = '_meta'
+
+
+def _path(directory, name, ext):
+    return os.path.join(directory, f'{name}.{ext}')
+
+
+def _write(path, text):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load(directory):
+    """Return the data dictionary stored in ``directory``."""
+    data = {}
+    if not os.path.isdir(directory):
+        return data
+    meta = _path(directory, META, 'json')
+    if os.path.exists(meta):
+        with open(meta, 'r', encoding='utf-8') as f:
+            data.update(json.load(f))
+    for filename in sorted(os.listdir(directory)):
+        name, ext = os.path.splitext(filename)
+        if name == META or ext not in ('.json', '.delta'):
+            continue
+        if ext == '.json':
+            with open(os.path.join(directory, filename), 'r', encoding='utf-8') as f:
+                data[name] = json.load(f)
+        elif not os.path.exists(_path(directory, name, 'json')):
+            data.setdefault(name, [])
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.delta'):
+            journal.replay(os.path.join(directory, filename), data)
+    return data
+
+
+def write_base(directory, name, rows):
+    """Rewrite the base file of a collection and drop its delta."""
+    _write(_path(directory, name, 'json'), json.dumps(rows))
+    delta = _path(directory, name, 'delta')
+    if os.path.exists(delta):
+        os.remove(delta)
+
+
+def append_delta(directory, name, entries):
+    """Append journal entries to a collection's delta.
+
+    Returns ``True`` when the delta has grown larger than the base and
+    should be folded with :func:`write_base`.
+    """
+    delta = _path(directory, name, 'delta')
+    journal.append(delta, entries)
+    base = _path(directory, name, 'json')
+    base_size = os.path.getsize(base) if os.path.exists(base) else 0
+    return os.path.getsize(delta) > max(base_size, 64 * 1024)
+
+
+def write_meta(directory, values):
+    _write(_path(directory, META, 'json'), json.dumps(values))
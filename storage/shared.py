@@ -0,0 +1,137 @@
+"""Cross-process primitives for running several workers on one data store.
+
+Workers share the journal (see ``storage.journal``): appends happen under
+an exclusive ``flock`` on a lock file, and every worker catches up by
+reading the journal from the offset it last applied. Row locks are POSIX
+byte-range locks on a second file, so two workers acting on the same form
+serialize while everything else proceeds in parallel. Ids are handed out
+in leased blocks from a small table shared by all workers.
+"""
+
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+
+def _require_fcntl():
+    if fcntl is None:
+        raise RuntimeError('multi-process storage requires fcntl (POSIX)')
+
+
+class FileLock:
+    """``flock`` on a file, also serialized between threads of one process.
+
+    Nested holds by the same thread reuse the outer lock; an exclusive
+    hold must not be nested inside a shared one.
+    """
+
+    def __init__(self, path):
+        _require_fcntl()
+        self.path = path
+        self._fd = None
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+
+    @contextmanager
+    def hold(self, exclusive=True):
+        with self._thread_lock:
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            outer = self._depth == 0
+            if outer:
+                fcntl.flock(self._fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if outer:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def reopen(self):
+        """Forget the inherited descriptor in a freshly forked child."""
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class RowLocks:
+    """Byte-range locks on one file, one byte per lock stripe.
+
+    Record locks belong to the process, so callers must make sure only one
+    thread holds a given stripe at a time; nested acquisitions are counted.
+    """
+
+    def __init__(self, path):
+        _require_fcntl()
+        self.path = path
+        self._fd = None
+        self._depth = {}
+        self._guard = threading.Lock()
+
+    def acquire(self, stripe):
+        with self._guard:
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            depth = self._depth.get(stripe, 0)
+            self._depth[stripe] = depth + 1
+        if depth == 0:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, stripe)
+
+    def release(self, stripe):
+        with self._guard:
+            depth = self._depth[stripe] - 1
+            self._depth[stripe] = depth
+        if depth == 0:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe)
+
+    def reopen(self):
+        self._guard = threading.Lock()
+        self._depth = {}
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def _read_table(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return {}
+
+
+def _write_table(path, table):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(table, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def lease(path, file_lock, counter, size, initial):
+    """Reserve ``size`` consecutive values of ``counter`` for this process.
+
+    Returns the first reserved value. ``initial`` is called to seed a
+    counter the table does not know yet.
+    """
+    with file_lock.hold():
+        table = _read_table(path)
+        first = table.get(counter)
+        if first is None:
+            first = initial()
+        table[counter] = first + size
+        _write_table(path, table)
+    return first
+
@@ -0,0 +1,292 @@
+"""Binary snapshot format that is memory-mapped and decoded on demand.
+
+Layout::
+
+    MAGIC | uint32 directory length | directory (JSON) | sections
+
+The directory maps every top-level key to the offset (``o``) and size
+(``r``) of its section, relative to the first section. A plain value is a
+single JSON document. A collection (a list of rows) is a run of records,
+each a uint32 length followed by the row as JSON, and carries its row
+count (``n``). When every row id is an integer the collection is followed
+by an offset index at ``x``: ``(id, record offset)`` pairs as little-endian
+int64/uint64, sorted by id, so one row can be found by binary search
+without decoding any other.
+
+:func:`load` only reads the directory. Collections stay in the mapped file
+until first used; see :class:`LazyData`.
+"""
+
+import json
+import mmap
+import struct
+import threading
+from collections import namedtuple
+
+MAGIC = b'GPSNAP01'
+_U32 = struct.Struct('<I')
+_SLOT = struct.Struct('<qQ')
+_INT64 = (-2 ** 63, 2 ** 63 - 1)
+
+Section = namedtuple('Section', 'records index count')
+
+
+def _encode(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def is_snapshot(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def section(value):
+    """Encode one top-level value as a :class:`Section`."""
+    if isinstance(value, Collection):
+        return value.section()
+    if not isinstance(value, list) or not all(isinstance(r, dict) for r in value):
+        return Section(_encode(value), None, None)
+    parts = []
+    slots = []
+    pos = 0
+    for row in value:
+        body = _encode(row)
+        slots.append((row.get('id'), pos))
+        parts.append(_U32.pack(len(body)))
+        parts.append(body)
+        pos += _U32.size + len(body)
+    index = None
+    if all(type(i) is int and _INT64[0] <= i <= _INT64[1] for i, _ in slots):
+        index = b''.join(_SLOT.pack(i, p) for i, p in sorted(slots))
+    return Section(b''.join(parts), index, len(value))
+
+
+def dumps(sections):
+    """Return the snapshot bytes for ``(key, Section)`` pairs."""
+    directory = {}
+    chunks = []
+    pos = 0
+    for key, sec in sections:
+        entry = {'o': pos, 'r': len(sec.records)}
+        chunks.append(sec.records)
+        pos += len(sec.records)
+        if sec.count is not None:
+            entry['n'] = sec.count
+        if sec.index is not None:
+            entry['x'] = pos
+            chunks.append(sec.index)
+            pos += len(sec.index)
+        directory[key] = entry
+    head = _encode(directory)
+    return MAGIC + _U32.pack(len(head)) + head + b''.join(chunks)
+
+
+def load(path):
+    """Map the snapshot at ``path`` and return it as :class:`LazyData`."""
+    data = LazyData()
+    with open(path, 'rb') as f:
+        if not f.read(len(MAGIC)):
+            return data
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buf[:len(MAGIC)] != MAGIC:
+        raise ValueError(f'{path} is not a binary snapshot')
+    size = _U32.unpack_from(buf, len(MAGIC))[0]
+    base = len(MAGIC) + _U32.size + size
+    directory = json.loads(buf[base - size:base])
+    for key, entry in directory.items():
+        start = base + entry['o']
+        if 'n' not in entry:
+            dict.__setitem__(data, key, json.loads(buf[start:start + entry['r']]))
+            continue
+        index = base + entry['x'] if 'x' in entry else None
+        data.defer(key, Collection(buf, start, entry['r'], entry['n'], index))
+    return data
+
+
+class Collection:
+    """Rows of one collection still sitting in the mapped snapshot.
+
+    Decoded rows are cached by position, so a row fetched with
+    :meth:`get` is the same object that later appears in :meth:`rows`.
+    Rows inserted meanwhile are kept after the mapped ones (:meth:`add`),
+    and a collection whose rows were changed in place is re-encoded by
+    :meth:`section` instead of copied.
+    """
+
+    def __init__(self, buf, offset, size, count, index):
+        self.buf = buf
+        self.offset = offset
+        self.size = size
+        self.count = count
+        self.index = index
+        self.changed = False
+        self._added = {}
+        self._decoded = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.count + len(self._added)
+
+    @property
+    def indexed(self):
+        return self.index is not None
+
+    def _row(self, pos):
+        row = self._decoded.get(pos)
+        if row is None:
+            start = self.offset + pos
+            length = _U32.unpack_from(self.buf, start)[0]
+            row = json.loads(self.buf[start + _U32.size:start + _U32.size + length])
+            self._decoded[pos] = row
+        return row
+
+    def get(self, row_id):
+        """Return the first row with ``row_id`` (requires :attr:`indexed`)."""
+        if isinstance(row_id, bool) or not isinstance(row_id, (int, float)):
+            return None
+        with self._lock:
+            row = self._find(row_id)
+            return row if row is not None else self._added.get(row_id)
+
+    def add(self, row):
+        """Insert ``row``, whose integer id no mapped row has."""
+        with self._lock:
+            self._added[row['id']] = row
+
+    def _find(self, row_id):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _SLOT.unpack_from(self.buf, self.index + mid * _SLOT.size)[0] < row_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.count:
+            return None
+        found, pos = _SLOT.unpack_from(self.buf, self.index + lo * _SLOT.size)
+        return self._row(pos) if found == row_id else None
+
+    def rows(self):
+        rows = []
+        pos = 0
+        with self._lock:
+            for _ in range(self.count):
+                rows.append(self._row(pos))
+                pos += _U32.size + _U32.unpack_from(self.buf, self.offset + pos)[0]
+            rows.extend(self._added.values())
+        return rows
+
+    def section(self):
+        if self.changed or self._added:
+            return section(self.rows())
+        index = None
+        if self.index is not None:
+            index = self.buf[self.index:self.index + self.count * _SLOT.size]
+        return Section(self.buf[self.offset:self.offset + self.size], index, self.count)
+
+
+class LazyData(dict):
+    """Data dictionary whose collections are decoded on first access.
+
+    A deferred key is present (``in``, ``len`` and iteration see it) but
+    its list is only built when the value is read through the mapping
+    API. :meth:`lazy` exposes the undecoded :class:`Collection` so single
+    rows and counts can be served without building the list.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._pending = {}
+        self._guard = threading.RLock()
+
+    def defer(self, key, collection):
+        with self._guard:
+            dict.__setitem__(self, key, None)
+            self._pending[key] = collection
+
+    def lazy(self, key):
+        return self._pending.get(key)
+
+    def add(self, key, row):
+        """Insert ``row`` into the undecoded collection ``key``.
+
+        Returns ``False`` if ``key`` is decoded (or the row cannot be
+        found by id without decoding it); the caller inserts it then.
+        """
+        with self._guard:
+            collection = self._pending.get(key)
+            if collection is None or not collection.indexed or type(row.get('id')) is not int:
+                return False
+            collection.add(row)
+            return True
+
+    def touch(self, key):
+        """Note that rows of the undecoded collection ``key`` changed in place.
+
+        Returns ``False`` if ``key`` is decoded.
+        """
+        with self._guard:
+            collection = self._pending.get(key)
+            if collection is None:
+                return False
+            collection.changed = True
+            return True
+
+    def _materialize(self, key):
+        if key in self._pending:
+            with self._guard:
+                collection = self._pending.get(key)
+                if collection is not None:
+                    dict.__setitem__(self, key, collection.rows())
+                    del self._pending[key]
+
+    def _materialize_all(self):
+        for key in list(self._pending):
+            self._materialize(key)
+
+    def __getitem__(self, key):
+        self._materialize(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        self._materialize(key)
+        return dict.get(self, key, default)
+
+    def setdefault(self, key, default=None):
+        self._materialize(key)
+        return dict.setdefault(self, key, default)
+
+    def __setitem__(self, key, value):
+        with self._guard:
+            self._pending.pop(key, None)
+            dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        with self._guard:
+            self._pending.pop(key, None)
+            dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        self._materialize(key)
+        return dict.pop(self, key, *default)
+
+    def clear(self):
+        with self._guard:
+            self._pending.clear()
+            dict.clear(self)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def items(self):
+        self._materialize_all()
+        return dict.items(self)
+
+    def values(self):
+        self._materialize_all()
+        return dict.values(self)
+
+    def copy(self):
+        self._materialize_all()
+        return dict(self)
@@ -0,0 +1,351 @@
+"""SQL storage backend built on SQLAlchemy.
+
+Every collection lives in its own ``store_<collection>`` table holding the
+row as a JSON document plus copies of the fields the controllers filter
+on. Those copies are indexed (mirroring the indexes declared in
+``models/``), so lookups such as "form by code" or "records of a form" are
+index scans instead of Python list scans. Top-level values such as
+``next_id`` live in ``store_meta``; a counter moves to
+``store_sequences`` once allocated from, and putting a new value in
+``store_meta`` drops that row again.
+
+Sessions are scoped to the current thread and removed at the end of each
+request by :func:`storage.close`; connections come from the engine pool.
+
+Existing ``data.json`` files can be migrated without loading them into
+memory::
+
+    STORAGE_MODE=sql python -m storage.sql migrate data.json sqlite:///data.db
+"""
+
+import json
+import sys
+
+from sqlalchemy import (
+    JSON,
+    Column,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    create_engine,
+    delete,
+    func,
+    insert,
+    select,
+    update,
+)
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from .criteria import matches as _matches
+
+DEFAULT_URL = 'sqlite:///data.db'
+
+# indexed copies of row fields per collection
+INDEXED = {
+    'users': {'username': String(64)},
+    'departments': {'org_id': Integer},
+    'approval_forms': {
+        'code': String(64),
+        'applicant_id': Integer,
+        'template_id': Integer,
+        'status': String(32),
+    },
+    'submission_records': {'form_id': Integer, 'submitter_id': Integer},
+    'approval_records': {'form_id': Integer, 'approver_id': Integer},
+    'verification_records': {'form_id': Integer, 'verifier_id': Integer},
+}
+
+
+class SQLStore:
+    """Collection store backed by a SQLAlchemy engine."""
+
+    def __init__(self, url=DEFAULT_URL):
+        kwargs = {}
+        if url.startswith('sqlite'):
+            kwargs['connect_args'] = {'check_same_thread': False}
+            if url in ('sqlite://', 'sqlite:///:memory:'):
+                # a single shared connection, otherwise every pooled
+                # connection would see its own empty database
+                kwargs['poolclass'] = StaticPool
+        self.engine = create_engine(url, **kwargs)
+        self.metadata = MetaData()
+        self.tables = {}
+        self.meta = Table(
+            'store_meta',
+            self.metadata,
+            Column('key', String(64), primary_key=True),
+            Column('value', JSON),
+        )
+        self.sequences = Table(
+            'store_sequences',
+            self.metadata,
+            Column('key', String(64), primary_key=True),
+            Column('value', Integer, nullable=False),
+        )
+        self.metadata.create_all(self.engine, tables=[self.meta, self.sequences])
+        self.session = scoped_session(sessionmaker(bind=self.engine))
+
+    def table(self, collection):
+        table = self.tables.get(collection)
+        if table is None:
+            columns = [Column('id', Integer, primary_key=True, autoincrement=False)]
+            for name, type_ in INDEXED.get(collection, {}).items():
+                columns.append(Column(name, type_, index=True))
+            columns.append(Column('doc', JSON, nullable=False))
+            table = Table(f'store_{collection}', self.metadata, *columns)
+            table.create(self.engine, checkfirst=True)
+            self.tables[collection] = table
+        return table
+
+    def _values(self, collection, row):
+        values = {'id': row['id'], 'doc': row}
+        for name in INDEXED.get(collection, {}):
+            value = row.get(name)
+            values[name] = value if isinstance(value, (int, str)) or value is None else str(value)
+        return values
+
+    # queries -----------------------------------------------------------
+
+    def get(self, collection, row_id):
+        table = self.table(collection)
+        return self.session().execute(
+            select(table.c.doc).where(table.c.id == row_id)
+        ).scalar()
+
+    def find_all(self, collection, criteria, session=None):
+        """Return rows matching ``criteria``.
+
+        Criteria on indexed fields become ``WHERE`` clauses; the rest are
+        applied to the decoded documents. A list/tuple/set value matches
+        any of its members. ``session`` defaults to the scoped session.
+        """
+        table = self.table(collection)
+        stmt = select(table.c.doc).order_by(table.c.id)
+        rest = {}
+        for name, value in criteria.items():
+            column = table.c.get(name) if name != 'doc' else None
+            if column is None:
+                rest[name] = value
+            elif isinstance(value, (list, tuple, set)):
+                stmt = stmt.where(column.in_(list(value)))
+            else:
+                stmt = stmt.where(column == value)
+        rows = (session or self.session()).execute(stmt).scalars()
+        if not rest:
+            return list(rows)
+        return [r for r in rows if _matches(r, rest)]
+
+    def count(self, collection):
+        table = self.table(collection)
+        return self.session().execute(select(func.count()).select_from(table)).scalar()
+
+    def get_value(self, key, default=None, session=None):
+        value = (session or self.session()).execute(
+            select(self.meta.c.value).where(self.meta.c.key == key)
+        ).scalar()
+        return default if value is None else value
+
+    def value_keys(self, session=None):
+        return list((session or self.session()).execute(select(self.meta.c.key)).scalars())
+
+    def reader(self):
+        """Return a new session whose reads all share one transaction."""
+        session = Session(self.engine)
+        session.begin()
+        return session
+
+    # mutations ---------------------------------------------------------
+
+    def insert(self, collection, row):
+        self.session().execute(insert(self.table(collection)), [self._values(collection, row)])
+
+    def insert_many(self, collection, rows):
+        if rows:
+            self.session().execute(
+                insert(self.table(collection)), [self._values(collection, r) for r in rows]
+            )
+
+    def update(self, collection, row):
+        table = self.table(collection)
+        self.session().execute(
+            update(table).where(table.c.id == row['id']).values(**self._values(collection, row))
+        )
+
+    def delete(self, collection, row_id):
+        table = self.table(collection)
+        self.session().execute(delete(table).where(table.c.id == row_id))
+
+    def replace(self, collection, rows):
+        self.session().execute(delete(self.table(collection)))
+        self.insert_many(collection, rows)
+
+    def set_value(self, key, value):
+        session = self.session()
+        session.execute(delete(self.meta).where(self.meta.c.key == key))
+        session.execute(insert(self.meta), [{'key': key, 'value': value}])
+
+    def allocate(self, key, start):
+        """Take the next value of a counter inside the current transaction.
+
+        The increment is a single ``UPDATE ... SET value = value + 1`` so
+        concurrent transactions serialize on the counter row.
+        """
+        session = self.session()
+        seq = self.sequences
+        if session.execute(update(seq).where(seq.c.key == key).values(value=seq.c.value + 1)).rowcount:
+            return session.execute(select(seq.c.value).where(seq.c.key == key)).scalar() - 1
+        current = self.get_value(key)
+        if current is None:
+            current = start() if callable(start) else start
+        session.execute(insert(seq), [{'key': key, 'value': current + 1}])
+        return current
+
+    def reset_sequence(self, key):
+        self.session().execute(delete(self.sequences).where(self.sequences.c.key == key))
+
+    def commit(self):
+        self.session().commit()
+
+    def remove(self):
+        self.session.remove()
+
+
+class _Reader:
+    """Incremental reader for the top level of a large JSON object."""
+
+    def __init__(self, fp, chunk_size):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.fp.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf) or not self._fill():
+                return self.buf[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f'expected {char!r} at offset {self.pos}')
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number that ends the buffer may continue in the next chunk
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_document(fp, collections, chunk_size=1 << 16):
+    """Yield ``(key, value)`` pairs of a JSON object read from ``fp``.
+
+    Members named in ``collections`` are yielded element by element as
+    ``(key, row)`` so arbitrarily long lists never sit in memory at once;
+    they are preceded by ``(key, None)`` to mark the start of the list.
+    """
+    reader = _Reader(fp, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key in collections and reader.peek() == '[':
+            reader.expect('[')
+            yield key, None
+            if reader.peek() == ']':
+                reader.pos += 1
+            else:
+                while True:
+                    yield key, reader.value()
+                    if reader.peek() == ',':
+                        reader.pos += 1
+                        continue
+                    reader.expect(']')
+                    break
+        else:
+            yield key, reader.value()
+        if reader.peek() == ',':
+            reader.pos += 1
+            continue
+        reader.expect('}')
+        return
+
+
+def migrate(path, store, collections, batch_size=500):
+    """Stream the JSON data file at ``path`` into ``store``.
+
+    Returns the number of rows copied per collection.
+    """
+    counts = {}
+    batch = []
+    current = None
+
+    def flush():
+        if batch:
+            store.insert_many(current, batch)
+            store.commit()
+            counts[current] = counts.get(current, 0) + len(batch)
+            batch.clear()
+
+    with open(path, 'r', encoding='utf-8') as fp:
+        for key, value in iter_document(fp, collections):
+            if key in collections:
+                if key != current:
+                    flush()
+                    current = key
+                    store.replace(key, [])
+                    counts.setdefault(key, 0)
+                if value is not None:
+                    batch.append(value)
+                    if len(batch) >= batch_size:
+                        flush()
+            else:
+                flush()
+                store.set_value(key, value)
+        flush()
+    store.commit()
+    return counts
+
+
+def main(argv):
+    if len(argv) < 2 or argv[0] != 'migrate':
+        print('usage: python -m storage.sql migrate <data.json> [url]')
+        return 2
+    from . import COLLECTIONS
+
+    url = argv[2] if len(argv) > 2 else DEFAULT_URL
+    counts = migrate(argv[1], SQLStore(url), COLLECTIONS)
+    for name, count in sorted(counts.items()):
+        print(f'{name}: {count}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
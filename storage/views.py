@@ -0,0 +1,130 @@
+"""Point-in-time views of the data store.
+
+A :class:`View` is taken by :func:`storage.snapshot_view`. Taking it copies
+the list of every collection (row references only) while all collection
+locks are held for that instant. Rows themselves are not copied: while
+a view is open, :func:`storage.update` hands it the row's previous state
+before changing it in place, so the view keeps reading the values as of
+the moment it was taken. Writers are only held up while the lists are
+copied and while the view copies a chunk of rows out.
+"""
+
+import json
+import threading
+
+CHUNK = 500
+
+
+class View:
+    def __init__(self, lock, matches, archived, release):
+        self._lock = lock
+        self._matches = matches
+        self._archived = archived
+        self._release = release
+        self._rows = {}
+        self._values = {}
+        self._before = {}
+        self._guard = threading.Lock()
+        self._form_ids = None
+
+    def capture(self, key, value):
+        # called with the lock of ``key`` held
+        if isinstance(value, list) and all(isinstance(r, dict) for r in value):
+            self._rows[key] = list(value)
+        else:
+            self._values[key] = json.loads(json.dumps(value))
+
+    def preserve(self, row):
+        """Remember ``row`` as it is before an in-place update."""
+        with self._guard:
+            if id(row) not in self._before:
+                self._before[id(row)] = dict(row)
+
+    def close(self):
+        if self._release is not None:
+            self._release(self)
+            self._release = None
+        self._rows.clear()
+        self._before.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def keys(self):
+        return list(self._rows) + list(self._values)
+
+    def value(self, key, default=None):
+        return self._values.get(key, default)
+
+    def collections(self):
+        return list(self._rows)
+
+    def rows(self, collection):
+        """Yield copies of the rows of ``collection``, leaving out the archive."""
+        rows = self._rows.get(collection, [])
+        for start in range(0, len(rows), CHUNK):
+            with self._lock(collection):
+                with self._guard:
+                    chunk = [dict(self._before.get(id(r), r)) for r in rows[start:start + CHUNK]]
+            yield from chunk
+
+    def iter_rows(self, collection, **criteria):
+        """Yield copies of the rows of ``collection`` matching ``criteria``.
+
+        Rows archived after the view was taken are found in the view's own
+        lists; the rest of the archive is streamed as in
+        :func:`storage.iter_rows`.
+        """
+        for row in self.rows(collection):
+            if self._matches(row, criteria):
+                yield row
+        if self._form_ids is None:
+            self._form_ids = {r.get('id') for r in self._rows.get('approval_forms', [])}
+        yield from self._archived(collection, criteria, self._form_ids.__contains__)
+
+    def get(self, collection, row_id):
+        return next((r for r in self.rows(collection) if r.get('id') == row_id), None)
+
+
+class SQLView:
+    """View of the SQL backend: every read goes through one transaction."""
+
+    def __init__(self, store, session, collections, archived):
+        self._store = store
+        self._session = session
+        self._collections = list(collections)
+        self._archived = archived
+
+    def close(self):
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def keys(self):
+        return self._collections + self._store.value_keys(self._session)
+
+    def collections(self):
+        return list(self._collections)
+
+    def value(self, key, default=None):
+        return self._store.get_value(key, default, self._session)
+
+    def rows(self, collection):
+        return iter(self._store.find_all(collection, {}, self._session))
+
+    def iter_rows(self, collection, **criteria):
+        yield from self._store.find_all(collection, criteria, self._session)
+        yield from self._archived(collection, criteria, lambda form_id: self.get('approval_forms', form_id) is not None)
+
+    def get(self, collection, row_id):
+        rows = self._store.find_all(collection, {'id': row_id}, self._session)
+        return rows[0] if rows else None
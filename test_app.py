@@ -2,6 +2,7 @@ import pytest
 
 from app import app, reset_data
 from controllers import approval
+import storage
 
 
 @pytest.fixture(autouse=True)
@@ -52,6 +53,15 @@ def test_user_cannot_create_user():
     assert resp.status_code == 403
 
 
+def test_user_update_takes_any_field_names():
+    client = app.test_client()
+    t = token(client, 'user', 'user')
+    payload = {'row': 1, 'collection': 'users', 'phone': '123'}
+    resp = client.put('/users/2', json=payload, headers={'Authorization': f'Bearer {t}'})
+    assert resp.status_code == 200
+    assert {k: resp.get_json()[k] for k in payload} == payload
+
+
 def test_admin_can_manage_templates():
     client = app.test_client()
     t = token(client, 'admin', 'admin')
@@ -76,7 +86,69 @@ def test_admin_can_manage_templates():
     assert any(t['id'] == tid for t in resp.get_json())
     resp = client.delete(f'/admin/templates/{tid}', headers={'Authorization': f'Bearer {t}'})
     assert resp.status_code == 204
-    assert all(t['id'] != tid for t in approval.workflow_templates)
+    assert storage.get('templates', tid) is None
+
+
+def test_template_update_recompiles_workflow():
+    client = app.test_client()
+    admin = {'Authorization': f"Bearer {token(client, 'admin', 'admin')}"}
+    user = {'Authorization': f"Bearer {token(client, 'user', 'user')}"}
+    resp = client.post('/admin/templates', json={'steps': [{'id': 'a', 'type': 'approval', 'approvers': [2]}]}, headers=admin)
+    tid = resp.get_json()['id']
+    form_ids = []
+    for _ in range(2):
+        resp = client.post('/approvals', json={'template_id': tid}, headers=admin)
+        form_ids.append(resp.get_json()['id'])
+    client.post(f'/approvals/{form_ids[0]}/submit', headers=admin)
+    assert approval._compiled(approval._find_template(tid)).can_act(2)
+
+    resp = client.put(f'/admin/templates/{tid}', json={'steps': [{'id': 'a', 'type': 'approval', 'approvers': [1]}]}, headers=admin)
+    assert resp.status_code == 200
+    client.post(f'/approvals/{form_ids[1]}/submit', headers=admin)
+    assert client.post(f'/approvals/{form_ids[1]}/approve', json={}, headers=user).status_code == 403
+    resp = client.post(f'/approvals/{form_ids[1]}/approve', json={}, headers=admin)
+    assert resp.get_json()['status'] == 'approved'
+
+
+
+def test_template_update_applies_to_cached_and_evicted_forms():
+    client = app.test_client()
+    admin = {'Authorization': f"Bearer {token(client, 'admin', 'admin')}"}
+    steps = [{'id': 'a', 'type': 'approval', 'approvers': [1], 'next': 'b'},
+             {'id': 'b', 'type': 'approval', 'approvers': [1]}]
+    tid = client.post('/admin/templates', json={'steps': steps}, headers=admin).get_json()['id']
+    form_ids = []
+    for _ in range(2):
+        form_id = client.post('/approvals', json={'template_id': tid}, headers=admin).get_json()['id']
+        client.post(f'/approvals/{form_id}/submit', headers=admin)
+        form_ids.append(form_id)
+    assert form_ids[0] in approval.workflow_instances
+
+    # a becomes the last node; one form's instance stays cached, the other's is evicted
+    client.put(f'/admin/templates/{tid}', json={'steps': [dict(steps[0], next=None), steps[1]]}, headers=admin)
+    approval.workflow_instances.discard(form_ids[1])
+    for form_id in form_ids:
+        resp = client.post(f'/approvals/{form_id}/approve', json={}, headers=admin)
+        body = resp.get_json()
+        assert (body['status'], body['workflow']['current']) == ('approved', None)
+
+def test_forms_at_a_removed_node_are_stale():
+    client = app.test_client()
+    admin = {'Authorization': f"Bearer {token(client, 'admin', 'admin')}"}
+    steps = [{'id': 'a', 'type': 'approval', 'approvers': [1], 'next': 'b'},
+             {'id': 'b', 'type': 'approval', 'approvers': [1]}]
+    tid = client.post('/admin/templates', json={'steps': steps}, headers=admin).get_json()['id']
+    form_id = client.post('/approvals', json={'template_id': tid}, headers=admin).get_json()['id']
+    client.post(f'/approvals/{form_id}/submit', headers=admin)
+    client.post(f'/approvals/{form_id}/approve', json={}, headers=admin)
+
+    # a is gone: its replayed approval does not move the form on to b
+    client.put(f'/admin/templates/{tid}', json={'steps': [steps[1]]}, headers=admin)
+    approval.workflow_instances.discard(form_id)
+    resp = client.post(f'/approvals/{form_id}/approve', json={}, headers=admin)
+    assert resp.status_code == 409
+    body = client.get(f'/approvals/{form_id}', headers=admin).get_json()
+    assert (body['status'], body['workflow']['status']) == ('in_progress', 'stale')
 
 
 def test_admin_can_manage_verifiers():
@@ -106,6 +178,95 @@ def test_admin_can_manage_orgs_and_depts():
     assert any(d['name'] == 'D2' for d in resp.get_json())
 
 
+def test_template_conditions_are_validated():
+    client = app.test_client()
+    headers = {'Authorization': f"Bearer {token(client, 'admin', 'admin')}"}
+    step = {'id': 'a', 'type': 'approval', 'approvers': [1]}
+    for conditions in ([{'expr': "__import__('os').getcwd()", 'next': 'a'}], [{'expr': 'amount >'}], 'amount > 1'):
+        resp = client.post('/admin/templates', json={'steps': [dict(step, conditions=conditions)]}, headers=headers)
+        assert resp.status_code == 400
+    resp = client.post(
+        '/admin/templates',
+        json={'steps': [dict(step, conditions=[{'expr': 'items.total > 100', 'next': 'a'}])]},
+        headers=headers,
+    )
+    assert resp.status_code == 201
+
+
+def test_template_field_types_are_validated():
+    client = app.test_client()
+    headers = {'Authorization': f"Bearer {token(client, 'admin', 'admin')}"}
+    step = {'id': 'a', 'type': 'approval', 'approvers': [1]}
+    for bad in (
+        {'id': ['a']},
+        {'next': ['a']},
+        {'approvers': 1},
+        {'delegates': 2},
+        {'push': 3},
+        {'approvers': ['1']},
+        {'conditions': [{'expr': 'amount > 1', 'next': ['a']}]},
+    ):
+        resp = client.post('/admin/templates', json={'steps': [dict(step, **bad)]}, headers=headers)
+        assert resp.status_code == 400, bad
+
+
+def test_template_graph_is_analysed_on_save():
+    client = app.test_client()
+    headers = {'Authorization': f"Bearer {token(client, 'admin', 'admin')}"}
+    steps = [
+        {'id': 'a', 'type': 'approval', 'approvers': [1], 'next': 'b'},
+        {'id': 'b', 'type': 'approval', 'approvers': [2]},
+        {'id': 'old', 'type': 'push', 'next': 'b'},
+    ]
+    resp = client.post('/admin/templates', json={'steps': steps}, headers=headers)
+    assert resp.status_code == 201
+    assert resp.get_json()['warnings'] == ['node old is unreachable']
+    tid = resp.get_json()['id']
+    assert 'warnings' not in storage.get('templates', tid)
+    for broken in (
+        [dict(steps[0], next='nowhere')],
+        [dict(steps[0], next='p'), {'id': 'p', 'type': 'push', 'next': 'a'}],
+        [dict(steps[0], conditions=[{'expr': 'amount > 1', 'next': 'nowhere'}])],
+        [dict(steps[0], next='f'), {'id': 'f', 'type': 'fork', 'branches': ['b'], 'next': 'b'}, steps[1]],
+        [{'id': 'f', 'type': 'fork', 'branches': 'b', 'next': 'j'}, steps[1], {'id': 'j', 'type': 'join'}],
+        [dict(steps[0], require='most')],
+    ):
+        resp = client.put(f'/admin/templates/{tid}', json={'steps': broken}, headers=headers)
+        assert resp.status_code == 400
+    resp = client.put(f'/admin/templates/{tid}', json={'steps': steps[:2]}, headers=headers)
+    assert resp.status_code == 200 and 'warnings' not in resp.get_json()
+    parallel = [
+        {'id': 'f', 'type': 'fork', 'branches': ['a', 'b'], 'next': 'j'},
+        dict(steps[0], next='j'),
+        dict(steps[1], next='j', require=2),
+        {'id': 'j', 'type': 'join', 'require': 'any'},
+    ]
+    resp = client.put(f'/admin/templates/{tid}', json={'steps': parallel}, headers=headers)
+    assert resp.status_code == 200 and 'warnings' not in resp.get_json()
+
+
+def test_template_preview_routes_forms_in_batch():
+    client = app.test_client()
+    headers = {'Authorization': f"Bearer {token(client, 'admin', 'admin')}"}
+    steps = [
+        {'id': 'a', 'type': 'approval', 'approvers': [1], 'next': 'b',
+         'conditions': [{'expr': 'amount > 100', 'next': 'c'}]},
+        {'id': 'b', 'type': 'approval', 'approvers': [2]},
+        {'id': 'c', 'type': 'approval', 'approvers': [1, 2]},
+    ]
+    tid = client.post('/admin/templates', json={'steps': steps}, headers=headers).get_json()['id']
+    for amount in (50, 500):
+        form_id = client.post('/approvals', json={'template_id': tid, 'data': {'amount': amount}}, headers=headers).get_json()['id']
+        client.post(f'/approvals/{form_id}/submit', headers=headers)
+    resp = client.post(f'/admin/templates/{tid}/preview', headers=headers)
+    assert [(p['current'], p['next'], p['approvers']) for p in resp.get_json()] == [('a', 'b', [2]), ('a', 'c', [1, 2])]
+    steps[0]['conditions'][0]['expr'] = 'amount > 10'
+    resp = client.post(f'/admin/templates/{tid}/preview', json={'steps': steps}, headers=headers)
+    assert [p['next'] for p in resp.get_json()] == ['c', 'c']
+    steps[0]['conditions'][0]['expr'] = 'amount >'
+    assert client.post(f'/admin/templates/{tid}/preview', json={'steps': steps}, headers=headers).status_code == 400
+
+
 def test_user_cannot_create_template():
     client = app.test_client()
     t = token(client, 'user', 'user')
@@ -115,3 +276,43 @@ def test_user_cannot_create_template():
         headers={'Authorization': f'Bearer {t}'},
     )
     assert resp.status_code == 403
+
+
+def test_archived_forms_stay_reachable(tmp_path, monkeypatch):
+    import storage
+
+    monkeypatch.setattr(storage, 'ARCHIVE_DIR', str(tmp_path / 'archive'))
+    client = app.test_client()
+    headers = {'Authorization': f'Bearer {token(client)}'}
+    form = client.post('/approvals', json={'data': {'amount': 40}}, headers=headers).get_json()
+    client.post(f"/approvals/{form['id']}/submit", headers=headers)
+    client.post(f"/approvals/{form['id']}/approve", json={}, headers=headers)
+    draft = client.post('/approvals', json={'data': {'amount': 5}}, headers=headers).get_json()
+
+    resp = client.post('/admin/archive', json={'days': 0}, headers=headers)
+    assert resp.get_json() == {'archived': 1}
+    assert storage.get('approval_forms', form['id']) is None
+    assert storage.find_all('approval_records', form_id=form['id']) == []
+    assert [f['id'] for f in client.get('/approvals', headers=headers).get_json()['items']] == [draft['id']]
+
+    assert client.get(f"/approvals/{form['id']}", headers=headers).get_json()['status'] == 'approved'
+    assert client.get(f"/verify/{form['code']}", headers=headers).status_code == 200
+    stats = client.get('/statistics/dashboard', headers=headers).get_json()
+    assert stats['totalCount'] == 2 and stats['approved'] == 1 and stats['totalAmount'] == 45
+
+    # acting on an archived form brings it back into the hot store
+    client.post(f"/approvals/{form['id']}/reject", json={}, headers=headers)
+    assert storage.get('approval_forms', form['id'])['status'] == 'rejected'
+    assert len(storage.find_all('approval_records', form_id=form['id'])) == 2
+    assert storage.archived_form(form['id']) is None
+
+
+def test_admin_backup_streams_gzip():
+    import gzip
+    import json
+
+    client = app.test_client()
+    resp = client.get('/admin/backup', headers={'Authorization': f'Bearer {token(client)}'})
+    assert resp.status_code == 200
+    data = json.loads(gzip.decompress(resp.data))
+    assert [u['username'] for u in data['users']] == ['admin', 'user']
@@ -1,6 +1,7 @@
 import pytest
 from app import app, reset_data
 from controllers import approval
+import storage
 
 
 @pytest.fixture(autouse=True)
@@ -38,8 +39,8 @@ def test_create_submit_reject_flow():
     submitted = resp.get_json()
     assert submitted['status'] == 'submitted'
     assert submitted['submitted_at']
-    assert len(approval.submission_records) == 1
-    record = approval.submission_records[0]
+    assert len(storage.all_rows('submission_records')) == 1
+    record = storage.all_rows('submission_records')[0]
     assert record['form_id'] == form_id
     assert record['submitter_id'] == 1
     assert record['submitted_at']
@@ -52,8 +53,8 @@ def test_create_submit_reject_flow():
     assert resp.status_code == 200
     rejected = resp.get_json()
     assert rejected['status'] == 'rejected'
-    assert len(approval.approval_records) == 1
-    a_record = approval.approval_records[0]
+    assert len(storage.all_rows('approval_records')) == 1
+    a_record = storage.all_rows('approval_records')[0]
     assert a_record['form_id'] == form_id
     assert a_record['approver_id'] == 1
     assert a_record['result'] == 'rejected'
@@ -79,7 +80,7 @@ def test_create_submit_approve_flow():
         f'/approvals/{form_id}/submit', headers={'Authorization': f'Bearer {t}'}
     )
     assert resp.status_code == 200
-    record = approval.submission_records[0]
+    record = storage.all_rows('submission_records')[0]
     # approve
     resp = client.post(
         f'/approvals/{form_id}/approve',
@@ -89,8 +90,8 @@ def test_create_submit_approve_flow():
     assert resp.status_code == 200
     approved = resp.get_json()
     assert approved['status'] == 'approved'
-    assert len(approval.approval_records) == 1
-    a_record = approval.approval_records[0]
+    assert len(storage.all_rows('approval_records')) == 1
+    a_record = storage.all_rows('approval_records')[0]
     assert a_record['form_id'] == form_id
     assert a_record['approver_id'] == 1
     assert a_record['result'] == 'approved'
@@ -98,7 +99,7 @@ def test_create_submit_approve_flow():
     assert a_record['comments'] == 'ok'
     assert a_record['acted_at']
     # no verification triggered by default
-    assert approval.verification_records == []
+    assert storage.all_rows('verification_records') == []
 
 
 def test_list_forms_by_user_and_status():
@@ -140,7 +141,7 @@ def test_workflow_execution_flow():
     client = app.test_client()
     t = token(client)
     # setup template with two approval nodes
-    approval.workflow_templates.append({
+    storage.insert('templates', {
         'id': 1,
         'name': 'two-step',
         'workflow_config': {
@@ -196,7 +197,7 @@ def test_workflow_execution_flow():
 def test_workflow_rejection_flow():
     client = app.test_client()
     t = token(client)
-    approval.workflow_templates.append({
+    storage.insert('templates', {
         'id': 1,
         'name': 'two-step',
         'workflow_config': {
@@ -283,4 +284,340 @@ def test_actor_scope_and_resubmit():
     resp = client.post(
         f'/approvals/{form_id}/submit', headers={'Authorization': f'Bearer {t_admin}'}
     )
-    assert resp.status_code == 200
\ No newline at end of file
+    assert resp.status_code == 200
+
+def test_workflow_instances_are_rehydrated(monkeypatch):
+    client = app.test_client()
+    t = token(client)
+    headers = {'Authorization': f'Bearer {t}'}
+    storage.insert('templates', {
+        'id': 1,
+        'name': 'two-step',
+        'workflow_config': {
+            'nodes': [
+                {'id': 'n1', 'type': 'approval', 'approvers': [1], 'next': 'n2'},
+                {'id': 'n2', 'type': 'approval', 'approvers': [1]},
+            ]
+        },
+    })
+    monkeypatch.setattr(approval, 'workflow_instances', approval.InstanceCache(maxsize=1))
+    form_ids = []
+    for _ in range(2):
+        resp = client.post('/approvals', json={'data': {'a': 1}, 'template_id': 1}, headers=headers)
+        form_ids.append(resp.get_json()['id'])
+        client.post(f'/approvals/{form_ids[-1]}/submit', headers=headers)
+    # only the most recently used instance stays in memory
+    assert len(approval.workflow_instances) == 1
+    assert form_ids[0] not in approval.workflow_instances
+
+    resp = client.post(f'/approvals/{form_ids[0]}/approve', json={'comments': 'ok'}, headers=headers)
+    assert resp.get_json()['workflow']['current'] == 'n2'
+    # a restart loses the cache but not the state
+    approval.workflow_instances.clear()
+    resp = client.get(f'/approvals/{form_ids[0]}', headers=headers)
+    workflow = resp.get_json()['workflow']
+    assert workflow['current'] == 'n2'
+    assert workflow['history'][0]['comments'] == 'ok'
+    assert [n['status'] for n in workflow['flow']] == ['approved', 'in_progress']
+    resp = client.post(f'/approvals/{form_ids[0]}/approve', json={}, headers=headers)
+    assert resp.get_json()['status'] == 'approved'
+    # a step taken by another worker invalidates the cached instance
+    form = storage.get('approval_forms', form_ids[1])
+    version = form['workflow_state']['version'] + 1
+    storage.insert('approval_records', {
+        'id': storage.next_id('approval_records'), 'form_id': form_ids[1], 'approver_id': 1,
+        'result': 'rejected', 'node_id': 'n1', 'seq': version, 'acted_at': '2024-01-01T00:00:00',
+    })
+    storage.update('approval_forms', form, workflow_state=dict(form['workflow_state'], version=version, current=None))
+    resp = client.get(f'/approvals/{form_ids[1]}', headers=headers)
+    assert resp.get_json()['workflow']['status'] == 'rejected'
+
+
+def test_workflow_state_is_event_sourced(monkeypatch):
+    client = app.test_client()
+    headers = {'Authorization': f'Bearer {token(client)}'}
+    storage.insert('templates', {
+        'id': 1,
+        'name': 'four-step',
+        'workflow_config': {
+            'nodes': [
+                {'id': f'n{i}', 'type': 'approval', 'approvers': [1], 'next': f'n{i + 1}' if i < 4 else None}
+                for i in range(1, 5)
+            ]
+        },
+    })
+    monkeypatch.setattr(approval, 'WORKFLOW_SNAPSHOT_EVERY', 2)
+    form_id = client.post('/approvals', json={'template_id': 1}, headers=headers).get_json()['id']
+    client.post(f'/approvals/{form_id}/submit', headers=headers)
+    snapshots = []
+    for i in range(3):
+        client.post(f'/approvals/{form_id}/approve', json={'comments': str(i)}, headers=headers)
+        state = storage.get('approval_forms', form_id)['workflow_state']
+        snapshots.append(state['snapshot']['version'])
+        # a restart rebuilds the instance from the snapshot and later events
+        approval.workflow_instances.clear()
+        workflow = client.get(f'/approvals/{form_id}', headers=headers).get_json()['workflow']
+        assert workflow['current'] == state['current'] == f'n{i + 2}'
+        assert [h['comments'] for h in workflow['history']] == [str(j) for j in range(i + 1)]
+    assert snapshots == [1, 3, 3]
+    events = approval._events(form_id)
+    assert [(e['seq'], e['node_id'], e['result']) for e in events] == [
+        (2, 'n1', 'approved'), (3, 'n2', 'approved'), (4, 'n3', 'approved')]
+    # reaching the end writes a final snapshot
+    resp = client.post(f'/approvals/{form_id}/approve', json={}, headers=headers)
+    state = storage.get('approval_forms', form_id)['workflow_state']
+    assert resp.get_json()['status'] == 'approved'
+    assert state['snapshot']['version'] == state['version'] == 5
+    assert state['snapshot']['status'] == 'approved'
+
+
+def test_sla_timers_remind_and_escalate(monkeypatch):
+    import time
+    from notifications import reset, sent_notifications
+
+    client = app.test_client()
+    headers = {'Authorization': f'Bearer {token(client)}'}
+    storage.insert('templates', {
+        'id': 1,
+        'name': 'sla',
+        'workflow_config': {
+            'nodes': [
+                {'id': 'n1', 'type': 'approval', 'approvers': [1], 'delegates': [2], 'next': 'n2',
+                 'remind_after': 60, 'escalate_after': 120},
+                {'id': 'n2', 'type': 'approval', 'approvers': [1]},
+            ]
+        },
+    })
+    form_ids = []
+    for _ in range(2):
+        form_ids.append(client.post('/approvals', json={'template_id': 1}, headers=headers).get_json()['id'])
+        client.post(f'/approvals/{form_ids[-1]}/submit', headers=headers)
+    # the second form moves on before its timers are due
+    client.post(f'/approvals/{form_ids[1]}/approve', json={}, headers=headers)
+    assert len(approval.sla_timers) == 2
+
+    reset()
+    now = time.time()
+    assert approval.run_timers(now) == []
+    assert approval.run_timers(now + 61) == [(form_ids[0], 'remind')]
+    assert [n['recipient_id'] for n in sent_notifications] == [1]
+    # timers survive a restart, fired ones do not come back
+    monkeypatch.setattr(approval, 'sla_timers', approval.TimerQueue())
+    monkeypatch.setattr(approval, '_timers_loaded', False)
+    assert approval.run_timers(now + 61) == []
+    assert approval.run_timers(now + 121) == [(form_ids[0], 'escalate')]
+    assert sent_notifications[-1]['recipient_id'] == 2
+    assert not storage.get('approval_forms', form_ids[0])['workflow_state']['timers']
+
+    resp = client.post('/admin/timers/run', headers=headers)
+    assert resp.get_json() == {'fired': []}
+    bad = {'id': 'n1', 'type': 'approval', 'approvers': [1], 'remind_after': 'soon'}
+    assert client.post('/admin/templates', json={'steps': [bad]}, headers=headers).status_code == 400
+
+
+def test_forms_are_assigned_to_one_approver(monkeypatch):
+    from notifications import reset, sent_notifications
+
+    client = app.test_client()
+    admin = {'Authorization': f'Bearer {token(client)}'}
+    user = {'Authorization': f"Bearer {token(client, 'user', 'user')}"}
+    storage.insert('templates', {
+        'id': 1,
+        'name': 'assigned',
+        'workflow_config': {
+            'nodes': [
+                {'id': 'n1', 'type': 'approval', 'approvers': [1, 2], 'assign': 'round_robin', 'next': 'n2'},
+                {'id': 'n2', 'type': 'approval', 'approvers': [1, 2]},
+            ]
+        },
+    })
+    reset()
+    form_ids = []
+    for _ in range(2):
+        form_ids.append(client.post('/approvals', json={'template_id': 1}, headers=admin).get_json()['id'])
+        client.post(f'/approvals/{form_ids[-1]}/submit', headers=admin)
+    # only the assigned approver is told, and sees the form
+    assert [n['recipient_id'] for n in sent_notifications] == [1, 2]
+    assert [f['id'] for f in client.get('/approvals?scope=actor', headers=admin).get_json()['items']] == [form_ids[0]]
+    assert approval.approver_pool.pending(1) == approval.approver_pool.pending(2) == 1
+
+    assert client.post(f'/approvals/{form_ids[1]}/approve', json={}, headers=admin).status_code == 403
+    resp = client.post(f'/approvals/{form_ids[1]}/approve', json={}, headers=user)
+    assert resp.get_json()['workflow']['current'] == 'n2'
+    assert 'assignees' not in storage.get('approval_forms', form_ids[1])['workflow_state']
+    assert approval.approver_pool.pending(2) == 0
+
+    # the pool is rebuilt from the forms in progress after a restart
+    monkeypatch.setattr(approval, 'approver_pool', approval.ApproverPool())
+    monkeypatch.setattr(approval, '_pool_loaded', False)
+    client.post(f'/approvals/{form_ids[0]}/approve', json={}, headers=admin)
+    assert approval.approver_pool.pending(1) == 0
+
+    bad = {'id': 'n1', 'type': 'approval', 'approvers': [1], 'assign': 'random'}
+    assert client.post('/admin/templates', json={'steps': [bad]}, headers=admin).status_code == 400
+
+
+def test_actor_inbox_follows_the_active_node(monkeypatch):
+    client = app.test_client()
+    admin = {'Authorization': f'Bearer {token(client)}'}
+    user = {'Authorization': f"Bearer {token(client, 'user', 'user')}"}
+    storage.insert('templates', {
+        'id': 1,
+        'name': 'inbox',
+        'workflow_config': {
+            'nodes': [
+                {'id': 'n1', 'type': 'approval', 'approvers': [2], 'next': 'n2'},
+                {'id': 'n2', 'type': 'approval', 'approvers': [1, 2], 'require': 'all'},
+            ]
+        },
+    })
+
+    def inbox(headers, **params):
+        return client.get('/approvals', query_string=dict(scope='actor', **params), headers=headers).get_json()
+
+    form_ids = []
+    for _ in range(3):
+        form_ids.append(client.post('/approvals', json={'template_id': 1}, headers=admin).get_json()['id'])
+        client.post(f'/approvals/{form_ids[-1]}/submit', headers=admin)
+    # the admin approves at n2 only, not while the forms wait at n1
+    assert inbox(admin)['total'] == 0
+    page = inbox(user, page=2, size=2)
+    assert page['total'] == 3 and [f['id'] for f in page['items']] == [form_ids[2]]
+
+    client.post(f'/approvals/{form_ids[0]}/approve', json={}, headers=user)
+    assert [f['id'] for f in inbox(admin)['items']] == [form_ids[0]]
+    assert [f['id'] for f in inbox(user)['items']] == form_ids
+    # a countersign leaves the inbox of whoever signed
+    client.post(f'/approvals/{form_ids[0]}/approve', json={}, headers=user)
+    assert [f['id'] for f in inbox(user)['items']] == form_ids[1:]
+    assert inbox(user, status='approved')['total'] == 0
+    client.post(f'/approvals/{form_ids[1]}/reject', json={}, headers=user)
+    assert [f['id'] for f in inbox(user)['items']] == form_ids[2:]
+
+    # rebuilt from the forms in progress, those saved without users included
+    form = storage.get('approval_forms', form_ids[2])
+    storage.update('approval_forms', form, workflow_state={
+        k: v for k, v in form['workflow_state'].items() if k != 'inbox'})
+    monkeypatch.setattr(approval, 'inbox', approval.Inbox())
+    monkeypatch.setattr(approval, '_inbox_loaded', False)
+    assert [f['id'] for f in inbox(user)['items']] == form_ids[2:]
+    assert [f['id'] for f in inbox(admin)['items']] == [form_ids[0]]
+
+
+@pytest.fixture
+def shared_store(shared_store):
+    reset_data()
+    approval.reset_data()
+    return shared_store
+
+
+def _in_other_worker(target):
+    import multiprocessing
+
+    worker = multiprocessing.get_context('fork').Process(target=target)
+    worker.start()
+    worker.join()
+    assert worker.exitcode == 0
+
+
+def test_actor_inbox_sees_forms_of_other_workers(shared_store):
+    client = app.test_client()
+    admin = {'Authorization': f'Bearer {token(client)}'}
+    user = {'Authorization': f"Bearer {token(client, 'user', 'user')}"}
+    storage.insert('templates', {
+        'id': 1,
+        'workflow_config': {'nodes': [{'id': 'n1', 'type': 'approval', 'approvers': [2]}]},
+    })
+    storage.save()
+
+    def inbox():
+        return client.get('/approvals', query_string={'scope': 'actor'}, headers=user).get_json()
+
+    assert inbox()['total'] == 0
+
+    def submit():
+        form_id = client.post('/approvals', json={'template_id': 1}, headers=admin).get_json()['id']
+        assert client.post(f'/approvals/{form_id}/submit', headers=admin).status_code == 200
+
+    _in_other_worker(submit)
+    _in_other_worker(submit)
+    page = inbox()
+    assert page['total'] == 2 and len(page['items']) == 2
+    form_id = page['items'][0]['id']
+
+    def approve():
+        assert client.post(f'/approvals/{form_id}/approve', json={}, headers=user).status_code == 200
+
+    _in_other_worker(approve)
+    page = inbox()
+    assert page['total'] == 1 and form_id not in [f['id'] for f in page['items']]
+
+
+def test_sla_timers_of_other_workers_fire(shared_store):
+    import time
+    from notifications import reset, sent_notifications
+
+    client = app.test_client()
+    admin = {'Authorization': f'Bearer {token(client)}'}
+    storage.insert('templates', {
+        'id': 1,
+        'workflow_config': {'nodes': [
+            {'id': 'n1', 'type': 'approval', 'approvers': [2], 'remind_after': 60},
+        ]},
+    })
+    storage.save()
+    assert approval.run_timers() == []
+
+    def submit():
+        form_id = client.post('/approvals', json={'template_id': 1}, headers=admin).get_json()['id']
+        assert client.post(f'/approvals/{form_id}/submit', headers=admin).status_code == 200
+
+    _in_other_worker(submit)
+    _in_other_worker(submit)
+    storage.sync()
+    form_ids = [f['id'] for f in storage.find_all('approval_forms', status='in_progress')]
+    assert len(form_ids) == 2
+
+    def approve():
+        user = {'Authorization': f"Bearer {token(client, 'user', 'user')}"}
+        assert client.post(f'/approvals/{form_ids[0]}/approve', json={}, headers=user).status_code == 200
+
+    # the first form moves on in the other worker after this one synced it
+    _in_other_worker(approve)
+    reset()
+    assert approval.run_timers(time.time() + 61) == [(form_ids[1], 'remind')]
+    assert [n['recipient_id'] for n in sent_notifications] == [2]
+
+
+def test_approver_pool_counts_assignments_of_other_workers(shared_store):
+    client = app.test_client()
+    admin = {'Authorization': f'Bearer {token(client)}'}
+    storage.insert('templates', {
+        'id': 1,
+        'workflow_config': {'nodes': [
+            {'id': 'n1', 'type': 'approval', 'approvers': [1, 2], 'assign': 'round_robin'},
+        ]},
+    })
+    storage.save()
+    pool = approval._pool()
+
+    def submit():
+        form_id = client.post('/approvals', json={'template_id': 1}, headers=admin).get_json()['id']
+        assert client.post(f'/approvals/{form_id}/submit', headers=admin).status_code == 200
+
+    _in_other_worker(submit)
+    storage.sync()
+    (first,) = storage.find_all('approval_forms', status='in_progress')
+    assert first['workflow_state']['assignees'] == {'n1': 1}
+    assert (pool.pending(1), pool.pending(2)) == (1, 0)
+    # the rotation continues where the other worker left it
+    submit()
+    assert (pool.pending(1), pool.pending(2)) == (1, 1)
+
+    def approve():
+        assert client.post(f"/approvals/{first['id']}/approve", json={}, headers=admin).status_code == 200
+
+    _in_other_worker(approve)
+    storage.sync()
+    assert (pool.pending(1), pool.pending(2)) == (0, 1)
+
@@ -0,0 +1,683 @@
+import io
+import json
+import os
+import threading
+
+import pytest
+
+import storage
+from storage import journal
+
+
+@pytest.fixture
+def journal_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, 'DATA_FILE', str(tmp_path / 'data.json'))
+    monkeypatch.setattr(storage, 'JOURNAL_FILE', str(tmp_path / 'data.json.log'))
+    monkeypatch.setattr(storage, 'MODE', 'journal')
+    storage.reset_all()
+    yield tmp_path
+
+
+def test_journal_appends_one_line_per_mutation(journal_store):
+    form = storage.insert('approval_forms', {'id': 1, 'status': 'draft'})
+    storage.put('next_id', 2)
+    storage.save()
+    storage.update('approval_forms', form, status='approved')
+    storage.save()
+    with open(storage.JOURNAL_FILE, encoding='utf-8') as f:
+        lines = f.readlines()
+    assert len(lines) == 3
+    # the snapshot is untouched by ordinary saves
+    assert storage._read_snapshot()['approval_forms'] == []
+
+
+def test_journal_replay_restores_state(journal_store):
+    storage.insert('users', {'id': 3, 'username': 'u3'})
+    form = storage.insert('approval_forms', {'id': 1, 'status': 'draft'})
+    storage.update('approval_forms', form, status='approved')
+    storage.delete('users', 2)
+    storage.save()
+    loaded = storage._load()
+    assert loaded == storage.data()
+    assert [u['id'] for u in loaded['users']] == [1, 3]
+    assert loaded['approval_forms'] == [{'id': 1, 'status': 'approved'}]
+
+
+def test_replay_ignores_torn_trailing_entry(journal_store):
+    storage.insert('approval_forms', {'id': 1})
+    storage.save()
+    with open(storage.JOURNAL_FILE, 'a', encoding='utf-8') as f:
+        f.write('{"o":"put","c":"approval_forms","r":{"id":')
+    loaded = storage._load()
+    assert loaded['approval_forms'] == [{'id': 1}]
+
+
+def test_appends_after_a_torn_entry_survive_restarts(journal_store):
+    storage.insert('approval_forms', {'id': 1})
+    storage.save()
+    with open(storage.JOURNAL_FILE, 'a', encoding='utf-8') as f:
+        f.write('{"o":"put","c":"approval_forms","r":{"id":')
+    storage.insert('approval_forms', {'id': 2})
+    storage.save()
+    assert [r['id'] for r in storage._load()['approval_forms']] == [1, 2]
+    # a torn tail is cut off on load, before anything is appended to it
+    with open(storage.JOURNAL_FILE, 'a', encoding='utf-8') as f:
+        f.write('{"o":"put","c":"approval_forms","r":{"id":')
+    assert [r['id'] for r in storage._load()['approval_forms']] == [1, 2]
+    storage.insert('approval_forms', {'id': 3})
+    storage.save()
+    assert [r['id'] for r in storage._load()['approval_forms']] == [1, 2, 3]
+    entries, _ = journal.read_from(storage.JOURNAL_FILE, 0)
+    assert [e['r']['id'] for e in entries] == [1, 2, 3]
+
+
+def test_compact_folds_journal_into_snapshot(journal_store):
+    storage.insert('approval_forms', {'id': 1})
+    storage.save()
+    storage.compact()
+    assert not os.path.exists(storage.JOURNAL_FILE)
+    assert storage._read_snapshot()['approval_forms'] == [{'id': 1}]
+    assert storage._load() == storage.data()
+
+
+def test_replay_over_newer_snapshot_is_idempotent():
+    data = {'approval_forms': [{'id': 1, 'status': 'approved'}]}
+    entries = [
+        {'o': 'put', 'c': 'approval_forms', 'r': {'id': 1, 'status': 'draft'}},
+        {'o': 'put', 'c': 'approval_forms', 'r': {'id': 2}},
+        {'o': 'put', 'c': 'approval_forms', 'r': {'id': 1, 'status': 'approved'}},
+        {'o': 'del', 'c': 'approval_forms', 'i': 2},
+    ]
+    positions = {}
+    for e in entries:
+        journal.apply(data, e, positions)
+    assert data == {'approval_forms': [{'id': 1, 'status': 'approved'}]}
+
+
+@pytest.fixture
+def sql_store(monkeypatch):
+    sql = pytest.importorskip('storage.sql')
+    store = sql.SQLStore('sqlite://')
+    monkeypatch.setattr(storage, '_sql', store)
+    storage.reset_all()
+    yield store
+    store.remove()
+
+
+def test_sql_store_queries(sql_store):
+    storage.insert('approval_forms', {'id': 1, 'code': 'APP000001', 'status': 'draft', 'applicant_id': 2})
+    storage.insert('approval_forms', {'id': 2, 'code': 'APP000002', 'status': 'approved', 'applicant_id': 1})
+    storage.save()
+    assert storage.get('approval_forms', 2)['code'] == 'APP000002'
+    assert storage.find('approval_forms', code='APP000001')['id'] == 1
+    assert [f['id'] for f in storage.find_all('approval_forms', status=('draft', 'approved'))] == [1, 2]
+    form = storage.get('approval_forms', 1)
+    storage.update('approval_forms', form, status='approved')
+    storage.save()
+    assert [f['id'] for f in storage.find_all('approval_forms', status='approved')] == [1, 2]
+    storage.delete('approval_forms', 2)
+    storage.save()
+    assert storage.count('approval_forms') == 1
+    assert storage.value('next_id') == 1
+    assert storage.find('users', username='admin')['id'] == 1
+
+
+def test_sql_migrate_streams_data_file(tmp_path):
+    sql = pytest.importorskip('storage.sql')
+    path = tmp_path / 'data.json'
+    rows = [{'id': i, 'code': f'APP{i:06d}', 'status': 'draft', 'data': {'amount': i}} for i in range(1, 51)]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'approval_forms': rows, 'users': [], 'next_id': 51, 'authorized_verifiers': [1, 2]}, f, indent=1)
+    store = sql.SQLStore('sqlite://')
+    counts = sql.migrate(str(path), store, storage.COLLECTIONS, batch_size=7)
+    assert counts == {'approval_forms': 50, 'users': 0}
+    assert store.count('approval_forms') == 50
+    assert store.get('approval_forms', 42)['data'] == {'amount': 42}
+    assert store.get_value('next_id') == 51
+    assert store.get_value('authorized_verifiers') == [1, 2]
+
+
+def test_iter_document_handles_small_chunks():
+    sql = pytest.importorskip('storage.sql')
+    text = json.dumps({'users': [{'id': 1, 'name': 'x' * 40}, {'id': 2}], 'next_id': 12345, 'empty': []})
+    items = list(sql.iter_document(io.StringIO(text), ('users',), chunk_size=3))
+    assert items == [
+        ('users', None),
+        ('users', {'id': 1, 'name': 'x' * 40}),
+        ('users', {'id': 2}),
+        ('next_id', 12345),
+        ('empty', []),
+    ]
+
+
+def test_sql_counters_restart_when_put(sql_store):
+    assert [storage.allocate('next_code') for _ in range(3)] == [1, 2, 3]
+    storage.put('next_code', 1)
+    storage.save()
+    assert storage.allocate('next_code') == 1
+    storage.put('next_code', None)
+    assert storage.allocate('next_code', start=7) == 7
+
+
+def test_sql_mode_starts_the_app(tmp_path):
+    # the real import path, which the sql_store fixture bypasses
+    pytest.importorskip('sqlalchemy')
+    import subprocess
+    import sys
+
+    script = """
+import app
+client = app.app.test_client()
+token = client.post('/login', json={'username': 'admin', 'password': 'admin'}).get_json()['token']
+headers = {'Authorization': 'Bearer ' + token}
+form = client.post('/approvals', json={'data': {'amount': 5}}, headers=headers).get_json()
+print(client.get('/approvals/%d' % form['id'], headers=headers).get_json()['data']['amount'])
+"""
+    root = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, STORAGE_MODE='sql', STORAGE_URL='sqlite://', PYTHONPATH=root)
+    result = subprocess.run([sys.executable, '-c', script], cwd=str(tmp_path), env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == '5'
+
+
+def test_approval_flow_on_sql_backend(sql_store):
+    from app import app
+
+    client = app.test_client()
+    resp = client.post('/login', json={'username': 'admin', 'password': 'admin'})
+    headers = {'Authorization': f"Bearer {resp.get_json()['token']}"}
+    resp = client.post('/approvals', json={'data': {'amount': 5}}, headers=headers)
+    form = resp.get_json()
+    client.post(f"/approvals/{form['id']}/submit", headers=headers)
+    resp = client.post(f"/approvals/{form['id']}/approve", json={}, headers=headers)
+    assert resp.get_json()['status'] == 'approved'
+    record = storage.find('approval_records', form_id=form['id'])
+    assert record['submission_id'] == storage.find('submission_records', form_id=form['id'])['id']
+    resp = client.get(f"/verification/{form['code']}", headers=headers)
+    assert resp.get_json()['id'] == form['id']
+    resp = client.get('/statistics/approvals?status=approved', headers=headers)
+    assert resp.get_json()['total_amount'] == 5
+
+
+@pytest.fixture
+def segment_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, 'SEGMENT_DIR', str(tmp_path / 'segments'))
+    monkeypatch.setattr(storage, 'MODE', 'segments')
+    storage.reset_all()
+    yield tmp_path / 'segments'
+
+
+def test_segments_only_write_touched_collections(segment_store):
+    users_mtime = os.stat(segment_store / 'users.json').st_mtime_ns
+    form = storage.insert('approval_forms', {'id': 1, 'status': 'in_progress'})
+    storage.save()
+    storage.insert('approval_records', {'id': 1, 'form_id': 1})
+    storage.update('approval_forms', form, status='approved')
+    storage.update('approval_forms', form, comments='ok')
+    storage.save()
+    files = sorted(p.name for p in segment_store.iterdir())
+    assert 'approval_forms.delta' in files
+    assert 'approval_records.delta' in files
+    assert 'users.delta' not in files
+    assert os.stat(segment_store / 'users.json').st_mtime_ns == users_mtime
+    # repeated updates of one row are coalesced into one entry per save
+    with open(segment_store / 'approval_forms.delta', encoding='utf-8') as f:
+        assert len(f.readlines()) == 2
+    assert storage.segments.load(str(segment_store)) == storage.data()
+
+
+def test_segments_track_deletes_and_meta(segment_store):
+    storage.delete('users', 2)
+    storage.put('next_id', 7)
+    storage.save()
+    loaded = storage.segments.load(str(segment_store))
+    assert [u['id'] for u in loaded['users']] == [1]
+    assert loaded['next_id'] == 7
+
+
+def test_segment_delta_is_folded_into_base(segment_store, monkeypatch):
+    for i in range(1, 400):
+        storage.insert('approval_records', {'id': i, 'form_id': i, 'comments': 'x' * 200})
+        storage.save()
+    assert os.path.getsize(segment_store / 'approval_records.json') > 2
+    assert storage.segments.load(str(segment_store)) == storage.data()
+
+
+@pytest.fixture
+def write_behind(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, 'DATA_FILE', str(tmp_path / 'data.json'))
+    monkeypatch.setattr(storage, 'MODE', 'json')
+    monkeypatch.setattr(storage, 'FLUSH_WINDOW', 0.02)
+    storage.reset_all()
+    yield tmp_path
+    storage.flush()
+
+
+def test_write_behind_coalesces_saves(write_behind, monkeypatch):
+    calls = []
+    persist = storage._persist
+
+    def counting_persist():
+        calls.append(1)
+        persist()
+
+    monkeypatch.setattr(storage, '_persist', counting_persist)
+
+    def worker(offset):
+        for i in range(20):
+            storage.insert('approval_records', {'id': offset + i})
+            storage.save()
+
+    threads = [threading.Thread(target=worker, args=(n * 100,)) for n in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    storage.save(wait=True)
+    assert len(calls) < 100
+    assert len(storage._read_snapshot()['approval_records']) == 100
+
+
+def test_flush_persists_synchronously(write_behind):
+    storage.insert('approval_forms', {'id': 1})
+    storage.save()
+    storage.flush()
+    assert storage._read_snapshot()['approval_forms'] == [{'id': 1}]
+    storage.wait_durable()
+
+
+def test_failed_flush_is_reported_and_retried(write_behind, monkeypatch):
+    write = storage._write_snapshot
+    failures = []
+
+    def failing_write(payload):
+        if not failures:
+            failures.append(1)
+            raise OSError('disk full')
+        write(payload)
+
+    monkeypatch.setattr(storage, '_write_snapshot', failing_write)
+    storage.insert('approval_forms', {'id': 1})
+    with pytest.raises(OSError):
+        storage.save(wait=True)
+    # the flusher keeps running and writes the changes it put back
+    storage.insert('approval_forms', {'id': 2})
+    storage.save(wait=True)
+    assert storage._read_snapshot()['approval_forms'] == [{'id': 1}, {'id': 2}]
+    storage.wait_durable()
+
+
+def test_allocate_is_atomic_across_threads():
+    storage.put('test_counter', None)
+    seen = []
+
+    def worker():
+        seen.extend(storage.allocate('test_counter') for _ in range(500))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(seen) == list(range(1, 4001))
+
+
+def test_next_id_continues_after_deletes_and_restarts_on_replace():
+    storage.put('approval_records', [{'id': 1}, {'id': 2}, {'id': 3}])
+    assert storage.next_id('approval_records') == 4
+    storage.delete('approval_records', 3)
+    assert storage.next_id('approval_records') == 5
+    storage.put('approval_records', [])
+    assert storage.next_id('approval_records') == 1
+
+
+def test_concurrent_inserts_persist_consistently(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, 'DATA_FILE', str(tmp_path / 'data.json'))
+    storage.put('approval_records', [])
+
+    def worker():
+        for _ in range(50):
+            storage.insert('approval_records', {'id': storage.next_id('approval_records')})
+            storage.save()
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    ids = [r['id'] for r in storage._read_snapshot()['approval_records']]
+    assert sorted(ids) == list(range(1, 201))
+
+
+def _shared_worker():
+    for _ in range(30):
+        storage.insert('approval_records', {'id': storage.next_id('approval_records')})
+        storage.save()
+        with storage.row_lock('approval_forms', 1):
+            form = storage.get('approval_forms', 1)
+            storage.update('approval_forms', form, approvals=form['approvals'] + 1)
+            storage.save()
+
+
+def test_worker_processes_share_the_journal(shared_store):
+    import multiprocessing
+
+    storage.insert('approval_forms', {'id': 1, 'approvals': 0})
+    storage.save()
+
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=_shared_worker) for _ in range(3)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    assert [w.exitcode for w in workers] == [0, 0, 0]
+    storage.sync()
+    ids = [r['id'] for r in storage.all_rows('approval_records')]
+    assert len(ids) == len(set(ids)) == 90
+    # row locks serialized the read-modify-write across processes
+    assert storage.get('approval_forms', 1)['approvals'] == 90
+    # a compaction by one worker is picked up by the others
+    storage.compact()
+    storage._journal_id = None
+    storage.sync()
+    assert storage.count('approval_records') == 90
+
+
+def test_shared_journal_offset_skips_a_torn_entry(shared_store):
+    storage.insert('approval_forms', {'id': 1})
+    storage.save()
+    with open(storage.JOURNAL_FILE, 'a', encoding='utf-8') as f:
+        f.write('{"o":"put","c":"approval_forms","r":{"id":')
+    storage.insert('approval_forms', {'id': 2})
+    storage.save()
+    assert storage._journal_pos == os.path.getsize(storage.JOURNAL_FILE)
+    storage._journal_id = None
+    storage.sync()
+    assert [r['id'] for r in storage.all_rows('approval_forms')] == [1, 2]
+
+
+def test_indexes_follow_mutations():
+    storage.put('approval_forms', [])
+    storage.put('approval_records', [])
+    form = storage.insert('approval_forms', {'id': 1, 'code': 'APP000001', 'applicant_id': 2})
+    storage.insert('approval_forms', {'id': 2, 'code': 'APP000002', 'applicant_id': 2})
+    for i in range(1, 4):
+        storage.insert('approval_records', {'id': i, 'form_id': 1 if i < 3 else 2})
+    assert storage.get('approval_forms', 2)['code'] == 'APP000002'
+    assert [r['id'] for r in storage.find_all('approval_records', form_id=1)] == [1, 2]
+    assert [f['id'] for f in storage.find_all('approval_forms', applicant_id=2)] == [1, 2]
+    storage.update('approval_forms', form, code='APP000009', applicant_id=3)
+    assert storage.find('approval_forms', code='APP000001') is None
+    assert storage.find('approval_forms', code='APP000009') is form
+    assert [f['id'] for f in storage.find_all('approval_forms', applicant_id=2)] == [2]
+    storage.delete('approval_records', 1)
+    assert [r['id'] for r in storage.find_all('approval_records', form_id=1)] == [2]
+    assert storage.get('approval_records', 1) is None
+    # rows appended behind the API are picked up by a rebuild
+    storage.all_rows('approval_records').append({'id': 7, 'form_id': 1})
+    assert [r['id'] for r in storage.find_all('approval_records', form_id=1)] == [2, 7]
+    assert storage.get('approval_records', 7)['form_id'] == 1
+    storage.put('approval_records', [{'id': 8, 'form_id': 5}])
+    assert storage.find_all('approval_records', form_id=1) == []
+    assert storage.get('approval_records', 8)['form_id'] == 5
+
+
+@pytest.fixture
+def binary_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, 'DATA_FILE', str(tmp_path / 'data.json'))
+    monkeypatch.setattr(storage, 'SNAPSHOT_FILE', str(tmp_path / 'data.snap'))
+    monkeypatch.setattr(storage, 'SNAPSHOT_FORMAT', 'binary')
+    storage.reset_all()
+    yield tmp_path
+
+
+def test_binary_snapshot_decodes_rows_on_demand(binary_store, monkeypatch):
+    for i in range(1, 6):
+        storage.insert('approval_forms', {'id': i, 'code': f'APP{i:06d}', 'items': ['x'] * i})
+    storage.put('next_id', 6)
+    storage.save()
+    assert not os.path.exists(storage.DATA_FILE)
+
+    loaded = storage._read_snapshot()
+    monkeypatch.setattr(storage, '_data', loaded)
+    assert storage.count('approval_forms') == 5
+    assert storage.value('next_id') == 6
+    form = storage.get('approval_forms', 3)
+    assert form['items'] == ['x'] * 3
+    assert storage.get('approval_forms', 9) is None
+    # nothing but the rows asked for has been decoded
+    assert loaded.lazy('approval_forms') is not None
+    assert len(loaded.lazy('approval_forms')._decoded) == 1
+    # untouched collections are copied as is into the next snapshot
+    storage.update('approval_forms', form, status='approved')
+    assert storage.all_rows('approval_forms')[2] is form
+    storage.save()
+    assert loaded.lazy('users') is not None
+    again = storage._read_snapshot()
+    assert [u['username'] for u in again['users']] == ['admin', 'user']
+    assert again['approval_forms'][2]['status'] == 'approved'
+    assert again['authorized_verifiers'] == [1]
+
+
+def test_binary_snapshot_inserts_and_updates_without_decoding(binary_store, monkeypatch):
+    for i in range(1, 6):
+        storage.insert('approval_forms', {'id': i, 'status': 'draft'})
+    storage.save()
+    loaded = storage._read_snapshot()
+    monkeypatch.setattr(storage, '_data', loaded)
+
+    storage.insert('approval_forms', {'id': 6, 'status': 'draft'})
+    storage.update('approval_forms', storage.get('approval_forms', 3), status='approved')
+    assert len(loaded.lazy('approval_forms')._decoded) == 1
+    assert storage.count('approval_forms') == 6
+    assert storage.get('approval_forms', 6)['status'] == 'draft'
+    assert [f['id'] for f in storage.find_all('approval_forms', id=6)] == [6]
+    storage.save()
+    again = storage._read_snapshot()
+    assert [(f['id'], f['status']) for f in again['approval_forms']] == [
+        (1, 'draft'), (2, 'draft'), (3, 'approved'), (4, 'draft'), (5, 'draft'), (6, 'draft')]
+
+
+def test_app_starts_without_decoding_collections(tmp_path):
+    import subprocess
+    import sys
+
+    setup = """
+import app
+client = app.app.test_client()
+token = client.post('/login', json={'username': 'admin', 'password': 'admin'}).get_json()['token']
+client.post('/approvals', json={'data': {'amount': 5}}, headers={'Authorization': 'Bearer ' + token})
+"""
+    check = """
+import app, storage
+print(sorted(k for k in storage.COLLECTIONS if k in storage.data() and storage._lazy(k) is None))
+"""
+    root = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, STORAGE_SNAPSHOT='binary', PYTHONPATH=root)
+    for script in (setup, check):
+        result = subprocess.run([sys.executable, '-c', script], cwd=str(tmp_path), env=env,
+                                capture_output=True, text=True, timeout=60)
+        assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == '[]'
+
+
+def test_binary_snapshot_without_integer_ids(tmp_path):
+    from storage import snapshot
+
+    path = tmp_path / 'data.snap'
+    rows = [{'id': 'b'}, {'id': 'a'}]
+    path.write_bytes(snapshot.dumps([('things', snapshot.section(rows)), ('empty', snapshot.section([]))]))
+    data = snapshot.load(str(path))
+    assert not data.lazy('things').indexed
+    assert data['things'] == rows
+    assert data['empty'] == []
+
+
+def test_codecs_round_trip():
+    from storage import codecs
+
+    data = {
+        'approval_forms': [
+            {'id': 1, 'status': 'approved', 'data': {'amount': 12.5, 'note': '出差'}},
+            {'id': 2, 'status': 'approved', 'data': {'amount': -3, 'items': [True, False, None]}},
+            {'id': 3, 'status': 'draft', 'extra': 'x' * 100, 'big': 2 ** 70},
+        ],
+        'users': [],
+        'mixed': [{'id': 1}, 'not a row'],
+        'next_id': 4,
+        'authorized_verifiers': [1, 2],
+    }
+    sizes = {}
+    for name in ('json', 'compact', 'binary', 'json+zlib', 'compact+zlib', 'binary+zlib'):
+        payload = codecs.get(name).dumps(iter(data.items()))
+        assert codecs.loads(payload) == data
+        sizes[name] = len(payload)
+    assert sizes['binary'] < sizes['json']
+    with pytest.raises(ValueError):
+        codecs.get('binary+lzma')
+
+
+def test_codec_migrates_existing_data_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, 'DATA_FILE', str(tmp_path / 'data.json'))
+    monkeypatch.setattr(storage, 'CODEC_FILE', str(tmp_path / 'data.pack'))
+    monkeypatch.setattr(storage, 'SNAPSHOT_FILE', str(tmp_path / 'data.snap'))
+    forms = [{'id': i, 'code': f'APP{i:06d}', 'status': 'approved'} for i in range(1, 200)]
+    storage.put('approval_forms', forms)
+    storage.save()
+    json_size = os.path.getsize(storage.DATA_FILE)
+
+    monkeypatch.setattr(storage, 'CODEC', 'compact+zlib')
+    assert storage._read_snapshot()['approval_forms'] == forms
+    storage.save()
+    assert os.path.getsize(storage.CODEC_FILE) < json_size / 5
+    # the old snapshot must not shadow newer data after switching back
+    assert not os.path.exists(storage.DATA_FILE)
+    assert os.path.exists(storage.DATA_FILE + '.bak')
+
+    monkeypatch.setattr(storage, 'CODEC', 'json')
+    assert storage._read_snapshot()['approval_forms'] == forms
+    storage.save()
+    with open(storage.DATA_FILE, encoding='utf-8') as f:
+        assert json.load(f)['approval_forms'] == forms
+
+
+def test_archive_keeps_only_the_latest_bundle(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, 'ARCHIVE_DIR', str(tmp_path / 'archive'))
+    storage.put('approval_forms', [
+        {'id': 1, 'code': 'A1', 'status': 'approved', 'created_at': '2020-01-01T00:00:00'},
+        {'id': 2, 'code': 'A2', 'status': 'approved', 'created_at': '2020-01-01T00:00:00'},
+        {'id': 3, 'code': 'A3', 'status': 'in_progress', 'created_at': '2020-01-01T00:00:00'},
+    ])
+    storage.put('approval_records', [{'id': 1, 'form_id': 2, 'acted_at': '2021-06-01T00:00:00'}])
+    storage.put('submission_records', [])
+    storage.put('verification_records', [])
+    assert storage.archive_forms('2021-01-01T00:00:00') == 1
+    assert [f['id'] for f in storage.all_rows('approval_forms')] == [2, 3]
+    assert storage.archive_forms('2022-01-01T00:00:00') == 1
+    assert storage.archived_form(code='A2')['id'] == 2
+    assert [r['id'] for r in storage.iter_rows('approval_records')] == [1]
+
+    storage.restore_form(1)
+    storage.update('approval_forms', storage.get('approval_forms', 1), comments='again')
+    assert storage.archive_forms('2022-01-01T00:00:00') == 1
+    # the first bundle of form 1 was superseded
+    assert [f['id'] for f in storage.iter_rows('approval_forms', status='approved')] == [2, 1]
+    assert storage.archived_form(1)['comments'] == 'again'
+    assert len(storage._archive()) == 2
+
+
+def test_snapshot_view_is_point_in_time(tmp_path):
+    import gzip
+
+    from storage import backup
+
+    storage.put('approval_forms', [{'id': 1, 'status': 'draft'}, {'id': 2, 'status': 'draft'}])
+    storage.put('next_id', 3)
+    with storage.snapshot_view() as view:
+        storage.update('approval_forms', storage.get('approval_forms', 1), status='approved')
+        storage.insert('approval_forms', {'id': 3, 'status': 'draft'})
+        storage.delete('approval_forms', 2)
+        storage.put('next_id', 4)
+        assert list(view.iter_rows('approval_forms')) == [{'id': 1, 'status': 'draft'}, {'id': 2, 'status': 'draft'}]
+        assert view.value('next_id') == 3
+        path = str(tmp_path / 'backup.json.gz')
+        backup.write_backup(path, view)
+    assert not storage._views
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        restored = json.load(f)
+    assert restored['approval_forms'] == [{'id': 1, 'status': 'draft'}, {'id': 2, 'status': 'draft'}]
+    assert restored['next_id'] == 3
+    assert restored['users'] == storage.all_rows('users')
+
+
+def test_sql_snapshot_view(sql_store):
+    storage.insert('approval_forms', {'id': 1, 'status': 'draft'})
+    storage.save()
+    with storage.snapshot_view() as view:
+        assert [r['id'] for r in view.iter_rows('approval_forms', status='draft')] == [1]
+        assert view.value('next_code') == 1
+        assert 'next_code' in view.keys()
+
+
+@pytest.fixture
+def change_feed(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, 'FEED_DIR', str(tmp_path / 'changes'))
+    monkeypatch.setattr(storage, 'CHANGE_FEED', True)
+    storage.save()
+    yield tmp_path / 'changes'
+
+
+def test_change_feed_orders_persisted_mutations(change_feed):
+    storage.put('approval_records', [])
+    form = storage.insert('approval_records', {'id': 1, 'result': 'approved'})
+    storage.update('approval_records', form, result='rejected')
+    assert storage.subscribe('stats').poll() == []
+    storage.save()
+    storage.delete('approval_records', 1)
+    storage.save()
+
+    sub = storage.subscribe('stats')
+    events = sub.poll()
+    assert [(e['seq'], e['op'], e['id']) for e in events] == [
+        (1, 'reset', None), (2, 'insert', 1), (3, 'update', 1), (4, 'delete', 1),
+    ]
+    assert events[2]['before'] == {'id': 1, 'result': 'approved'}
+    assert events[2]['after'] == {'id': 1, 'result': 'rejected'}
+    sub.commit(3)
+    # the cursor survives a new subscription (e.g. after a restart)
+    assert [e['seq'] for e in storage.subscribe('stats').poll()] == [4]
+
+
+def test_change_feed_trims_consumed_segments(tmp_path):
+    from storage import feed
+
+    changes = feed.ChangeFeed(str(tmp_path), segment_bytes=1)
+    for i in range(3):
+        changes.append([{'op': 'insert', 'collection': 'c', 'id': i}])
+    assert changes.last_seq() == 3
+    assert changes.trim() == 0
+    sub = feed.Subscription(changes, 'a')
+    sub.commit(2)
+    assert changes.trim() == 2
+    assert [e['seq'] for e in changes.read(0)] == [3]
+    assert [e['id'] for e in sub.poll()] == [2]
+
+
+def test_change_feed_continues_after_a_large_event(tmp_path):
+    from storage import feed
+
+    changes = feed.ChangeFeed(str(tmp_path))
+    changes.append([{'op': 'insert', 'collection': 'c', 'id': 1}])
+    changes.append([{'op': 'insert', 'collection': 'c', 'id': 2, 'after': {'text': 'x' * 70000}}])
+    assert changes.last_seq() == 2
+    assert changes.append([{'op': 'delete', 'collection': 'c', 'id': 2}]) == 3
+    assert [e['seq'] for e in changes.read(0)] == [1, 2, 3]
+
+
+def test_change_feed_publishes_on_sql_commit(sql_store, change_feed):
+    storage.insert('approval_forms', {'id': 1, 'status': 'draft'})
+    assert storage.subscribe('replica').poll() == []
+    storage.save()
+    assert [(e['op'], e['id']) for e in storage.subscribe('replica').poll()] == [('insert', 1)]
@@ -3,6 +3,7 @@ import pytest
 
 from app import app, reset_data
 from controllers import approval, verification
+import storage
 
 
 @pytest.fixture(autouse=True)
@@ -43,7 +44,7 @@ def test_qr_code_and_verification_flow():
     assert record['status'] == 'verified'
     assert record['verifier_id'] == 1
     assert record['verified_at']
-    assert approval.verification_records[0]['status'] == 'verified'
+    assert storage.all_rows('verification_records')[0]['status'] == 'verified'
 
 
 def test_verification_requires_authorized_user():
@@ -58,3 +59,24 @@ def test_verification_requires_authorized_user():
     resp = client.post(f'/verification/{code}', json={}, headers={'Authorization': f'Bearer {t_user}'})
     assert resp.status_code == 200
     assert resp.get_json()['verifier_id'] == 2
+
+
+def test_denied_requests_leave_archived_forms_archived(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, 'ARCHIVE_DIR', str(tmp_path / 'archive'))
+    client = app.test_client()
+    admin = {'Authorization': f"Bearer {client.post('/login', json={'username': 'admin', 'password': 'admin'}).get_json()['token']}"}
+    user = {'Authorization': f"Bearer {client.post('/login', json={'username': 'user', 'password': 'user'}).get_json()['token']}"}
+    storage.insert('templates', {'id': 1, 'workflow_config': {'nodes': [{'id': 'n1', 'type': 'approval', 'approvers': [1]}]}})
+    form = client.post('/approvals', json={'template_id': 1}, headers=admin).get_json()
+    client.post(f"/approvals/{form['id']}/submit", headers=admin)
+    client.post(f"/approvals/{form['id']}/approve", json={}, headers=admin)
+    assert storage.archive_forms('9999-01-01T00:00:00') == 1
+
+    for method, url in [('post', f"/approvals/{form['id']}/approve"), ('post', f"/approvals/{form['id']}/reject"),
+                        ('put', f"/approvals/{form['id']}"), ('post', f"/approvals/{form['id']}/submit"),
+                        ('post', f"/verification/{form['code']}")]:
+        assert getattr(client, method)(url, json={}, headers=user).status_code == 403
+        assert storage.get('approval_forms', form['id']) is None
+    assert client.post(f"/verification/{form['code']}", json={}, headers=admin).status_code == 200
+    assert storage.get('approval_forms', form['id'])['status'] == 'verified'
+
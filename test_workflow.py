@@ -1,6 +1,7 @@
 import pytest
 
 from workflow import Workflow, WorkflowTemplate
+from workflow import plan as workflow_plan
 
 
 def build_workflow():
@@ -82,3 +83,303 @@ def test_template_builder_creates_workflow():
     wf = tpl.to_workflow()
     assert wf.start_id == 'a1'
     assert wf.get_node('a2').approvers == [2]
+
+
+def test_workflow_cache_shares_compiled_workflows():
+    from workflow import WorkflowCache
+
+    cache = WorkflowCache()
+    config = {'nodes': [{'id': 'a1', 'type': 'approval', 'approvers': [1], 'delegates': [2]}]}
+    wf = cache.get(1, config)
+    assert cache.get(1, config) is wf
+    # an equal config of the same template compiles to the same workflow
+    assert cache.get(1, {'nodes': [dict(config['nodes'][0])]}) is wf
+    assert cache.get(2, config) is not wf
+    assert wf.can_act(2) and not wf.can_act(3)
+    # compiled nodes do not follow edits of the template; the edited
+    # version is compiled separately
+    config['nodes'][0]['approvers'].append(3)
+    assert not wf.can_act(3)
+    assert cache.get(1, config).can_act(3)
+    assert len(cache) == 3
+    cache.invalidate(1)
+    assert len(cache) == 1
+    assert cache.get(1, {'nodes': []}) is None
+
+
+def test_condition_expressions_are_restricted():
+    from workflow import ConditionError, compile_condition
+
+    ctx = {'amount': 150, 'dept': {'name': 'ops'}, 'tags': ['urgent']}
+    assert compile_condition('amount > 100 and dept.name == "ops"')(ctx)
+    assert compile_condition("dept['name'] in ('ops', 'hr') and not amount % 2")(ctx)
+    assert compile_condition("'urgent' in tags or amount * 2 >= 1000")(ctx)
+    assert compile_condition('-amount < 0 if amount else False')(ctx)
+    for expr in (
+        "__import__('os').system('true')",
+        'amount.__class__',
+        '().__class__.__bases__',
+        '[x for x in tags]',
+        'lambda: 1',
+        'amount ** 99',
+        'amount >',
+    ):
+        with pytest.raises(ConditionError):
+            compile_condition(expr)
+    # dotted access reads keys, never attributes
+    with pytest.raises(KeyError):
+        compile_condition('dept.title')(ctx)
+    with pytest.raises(TypeError):
+        compile_condition('amount.real')(ctx)
+
+
+def test_invalid_or_failing_conditions():
+    steps = [
+        {'id': 'start', 'type': 'approval', 'approvers': [1], 'next': 'end',
+         'conditions': [{'expr': 'missing > 1', 'next': 'audit'}, {'expr': 'amount > 1', 'next': 'audit'}]},
+        {'id': 'audit', 'type': 'approval', 'approvers': [2]},
+        {'id': 'end', 'type': 'push'},
+    ]
+    wf = Workflow.from_template(steps)
+    # a condition failing at runtime is skipped like before
+    assert wf.get_next('start', {'amount': 5}).id == 'audit'
+    assert wf.get_next('start', {'amount': None}).id == 'end'
+    steps[0]['conditions'] = [{'expr': 'open("x")', 'next': 'audit'}]
+    with pytest.raises(ValueError):
+        Workflow.from_template(steps)
+
+
+@pytest.mark.parametrize('vectorized', [True, False])
+def test_batch_routing_matches_single_forms(monkeypatch, vectorized):
+    from workflow import batch
+
+    if vectorized:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(batch, 'np', None)
+    steps = [
+        {'id': 'start', 'type': 'approval', 'approvers': [1], 'next': 'notify', 'conditions': [
+            {'expr': "amount > 1000 and dept.name in ('ops', 'hr')", 'next': 'audit'},
+            {'expr': 'amount * 2 >= 500 or not urgent == False', 'next': 'manager'},
+            {'expr': "kind == 'x'", 'next': 'missing'},
+        ]},
+        {'id': 'notify', 'type': 'push', 'next': 'final'},
+        {'id': 'manager', 'type': 'push', 'next': 'audit', 'conditions': [{'expr': 'amount < 300', 'next': 'final'}]},
+        {'id': 'loop', 'type': 'push', 'next': 'loop'},
+        {'id': 'audit', 'type': 'approval', 'approvers': [2]},
+        {'id': 'final', 'type': 'approval', 'approvers': [3]},
+    ]
+    wf = Workflow.from_template(steps)
+    forms = []
+    for amount in (50, 400, 1500, None, 'abc', 2 ** 60, True):
+        for dept in ({'name': 'ops'}, {'name': 'x'}, {}, 'bad'):
+            for urgent in (True, False):
+                forms.append({'amount': amount, 'dept': dept, 'urgent': urgent, 'kind': 'x' if urgent else 1})
+    forms += [{}, None, {'dept': {'name': 'hr'}, 'amount': 2000.5}]
+    nodes = ['start', 'manager', 'notify', 'loop', 'audit', 'unknown', None]
+    current = [nodes[i % len(nodes)] for i in range(len(forms))]
+
+    def ids(nodes):
+        return [n.id if n else None for n in nodes]
+
+    assert wf.get_next_batch(current, forms) == ids(wf.get_next(n, f) for n, f in zip(current, forms))
+    assert wf.next_approval_batch('start', forms) == ids(wf.next_approval('start', f) for f in forms)
+    table = batch.FormBatch(forms)
+    assert wf.next_approval_batch(current, table) == ids(wf.next_approval(n, f) for n, f in zip(current, forms))
+
+
+def test_batch_routing_fuzz_mixed_types_and_large_ints():
+    import random
+
+    pytest.importorskip('numpy')
+    exprs = [
+        "x in ('a', 1)", "x in (1.5, 'b')", "x not in (1, 'a', None)", "x in (True, 2)", "x in ('1.0', '1')",
+        'x * 3 > 9007199254740992', 'x * 3 >= y', 'x + y == 9007199254740993', 'x - y < 0', '-x * 2 < y',
+        'x > 9007199254740993', "x == 'a' or y > 2", 'x == y', 'x < y and y < 10', 'x * y == 6',
+        "x in (1, 2) and y not in ('b',)", 'not x * 0 == 0', 'x == None',
+    ]
+    values = [0, 1, 2, 3, -1, 1.5, 1.0, 'a', 'b', '1', '1.0', True, False, None,
+              3002399751580331, 2 ** 53, 2 ** 53 + 1, -(2 ** 53) - 1, 2 ** 63, 1e300, [1]]
+    rng = random.Random(7)
+    wf = Workflow.from_template([
+        {'id': 'n', 'type': 'push', 'next': 'other',
+         'conditions': [{'expr': expr, 'next': f'c{i}'} for i, expr in enumerate(exprs)]},
+        {'id': 'other', 'type': 'push'},
+    ] + [{'id': f'c{i}', 'type': 'push'} for i in range(len(exprs))])
+    for expr in exprs:
+        single = Workflow.from_template([
+            {'id': 'n', 'type': 'push', 'next': 'B', 'conditions': [{'expr': expr, 'next': 'A'}]},
+            {'id': 'A', 'type': 'push'}, {'id': 'B', 'type': 'push'},
+        ])
+        forms = [{'x': rng.choice(values), 'y': rng.choice(values)} for _ in range(300)]
+        forms += [{'x': v} for v in values] + [{'x': v, 'y': w} for v in values for w in values[:6]]
+        expected = [single.get_next('n', f).id for f in forms]
+        assert single.get_next_batch('n', forms) == expected, expr
+    forms = [{'x': rng.choice(values), 'y': rng.choice(values)} for _ in range(500)]
+    assert wf.get_next_batch('n', forms) == [wf.get_next('n', f).id for f in forms]
+
+
+def test_routing_plan_analysis():
+    steps = [
+        {'id': 'a', 'type': 'approval', 'approvers': [1], 'next': 'p',
+         'conditions': [{'expr': 'amount > 100', 'next': 'q'}]},
+        {'id': 'p', 'type': 'push', 'next': 'b'},
+        {'id': 'b', 'type': 'approval', 'approvers': [2], 'next': 'r'},
+        {'id': 'q', 'type': 'push', 'next': 'p', 'conditions': [{'expr': 'urgent', 'next': 'b'}]},
+        {'id': 'r', 'type': 'push', 'next': 'gone'},
+        {'id': 'x', 'type': 'push', 'next': 'a'},
+    ]
+    plan = Workflow.from_template(steps).plan
+    assert plan.unreachable == ['x']
+    assert plan.missing == [('r', 'gone')]
+    assert plan.cycle is None
+    assert plan.warnings() == ['node x is unreachable']
+    assert plan.errors() == ['node r links to unknown node gone']
+    # only nodes whose way on is condition free are resolved in advance
+    assert {n: plan.next_approval[n] for n in ('p', 'b', 'r', 'x')} == {'p': 'b', 'b': None, 'r': None, 'x': 'a'}
+    assert plan.next_approval['a'] is plan.next_approval['q'] is workflow_plan.DYNAMIC
+
+    loop = Workflow.from_template([
+        {'id': 'a', 'type': 'approval', 'approvers': [1], 'next': 'p'},
+        {'id': 'p', 'type': 'push', 'next': 'a'},
+    ]).plan
+    assert loop.cycle == ['a', 'p']
+    assert loop.errors() == ['nodes a -> p form a loop that cannot be left']
+    assert loop.warnings() == []
+    rework = Workflow.from_template([
+        {'id': 'a', 'type': 'approval', 'approvers': [1], 'next': 'b'},
+        {'id': 'b', 'type': 'approval', 'approvers': [2], 'conditions': [{'expr': 'rework', 'next': 'a'}]},
+    ]).plan
+    assert rework.errors() == [] and rework.warnings() == ['nodes a -> b form a loop']
+    assert loop.next_approval == {'a': 'a', 'p': 'a'}
+
+
+def test_next_approval_tables_match_graph_walk():
+    steps = [
+        {'id': 'a', 'type': 'approval', 'approvers': [1], 'next': 'p1',
+         'conditions': [{'expr': 'amount > 100', 'next': 'p2'}]},
+        {'id': 'p1', 'type': 'push', 'push': [7], 'next': 'p2'},
+        {'id': 'p2', 'type': 'push', 'next': 'b', 'conditions': [{'expr': 'urgent', 'next': 'c'}]},
+        {'id': 'b', 'type': 'approval', 'approvers': [2], 'next': 'p3'},
+        {'id': 'c', 'type': 'approval', 'approvers': [3], 'next': 'p4'},
+        {'id': 'p3', 'type': 'push', 'next': 'p4'},
+        {'id': 'p4', 'type': 'push', 'next': 'p3'},
+    ]
+    wf = Workflow.from_template(steps)
+
+    def walk(node_id, context):
+        checked = set()
+        nxt = wf.get_next(node_id, context)
+        while nxt and nxt.id not in checked:
+            if nxt.type == 'approval':
+                return nxt
+            checked.add(nxt.id)
+            nxt = wf.get_next(nxt.id, context)
+        return None
+
+    for context in ({}, {'amount': 500}, {'urgent': True}, {'amount': 500, 'urgent': True}):
+        for node_id in list(wf.nodes) + ['missing']:
+            assert wf.next_approval(node_id, context) is walk(node_id, context)
+    assert wf.push_targets('p1', {'urgent': True}) == [7, 3]
+
+
+def test_timer_queue_orders_and_cancels():
+    from workflow.timers import TimerQueue
+
+    queue = TimerQueue()
+    queue.load([('a', 30, 'x'), ('b', 10, 'y')])
+    queue.schedule('c', 20)
+    queue.schedule('b', 40, 'z')  # rescheduled
+    assert queue.cancel('a') and not queue.cancel('a')
+    assert len(queue) == 2 and queue.next_due() == 20
+    assert queue.pop_due(35) == [('c', 20, None)]
+    assert queue.pop_due(100) == [('b', 40, 'z')]
+    assert queue.next_due() is None
+    for i in range(1000):
+        queue.schedule(i % 10, i)
+    # superseded entries do not pile up
+    assert len(queue) == 10 and len(queue._heap) <= 2 * 64
+    assert [key for key, _, _ in queue.pop_due(10 ** 6, limit=3)] == [0, 1, 2]
+
+
+def test_engine_benchmark_replays_generated_trace(tmp_path):
+    from benchmarks import engine
+
+    path = str(tmp_path / 'trace.jsonl')
+    count = engine.write_trace(path, engine.generate(50, list(engine.TEMPLATES), concurrency=10))
+    events = list(engine.read_trace(path))
+    assert len(events) == count
+    stats = engine.replay(events)
+    assert stats['transitions'] == sum(e['op'] == 'act' for e in events) > 50
+    assert stats['p50_us'] <= stats['p99_us']
+
+
+def test_fork_analysis_and_targets():
+    steps = [
+        {'id': 'a', 'type': 'approval', 'approvers': [1], 'next': 'p'},
+        {'id': 'p', 'type': 'push', 'push': [9], 'next': 'f'},
+        {'id': 'f', 'type': 'fork', 'branches': ['b', 'q'], 'next': 'j'},
+        {'id': 'b', 'type': 'approval', 'approvers': [2], 'next': 'j'},
+        {'id': 'q', 'type': 'push', 'next': 'c'},
+        {'id': 'c', 'type': 'approval', 'approvers': [3, 4], 'require': 'all', 'next': 'j'},
+        {'id': 'j', 'type': 'join', 'require': 'any', 'next': 'd'},
+        {'id': 'd', 'type': 'approval', 'approvers': [5]},
+    ]
+    wf = Workflow.from_template(steps)
+    plan = wf.plan
+    assert plan.errors() == [] and plan.warnings() == []
+    assert plan.join_of == {'b': 'j', 'q': 'j', 'c': 'j'}
+    assert plan.required == {'c': 2, 'j': 1}
+    assert wf.next_approval('a') is None and wf.next_approval('j').id == 'd'
+    assert [n.id for n in wf.next_approvals('a')] == ['b', 'c']
+    assert wf.push_targets('p') == [9, 2, 3, 4]
+    assert wf.push_targets('b') == []
+    assert wf.next_approval_batch(['a', 'b', 'j'], [{}, {}, {}]) == [None, None, 'd']
+
+    for broken, message in (
+        ([dict(steps[2], branches=[])], 'fork f has no branches'),
+        ([dict(steps[2], next='d'), steps[-1]], 'fork f must lead to a join node'),
+        ([steps[2], dict(steps[3], next='f'), dict(steps[4], next='j'), steps[6]], 'fork f contains fork f'),
+        ([steps[6]], 'join j must close exactly one fork'),
+        ([dict(steps[0], require=0)], 'node a has an invalid require value'),
+    ):
+        assert message in Workflow.from_template(broken, require_approvers=False).plan.errors()
+
+
+def test_approver_pool_policies():
+    from workflow.assign import ApproverPool
+
+    pool = ApproverPool()
+    assert [pool.assign('n', [1, 2, 3], 'round_robin') for _ in range(4)] == [1, 2, 3, 1]
+    assert [pool.pending(u) for u in (1, 2, 3)] == [2, 1, 1]
+    # the least pending approver, counted across nodes
+    assert pool.assign('m', [1, 2], 'least_pending') == 2
+    assert pool.assign('m', [1, 2], 'least_pending') in (1, 2)
+    pool.release(1)
+    pool.release(1)
+    assert pool.assign('m', [1, 2, 3], 'least_pending') == 1
+    # the same applicant goes back to the same approver
+    first = pool.assign('s', [4, 5], 'sticky', applicant=9)
+    assert pool.assign('s', [4, 5], 'sticky', applicant=8) != first
+    assert pool.assign('s', [4, 5], 'sticky', applicant=9) == first
+    pool.load([('s', 5, 9)])
+    assert len(pool) == 1 and pool.assign('s', [4, 5], 'sticky', applicant=9) == 5
+    with pytest.raises(ValueError):
+        pool.assign('n', [1], 'random')
+
+
+def test_inbox_index_moves_forms_between_users():
+    from workflow.inbox import Inbox
+
+    inbox = Inbox()
+    inbox.load([(3, [1, 2]), (1, [1]), (2, [])])
+    assert inbox.page(1) == [1, 3] and inbox.page(2) == [3] and inbox.count(3) == 0
+    inbox.set(2, [2, 3])
+    inbox.set(3, [3])
+    assert inbox.page(1) == [1] and inbox.page(2) == [2] and inbox.page(3) == [2, 3]
+    assert inbox.users(3) == (3,)
+    for form_id in range(4, 30):
+        inbox.set(form_id, [3])
+    assert inbox.count(3) == 28 and inbox.page(3, 10, 5) == [12, 13, 14, 15, 16]
+    inbox.set(2, [])
+    assert inbox.page(2) == [] and inbox.page(3, 0, 2) == [3, 4]
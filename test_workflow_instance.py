@@ -1,7 +1,9 @@
+import json
+
 import pytest
 
 from notifications import reset, sent_notifications
-from workflow import WorkflowInstance, WorkflowTemplate
+from workflow import ExecutionRecord, StaleInstanceError, WorkflowInstance, WorkflowTemplate
 
 
 def build_workflow():
@@ -46,3 +48,158 @@ def test_rejection_stops_flow():
     assert inst.current_id is None
     # one notification to next approver and initial start = 2 total
     assert len(sent_notifications) == 2
+
+
+def test_state_round_trip():
+    reset()
+    wf = build_workflow()
+    inst = WorkflowInstance(wf)
+    inst.act(actor_id=2, result='approved', attachments=['f'])
+    state = json.loads(json.dumps(inst.to_state()))
+    restored = WorkflowInstance.from_state(wf, state)
+    # rehydrating does not announce the workflow again
+    assert len(sent_notifications) == 2
+    assert restored.current_id == 'a2'
+    assert restored.records[0].attachments == ['f']
+    assert restored.records[0].acted_at == inst.records[0].acted_at
+    assert restored.flow_state() == inst.flow_state()
+    assert restored.records == inst.records
+
+
+def test_compact_records_and_flow_state():
+    reset()
+    tpl = WorkflowTemplate()
+    tpl.add_approval('a1', approvers=[1], next='a2', conditions=[{'expr': 'amount > 100', 'next': 'a3'}])
+    tpl.add_approval('a2', approvers=[2])
+    tpl.add_approval('a3', approvers=[3])
+    wf = tpl.to_workflow()
+    inst = WorkflowInstance(wf, context={'amount': 500})
+    inst.act(actor_id=1, result='approved', comments='ok')
+    record = inst.records[0]
+    assert not hasattr(record, '__dict__') and not hasattr(inst, '__dict__')
+    assert (record.result, record.attachments) == ('approved', [])
+    history = inst.to_dict()['history'][0]
+    assert history['acted_at'] == record.acted_at and history['comments'] == 'ok'
+    # the way past a condition follows the form data
+    assert [(n['id'], n['status']) for n in inst.flow_state()] == [('a1', 'approved'), ('a3', 'in_progress')]
+    state = json.loads(json.dumps(inst.to_state()))
+    state['records'][0]['result'] = 'returned'
+    restored = WorkflowInstance.from_state(wf, state, context={'amount': 500})
+    # node ids are shared with the workflow; unknown results are kept as is
+    assert restored.records[0].node_id is wf.get_node('a1').id
+    assert restored.records[0].result == 'returned'
+
+
+def test_flow_state_is_cached_until_state_changes():
+    reset()
+    tpl = WorkflowTemplate()
+    tpl.add_approval('a1', approvers=[1], next='a2')
+    tpl.add_approval('a2', approvers=[2], conditions=[{'expr': 'amount > 100', 'next': 'a1'}])
+    inst = WorkflowInstance(tpl.to_workflow(), context={'amount': 500})
+    flow = inst.flow_state()
+    assert inst.flow_state() is flow
+    inst.act(actor_id=1, result='approved')
+    inst.act(actor_id=2, result='approved')
+    assert inst.current_id == 'a1'
+    assert [n['status'] for n in inst.flow_state()] == ['in_progress', 'approved']
+    inst.act(actor_id=1, result='rejected')
+    # a node executed twice shows its latest result
+    assert [n['status'] for n in inst.flow_state()] == ['rejected', 'approved']
+    restored = WorkflowInstance.from_state(inst.workflow, inst.to_state(), context={'amount': 500})
+    assert restored.flow_state() == inst.flow_state()
+
+
+def build_parallel(require='all'):
+    tpl = WorkflowTemplate()
+    tpl.add_approval('submit', approvers=[1], next='split')
+    tpl.add_fork('split', ['legal', 'audit', 'it'], next='merge')
+    tpl.add_approval('legal', approvers=[2], next='merge')
+    tpl.add_approval('audit', approvers=[3, 4, 5], require=2, next='merge')
+    tpl.add_approval('it', approvers=[6])
+    tpl.add_join('merge', require=require, next='cfo')
+    tpl.add_approval('cfo', approvers=[7])
+    return tpl.to_workflow()
+
+
+def test_fork_join_and_countersign():
+    reset()
+    inst = WorkflowInstance(build_parallel(), auto_notify_start=False)
+    inst.act(actor_id=1, result='approved')
+    assert inst.active == ['legal', 'audit', 'it']
+    assert inst.joins == {'merge': [0, 0]}
+    # every branch is announced
+    assert [n['recipient_id'] for n in sent_notifications] == [2, 3, 4, 5, 6]
+    assert [n['id'] for n in inst.flow_state()] == ['submit', 'split', 'legal', 'audit', 'it', 'merge', 'cfo']
+
+    reset()
+    inst.act(actor_id=3, result='approved')
+    # one of two signatures: the node stays open and nobody is notified
+    assert inst.active == ['legal', 'audit', 'it'] and inst.signs == {'audit': [3]}
+    assert sent_notifications == []
+    with pytest.raises(ValueError):
+        inst.act(actor_id=3, result='approved')
+    inst.act(actor_id=6, result='approved')  # a branch ending without next joins
+    inst.act(actor_id=4, result='approved')
+    assert inst.signs is None and inst.joins == {'merge': [2, 0]}
+    assert inst.active == ['legal']
+
+    state = json.loads(json.dumps(inst.to_state()))
+    restored = WorkflowInstance.from_state(inst.workflow, state)
+    assert (restored.active, restored.joins) == (inst.active, inst.joins)
+
+    reset()
+    inst.act(actor_id=2, result='approved')
+    assert inst.active == ['cfo'] and inst.joins is None
+    assert sent_notifications[-1]['recipient_id'] == 7
+    inst.act(actor_id=7, result='approved')
+    assert inst.status == 'approved' and inst.active == []
+
+
+def test_join_quorum_and_rejected_branches():
+    wf = build_parallel(require=2)
+    inst = WorkflowInstance(wf, auto_notify_start=False)
+    inst.act(actor_id=1, result='approved')
+    inst.act(actor_id=2, result='rejected')
+    # two of the remaining branches can still approve
+    assert inst.status == 'pending' and inst.active == ['audit', 'it']
+    inst.act(actor_id=6, result='approved', node_id='it')
+    inst.act(actor_id=5, result='approved')
+    inst.act(actor_id=3, result='approved')
+    assert inst.active == ['cfo'] and inst.joins is None
+
+    inst = WorkflowInstance(wf, auto_notify_start=False)
+    inst.act(actor_id=1, result='approved')
+    inst.act(actor_id=6, result='rejected')
+    inst.act(actor_id=3, result='rejected')
+    assert inst.status == 'rejected' and inst.active == [] and inst.joins is None
+
+    inst = WorkflowInstance(build_parallel(require='any'), auto_notify_start=False)
+    inst.act(actor_id=1, result='approved')
+    inst.act(actor_id=3, result='approved')
+    inst.act(actor_id=6, result='approved')
+    # the first branch decides; the open countersign is dropped
+    assert inst.active == ['cfo'] and inst.signs is None
+    with pytest.raises(ValueError):
+        inst.act(actor_id=2, result='approved', node_id='legal')
+
+
+def test_instance_is_stale_when_the_template_lost_its_nodes():
+    reset()
+    inst = WorkflowInstance(build_workflow())
+    state = json.loads(json.dumps(inst.to_state()))
+    tpl = WorkflowTemplate()
+    tpl.add_approval('a2', approvers=[3])
+    changed = tpl.to_workflow()
+
+    # waiting at a node the template no longer has
+    restored = WorkflowInstance.from_state(changed, state)
+    assert restored.status == 'stale'
+    assert restored.awaiting() == []
+    with pytest.raises(StaleInstanceError):
+        restored.act(actor_id=3, result='approved')
+
+    # a replayed record of such a node is not skipped
+    replayed = WorkflowInstance(changed)
+    assert replayed.apply(ExecutionRecord(node_id='a1', actor_id=1, result='approved')) == (False, [])
+    assert replayed.status == 'stale'
+    assert replayed.records[-1].node_id == 'a1'
@@ -1,33 +1,134 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
 from dataclasses import dataclass, field
-from datetime import datetime
-from typing import Any, Dict, List, Optional
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple, Union
 
 from notifications import send as send_notification
 
+from .conditions import ConditionError, compile_condition
+from .plan import DYNAMIC, PARALLEL_TYPES, RoutingPlan
+
 
 @dataclass
 class Node:
     """Represents a single workflow node."""
 
     id: str
-    type: str  # 'approval' or 'push'
+    type: str  # 'approval', 'push', 'fork' or 'join'
     next: Optional[str] = None
     conditions: List[Dict[str, Any]] = field(default_factory=list)
     approvers: List[int] = field(default_factory=list)
     delegates: List[int] = field(default_factory=list)
     push: List[int] = field(default_factory=list)
+    # SLA: seconds a form may wait at the node before its approvers are
+    # reminded, and before it is escalated
+    remind_after: Optional[float] = None
+    escalate_after: Optional[float] = None
+    # fork: first node of each parallel branch; ``next`` is its join
+    branches: List[str] = field(default_factory=list)
+    # join: branches that must approve, approval: distinct approvers that
+    # must sign; 'all', 'any' or a number (see workflow.plan.required_count)
+    require: Union[str, int, None] = None
+    # approval: give each form to one approver, see workflow.assign; the
+    # approvers are then notified by whoever assigns, not by the engine
+    assign: Optional[str] = None
+
+
+# results stored as small integers in ExecutionRecord
+RESULTS = ('approved', 'rejected')
+_RESULT_CODES = {result: code for code, result in enumerate(RESULTS)}
+_STATUSES = {s: s for s in ('pending', 'approved', 'rejected')}
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_DAY = _EPOCH.toordinal()
+_MICROSECOND = timedelta(microseconds=1)
 
 
-@dataclass
 class ExecutionRecord:
-    """Record of an executed workflow node."""
+    """Record of an executed workflow node.
+
+    There is one record per step of every form in flight, so records use
+    ``__slots__`` and keep the result as an index into ``RESULTS``, the
+    attachments as a tuple (``None`` if empty) and ``acted_at`` as integer
+    microseconds since the epoch (naive UTC). The properties convert on
+    access; ``attachments`` returns a new list each time.
+    """
+
+    __slots__ = ('node_id', 'actor_id', '_result', 'comments', '_attachments', '_acted_at')
+
+    def __init__(self, node_id: str, actor_id: int, result: str, comments: Optional[str] = None,
+                 attachments: Optional[List[str]] = None, acted_at: Optional[datetime] = None):
+        self.node_id = node_id
+        self.actor_id = actor_id
+        self.result = result  # ``approved`` or ``rejected``
+        self.comments = comments
+        self.attachments = attachments
+        self.acted_at = acted_at if acted_at is not None else datetime.utcnow()
+
+    @property
+    def result(self) -> str:
+        result = self._result
+        return RESULTS[result] if type(result) is int else result
+
+    @result.setter
+    def result(self, value: str) -> None:
+        self._result = _RESULT_CODES.get(value, value)
+
+    @property
+    def attachments(self) -> List[str]:
+        return list(self._attachments or ())
+
+    @attachments.setter
+    def attachments(self, value: Optional[List[str]]) -> None:
+        self._attachments = tuple(value) if value else None
+
+    @property
+    def acted_at(self) -> datetime:
+        return _EPOCH + self._acted_at * _MICROSECOND
+
+    @acted_at.setter
+    def acted_at(self, value: datetime) -> None:
+        days = value.toordinal() - _EPOCH_DAY
+        seconds = days * 86400 + value.hour * 3600 + value.minute * 60 + value.second
+        self._acted_at = seconds * 1000000 + value.microsecond
+
+    @classmethod
+    def from_state(cls, state: Dict[str, Any], node_id: Optional[str] = None) -> "ExecutionRecord":
+        """Build a record from :meth:`to_state` output, optionally with a shared node id."""
+        record = cls.__new__(cls)
+        record.node_id = state['node_id'] if node_id is None else node_id
+        record.actor_id = state['actor_id']
+        result = state['result']
+        record._result = _RESULT_CODES.get(result, result)
+        record.comments = state.get('comments')
+        record._attachments = tuple(state['attachments']) if state.get('attachments') else None
+        record.acted_at = datetime.fromisoformat(state['acted_at'])
+        return record
+
+    def to_state(self) -> Dict[str, Any]:
+        return dict(self.to_dict(), acted_at=self.acted_at.isoformat())
+
+    def to_dict(self) -> Dict[str, Any]:
+        result = self._result
+        return {
+            'node_id': self.node_id,
+            'actor_id': self.actor_id,
+            'result': RESULTS[result] if type(result) is int else result,
+            'comments': self.comments,
+            'attachments': list(self._attachments or ()),
+            'acted_at': _EPOCH + self._acted_at * _MICROSECOND,
+        }
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, ExecutionRecord):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
 
-    node_id: str
-    actor_id: int
-    result: str  # ``approved`` or ``rejected``
-    comments: Optional[str] = None
-    attachments: List[str] = field(default_factory=list)
-    acted_at: datetime = field(default_factory=datetime.utcnow)
+    def __repr__(self) -> str:
+        fields = ', '.join(f'{k}={v!r}' for k, v in self.to_dict().items())
+        return f'ExecutionRecord({fields})'
 
 
 @dataclass
@@ -46,6 +147,10 @@ class WorkflowTemplate:
         next: Optional[str] = None,
         conditions: Optional[List[Dict[str, Any]]] = None,
         push: Optional[List[int]] = None,
+        remind_after: Optional[float] = None,
+        escalate_after: Optional[float] = None,
+        require: Union[str, int, None] = None,
+        assign: Optional[str] = None,
     ) -> "WorkflowTemplate":
         if not approvers:
             raise ValueError("approval node requires approvers")
@@ -57,6 +162,10 @@ class WorkflowTemplate:
             approvers=list(approvers),
             delegates=list(delegates or []),
             push=list(push or []),
+            remind_after=remind_after,
+            escalate_after=escalate_after,
+            require=require,
+            assign=assign,
         )
         self.nodes[node_id] = node
         if not self.start_id:
@@ -83,33 +192,85 @@ class WorkflowTemplate:
             self.start_id = node_id
         return self
 
+    def add_fork(self, node_id: str, branches: List[str], *, next: str) -> "WorkflowTemplate":
+        """Add a node that starts ``branches`` in parallel; ``next`` is their join."""
+        self.nodes[node_id] = Node(id=node_id, type="fork", next=next, branches=list(branches))
+        if not self.start_id:
+            self.start_id = node_id
+        return self
+
+    def add_join(
+        self,
+        node_id: str,
+        *,
+        require: Union[str, int] = "all",
+        next: Optional[str] = None,
+    ) -> "WorkflowTemplate":
+        """Add the node where the branches of a fork meet again."""
+        self.nodes[node_id] = Node(id=node_id, type="join", next=next, require=require)
+        if not self.start_id:
+            self.start_id = node_id
+        return self
+
     def to_workflow(self) -> "Workflow":
-        return Workflow(self.nodes, self.start_id)
+        return Workflow(dict(self.nodes), self.start_id)
 
 
 class Workflow:
-    """Parses workflow templates and provides navigation helpers."""
+    """Parses workflow templates and provides navigation helpers.
+
+    A workflow is not modified after it is built, so one object can be
+    shared by every instance of a template (see :class:`WorkflowCache`).
+    """
 
     def __init__(self, nodes: Dict[str, Node], start_id: Optional[str] = None):
         self.nodes = nodes
         self.start_id = start_id
+        # users allowed to act on at least one approval node
+        self.actors = frozenset(
+            user_id
+            for node in nodes.values() if node.type == 'approval'
+            for user_id in node.approvers + node.delegates
+        )
+        # conditional jumps per node as (compiled condition, target) pairs;
+        # raises ConditionError for an invalid expression
+        self.routes = {
+            node.id: [
+                (compile_condition(c['expr']), c['next'])
+                for c in node.conditions
+                if c.get('expr') is not None and c.get('next') is not None
+            ]
+            for node in nodes.values()
+        }
+        # static analysis and lookup tables, see workflow.plan
+        self.plan = RoutingPlan(self)
 
     @classmethod
-    def from_template(cls, steps: List[Dict[str, Any]]):
-        """Create a workflow from a template description."""
+    def from_template(cls, steps: List[Dict[str, Any]], *, require_approvers: bool = True):
+        """Create a workflow from a template description.
+
+        With ``require_approvers=False`` approval nodes without approvers
+        are accepted, e.g. to analyse a template that is not complete yet.
+        """
         nodes: Dict[str, Node] = {}
         start_id = steps[0]['id'] if steps else None
         for step in steps:
-            if step.get('type') == 'approval' and not step.get('approvers'):
+            if require_approvers and step.get('type') == 'approval' and not step.get('approvers'):
                 raise ValueError('approval node requires approvers')
+            # copies, so later edits of the template leave the workflow alone
             node = Node(
                 id=step['id'],
                 type=step['type'],
                 next=step.get('next'),
-                conditions=step.get('conditions', []),
-                approvers=step.get('approvers', []),
-                delegates=step.get('delegates', []),
-                push=step.get('push', []),
+                conditions=[dict(c) for c in step.get('conditions', [])],
+                approvers=list(step.get('approvers', [])),
+                delegates=list(step.get('delegates', [])),
+                push=list(step.get('push', [])),
+                remind_after=step.get('remind_after'),
+                escalate_after=step.get('escalate_after'),
+                branches=list(step.get('branches', [])),
+                require=step.get('require'),
+                assign=step.get('assign'),
             )
             nodes[node.id] = node
         return cls(nodes, start_id)
@@ -117,52 +278,122 @@ class Workflow:
     def get_node(self, node_id: str) -> Optional[Node]:
         return self.nodes.get(node_id)
 
+    def can_act(self, user_id: int) -> bool:
+        """Return whether ``user_id`` approves or delegates any approval node."""
+        return user_id in self.actors
+
     def get_next(self, node_id: str, context: Optional[Dict[str, Any]] = None) -> Optional[Node]:
         """Return the next node given the current context."""
         node = self.get_node(node_id)
         if node is None:
             return None
         context = context or {}
-        # Evaluate conditional jumps. Each condition is a dict with 'expr' and 'next'.
-        for condition in node.conditions:
-            expr = condition.get('expr')
-            target = condition.get('next')
-            if expr is None or target is None:
-                continue
+        # Evaluate conditional jumps, compiled from the nodes' 'expr'/'next' dicts.
+        for condition, target in self.routes.get(node_id, ()):
             try:
-                if eval(expr, {}, context):  # nosec - expressions are controlled by templates
+                if condition(context):
                     return self.get_node(target)
             except Exception:
+                # e.g. a field missing from the form or of the wrong type
                 continue
         if node.next:
             return self.get_node(node.next)
         return None
 
     def next_approval(self, node_id: str, context: Optional[Dict[str, Any]] = None) -> Optional[Node]:
-        """Find the next approval node from the given node."""
+        """Find the next approval node from the given node.
+
+        The search stops at a fork or a join; see :meth:`next_approvals`.
+        """
+        table = self.plan.next_approval
+        found = table.get(node_id, DYNAMIC)
+        if found is not DYNAMIC:
+            return self.nodes[found] if found else None
         checked = set()
         nxt = self.get_next(node_id, context)
         while nxt and nxt.id not in checked:
             if nxt.type == 'approval':
                 return nxt
+            if nxt.type in PARALLEL_TYPES:
+                return None
+            # the rest of the way may not depend on the form data
+            found = table.get(nxt.id, DYNAMIC)
+            if found is not DYNAMIC:
+                return self.nodes[found] if found else None
             checked.add(nxt.id)
             nxt = self.get_next(nxt.id, context)
         return None
 
+    def next_approvals(self, node_id: str, context: Optional[Dict[str, Any]] = None) -> List[Node]:
+        """Return the approval nodes a form waits at once ``node_id`` is done.
+
+        Like :meth:`next_approval`, but a fork on the way opens the first
+        approval node of each of its branches.
+        """
+        found = self.next_approval(node_id, context)
+        if found is not None:
+            return [found]
+        # no approval before the end, a join or a fork: look for the fork
+        checked = set()
+        nxt = self.get_next(node_id, context)
+        while nxt and nxt.type == 'push' and nxt.id not in checked:
+            checked.add(nxt.id)
+            nxt = self.get_next(nxt.id, context)
+        if nxt is None or nxt.type != 'fork':
+            return []
+        approvals = []
+        for branch in nxt.branches:
+            node = self.get_node(branch)
+            if node is not None and node.type != 'approval' and node.type not in PARALLEL_TYPES:
+                node = self.next_approval(node.id, context)
+            if node is not None and node.type == 'approval':
+                approvals.append(node)
+        return approvals
+
+    def get_next_batch(self, node_ids, forms) -> List[Optional[str]]:
+        """Return the ids :meth:`get_next` gives for many forms at once.
+
+        See :mod:`workflow.batch`; ``forms`` holds the form data dicts.
+        """
+        from .batch import next_nodes
+
+        return next_nodes(self, node_ids, forms)
+
+    def next_approval_batch(self, node_ids, forms) -> List[Optional[str]]:
+        """Return the ids :meth:`next_approval` gives for many forms at once."""
+        from .batch import next_approvals
+
+        return next_approvals(self, node_ids, forms)
+
+    def escalation_targets(self, node_id: str, context: Optional[Dict[str, Any]] = None) -> List[int]:
+        """Return who a form overdue at ``node_id`` is escalated to.
+
+        The node's delegates, or without delegates the approvers of the
+        next approval node.
+        """
+        node = self.get_node(node_id)
+        if node is None:
+            return []
+        if node.delegates:
+            return list(node.delegates)
+        nxt = self.next_approval(node_id, context)
+        return list(nxt.approvers) if nxt else []
+
     def push_targets(self, node_id: str, context: Optional[Dict[str, Any]] = None) -> List[int]:
         """Return push recipients for the node.
 
         By default notifications are sent to the approvers of the next approval
-        node. Additional recipients can be specified via the node's ``push``
-        field.
+        node, or of every branch when a fork follows; a node that assigns
+        forms to one approver is left to the assignment. Additional
+        recipients can be specified via the node's ``push`` field.
         """
         node = self.get_node(node_id)
         if node is None:
             return []
         targets = list(node.push)
-        nxt = self.next_approval(node_id, context)
-        if nxt:
-            targets.extend(nxt.approvers)
+        for nxt in self.next_approvals(node_id, context):
+            if not nxt.assign:
+                targets.extend(nxt.approvers)
         return targets
 
     def notify(self, node_id: str, message: str, context: Optional[Dict[str, Any]] = None,
@@ -177,8 +408,37 @@ class Workflow:
             send_notification(recipients, message, channels)
 
 
+class StaleInstanceError(ValueError):
+    """The instance refers to nodes its (changed) template no longer has."""
+
+
 class WorkflowInstance:
-    """Simple in-memory workflow executor."""
+    """Simple in-memory workflow executor.
+
+    Instances are kept for every form in flight, hence ``__slots__``.
+
+    ``active`` lists the nodes the form waits at: one, or one per open
+    branch after a fork. The first is kept in ``current_id`` and the others,
+    rarely any, in ``_others``. ``joins`` counts the approved and rejected
+    branches of every open fork by its join id, and ``signs`` the actors who
+    signed a countersign node so far; all three are ``None`` while empty.
+
+    ``assignees`` maps nodes that assign forms to one approver (see
+    :mod:`workflow.assign`) to that approver, who alone of the approvers may
+    then act; the delegates still can. The caller keeps it up to date, it is
+    not part of :meth:`to_state`.
+
+    An instance rebuilt against a template that lost a node it waits at, or
+    a node of a replayed record, has status ``stale``: it does not move on
+    and :meth:`act` raises :class:`StaleInstanceError`.
+    """
+
+    __slots__ = (
+        'workflow', 'context', 'current_id', '_others', 'joins', 'signs', 'assignees', 'records', 'status',
+        # flow_state caches: node id -> latest result, records folded into
+        # it, the resolved path and its context, the last flow and its key
+        '_results', '_indexed', '_path', '_path_context', '_flow', '_flow_key',
+    )
 
     def __init__(
         self,
@@ -189,25 +449,53 @@ class WorkflowInstance:
     ):
         self.workflow = workflow
         self.context = context or {}
-        self.current_id = workflow.start_id
+        self.current_id: Optional[str] = None
+        self._others: Optional[List[str]] = None
+        self.joins: Optional[Dict[str, List[int]]] = None
+        self.signs: Optional[Dict[str, List[int]]] = None
+        self.assignees: Optional[Dict[str, int]] = None
         self.records: List[ExecutionRecord] = []
         self.status = 'pending'
-        if auto_notify_start and self.current_id:
-            node = self.current_node()
-            if node and node.type == 'approval':
-                send_notification(node.approvers, f"{node.id} pending", None)
+        self._results: Optional[Dict[str, str]] = None
+        self._indexed = 0
+        self._path = self._path_context = self._flow = self._flow_key = None
+        start = workflow.get_node(workflow.start_id) if workflow.start_id else None
+        if start is not None:
+            self._enter(start, [])
+        if auto_notify_start:
+            for node_id in self.active:
+                node = workflow.get_node(node_id)
+                if node.type == 'approval' and not node.assign:
+                    send_notification(node.approvers, f"{node.id} pending", None)
+
+    @property
+    def active(self) -> List[str]:
+        if self._others:
+            return [self.current_id] + self._others
+        return [self.current_id] if self.current_id else []
+
+    @active.setter
+    def active(self, node_ids: List[str]) -> None:
+        self.current_id = node_ids[0] if node_ids else None
+        self._others = list(node_ids[1:]) or None
 
     def current_node(self) -> Optional[Node]:
         return self.workflow.get_node(self.current_id) if self.current_id else None
 
     def act(self, actor_id: int, result: str, comments: Optional[str] = None,
-            attachments: Optional[List[str]] = None) -> None:
-        """Execute the current node with the provided result."""
-        node = self.current_node()
-        if node is None or node.type != 'approval':
-            raise ValueError('current node is not approvable')
-        if actor_id not in node.approvers and actor_id not in node.delegates:
-            raise ValueError('actor not permitted for this node')
+            attachments: Optional[List[str]] = None, node_id: Optional[str] = None) -> None:
+        """Execute an active node with the provided result.
+
+        ``node_id`` picks one of the active nodes; by default it is the
+        first approval node ``actor_id`` may act on and has not signed yet.
+        """
+        if self.status == 'stale':
+            raise StaleInstanceError('the template no longer has the nodes of this instance')
+        node = self.current_node() if node_id is None and not self._others else None
+        if node is None or node.type != 'approval' or not self._may_act(node, actor_id) or (
+                self.signs and actor_id in self.signs.get(node.id, ())):
+            # not the plain case of one node the actor may sign
+            node = self._actionable(actor_id, node_id)
         record = ExecutionRecord(
             node_id=node.id,
             actor_id=actor_id,
@@ -215,43 +503,392 @@ class WorkflowInstance:
             comments=comments,
             attachments=list(attachments or []),
         )
+        done, joined = self.apply(record)
+        if done:
+            self.workflow.notify(node.id, f'{node.id} {result}', self.context)
+        for join_id in joined:
+            self.workflow.notify(join_id, f'{join_id} {result}', self.context)
+
+    def awaiting(self) -> List[int]:
+        """Return the users who may act on one of the active nodes now.
+
+        Those are the approvers (or the assigned approver) and delegates of
+        every active approval node, less who signed a countersign node.
+        """
+        if self.status == 'stale':
+            return []
+        users = {}
+        signs = self.signs or {}
+        assignees = self.assignees or {}
+        for node_id in self.active:
+            node = self.workflow.get_node(node_id)
+            if node is None or node.type != 'approval':
+                continue
+            approvers = [assignees[node_id]] if node_id in assignees else node.approvers
+            signed = signs.get(node_id, ())
+            users.update((user, None) for user in approvers + node.delegates if user not in signed)
+        return list(users)
+
+    def _may_act(self, node: Node, actor_id: int) -> bool:
+        if actor_id in node.delegates:
+            return True
+        assignees = self.assignees
+        if assignees and node.id in assignees:
+            return actor_id == assignees[node.id]
+        return actor_id in node.approvers
+
+    def _actionable(self, actor_id: int, node_id: Optional[str]) -> Node:
+        active = self.active
+        if node_id is not None and node_id not in active:
+            raise ValueError('current node is not approvable')
+        candidates = [self.workflow.get_node(n) for n in ([node_id] if node_id is not None else active)]
+        candidates = [n for n in candidates if n is not None and n.type == 'approval']
+        if not candidates:
+            raise ValueError('current node is not approvable')
+        permitted = [n for n in candidates if self._may_act(n, actor_id)]
+        if not permitted:
+            raise ValueError('actor not permitted for this node')
+        signs = self.signs or {}
+        for node in permitted:
+            if actor_id not in signs.get(node.id, ()):
+                return node
+        raise ValueError('actor already signed this node')
+
+    def apply(self, record: ExecutionRecord) -> Tuple[bool, List[str]]:
+        """Advance the instance by an executed node, without checks or notifications.
+
+        :meth:`act` validates and notifies, then applies; replaying persisted
+        records through this method rebuilds the same state. Returns whether
+        the record completed its node, and the joins it completed.
+        """
         self.records.append(record)
-        self.workflow.notify(node.id, f'{node.id} {result}', self.context)
-        if result == 'approved':
+        node_id = record.node_id
+        if self.status == 'stale' or node_id not in self.workflow.nodes:
+            # a node the template lost: where the form went is unknown
+            self.status = 'stale'
+            return False, []
+        plan = self.workflow.plan
+        if not plan.parallel:
+            # no forks or countersigns: one node at a time
+            nxt = self.workflow.get_next(node_id, self.context) if record.result == 'approved' else None
+            self.current_id = nxt.id if nxt is not None else None
+            if nxt is None:
+                self.status = 'approved' if record.result == 'approved' else 'rejected'
+            return True, []
+        join_id = plan.join_of.get(node_id)
+        if record.result != 'approved':
+            # one rejection rejects a countersign node
+            if self.signs and node_id in self.signs:
+                self._unsign(node_id)
+            counts = self.joins.get(join_id) if self.joins and join_id else None
+            if counts is not None:
+                # a rejected branch closes; the fork fails once its join
+                # cannot get enough approved branches any more
+                counts[1] += 1
+                self._leave(node_id)
+                if plan.branch_count[join_id] - counts[1] >= plan.required.get(join_id, 1):
+                    return True, []
+            self.current_id = self._others = self.joins = self.signs = None
+            self.status = 'rejected'
+            return True, []
+        required = plan.required.get(node_id, 1)
+        if required > 1:
+            signs = self.signs if self.signs is not None else {}
+            signed = signs.setdefault(node_id, [])
+            if record.actor_id not in signed:
+                signed.append(record.actor_id)
+            self.signs = signs
+            if len(signed) < required:
+                return False, []
+            self._unsign(node_id)
+        self._leave(node_id)
+        nxt = self.workflow.get_next(node_id, self.context)
+        if nxt is None and join_id is not None:
+            # a branch that ends without a next node meets its join
+            nxt = self.workflow.get_node(join_id)
+        joined: List[str] = []
+        if nxt is not None:
+            self._enter(nxt, joined)
+        if self.current_id is None and self.status == 'pending':
+            self.status = 'approved'
+        return True, joined
+
+    def _leave(self, node_id: str) -> None:
+        others = self._others
+        if node_id == self.current_id:
+            self.current_id = others.pop(0) if others else None
+        elif others and node_id in others:
+            others.remove(node_id)
+        else:
+            return
+        if not others:
+            self._others = None
+
+    def _unsign(self, node_id: str) -> None:
+        del self.signs[node_id]
+        if not self.signs:
+            self.signs = None
+
+    def _enter(self, node: Node, joined: List[str]) -> None:
+        """Make the form wait at ``node``, passing through forks and joins."""
+        if node.type == 'fork':
+            joins = self.joins if self.joins is not None else {}
+            joins[node.next] = [0, 0]  # approved, rejected branches
+            self.joins = joins
+            for branch in node.branches:
+                target = self.workflow.get_node(branch)
+                if target is not None:
+                    self._enter(target, joined)
+            return
+        if node.type == 'join':
+            counts = self.joins.get(node.id) if self.joins else None
+            if counts is not None:
+                counts[0] += 1
+                if counts[0] < self.workflow.plan.required.get(node.id, 1):
+                    return
+                # done: the branches still open are not needed any more
+                del self.joins[node.id]
+                if not self.joins:
+                    self.joins = None
+                join_of = self.workflow.plan.join_of
+                for node_id in [n for n in self.active if join_of.get(n) == node.id]:
+                    self._leave(node_id)
+                    if self.signs and node_id in self.signs:
+                        self._unsign(node_id)
+                joined.append(node.id)
             nxt = self.workflow.get_next(node.id, self.context)
-            if nxt:
-                self.current_id = nxt.id
-            else:
-                self.current_id = None
-                self.status = 'approved'
+            if nxt is not None:
+                self._enter(nxt, joined)
+            return
+        if self.current_id is None:
+            self.current_id = node.id
+        elif self._others is None:
+            self._others = [node.id]
         else:
-            self.current_id = None
-            self.status = 'rejected'
+            self._others.append(node.id)
+
+    def to_state(self) -> Dict[str, Any]:
+        """Return the JSON-serializable execution state of the instance."""
+        state = {
+            'current': self.current_id,
+            'status': self.status,
+            'records': [r.to_state() for r in self.records],
+        }
+        # parallel branches and countersigns only
+        if self._others:
+            state['active'] = self.active
+        if self.joins:
+            state['joins'] = {k: list(v) for k, v in self.joins.items()}
+        if self.signs:
+            state['signs'] = {k: list(v) for k, v in self.signs.items()}
+        return state
+
+    @classmethod
+    def from_state(
+        cls,
+        workflow: Workflow,
+        state: Dict[str, Any],
+        context: Optional[Dict[str, Any]] = None,
+    ) -> "WorkflowInstance":
+        """Rehydrate an instance saved with :meth:`to_state`.
+
+        No start notification is sent; it went out when the instance was
+        first created.
+        """
+        def shared(node_id):
+            # the workflow's own id string rather than a copy per instance
+            node = workflow.get_node(node_id)
+            return node.id if node is not None else node_id
+
+        inst = cls(workflow, context, auto_notify_start=False)
+        active = state.get('active') or ([state['current']] if state.get('current') else [])
+        inst.active = [shared(node_id) for node_id in active]
+        inst.joins = {shared(k): list(v) for k, v in state['joins'].items()} if state.get('joins') else None
+        inst.signs = {shared(k): list(v) for k, v in state['signs'].items()} if state.get('signs') else None
+        status = state.get('status', 'pending')
+        inst.status = _STATUSES.get(status, status)
+        if inst.status == 'pending' and any(node_id not in workflow.nodes for node_id in active):
+            inst.status = 'stale'
+        inst.records = [ExecutionRecord.from_state(r, shared(r['node_id'])) for r in state.get('records', [])]
+        return inst
 
     def to_dict(self) -> Dict[str, Any]:
         return {
             'status': self.status,
             'current': self.current_id,
-            'history': [r.__dict__ for r in self.records],
+            'active': self.active,
+            'history': [r.to_dict() for r in self.records],
             'flow': self.flow_state(),
         }
 
     def flow_state(self) -> List[Dict[str, Any]]:
-        """Return ordered node list with execution status for display."""
-        order: List[Dict[str, Any]] = []
-        node_id = self.workflow.start_id
-        visited = set()
-        while node_id and node_id not in visited:
-            node = self.workflow.get_node(node_id)
-            status = 'pending'
-            for rec in self.records:
-                if rec.node_id == node.id:
-                    status = rec.result
-                    break
-            if node.id == self.current_id:
-                status = 'in_progress'
-            order.append({'id': node.id, 'type': node.type, 'status': status})
-            visited.add(node_id)
-            nxt = self.workflow.get_next(node_id, self.context)
-            node_id = nxt.id if nxt else None
-        return order
+        """Return ordered node list with execution status for display.
+
+        Each node shows the result of its latest record. The flow is cached
+        until the active nodes or the records change, and the path until
+        the context is replaced; the returned list must not be modified.
+        """
+        key = (self.current_id, tuple(self._others) if self._others else None, len(self.records))
+        if self._flow is not None and self._flow_key == key:
+            return self._flow
+        results = self._record_results()
+        active = self.active
+        self._flow = [
+            {'id': node.id, 'type': node.type,
+             'status': 'in_progress' if node.id in active else results.get(node.id, 'pending')}
+            for node in self._resolved_path()
+        ]
+        self._flow_key = key
+        return self._flow
+
+    def _record_results(self) -> Dict[str, str]:
+        """Return node id -> latest result, folding in records added since."""
+        records = self.records
+        if self._results is None or len(records) < self._indexed:
+            # not built yet, or the records were replaced
+            self._results = {}
+            self._indexed = 0
+        for rec in records[self._indexed:]:
+            self._results[rec.node_id] = rec.result
+        self._indexed = len(records)
+        return self._results
+
+    def _resolved_path(self) -> List[Node]:
+        """Return the nodes a form with this context passes, in order.
+
+        The branches of a fork follow the fork one after the other.
+        """
+        if self._path is not None and self._path_context is self.context:
+            return self._path
+        plan = self.workflow.plan
+        path = list(plan.start_path)
+        if plan.start_open:
+            # past the first condition or fork the way depends on the form data
+            last = path.pop()
+            self._follow(last, path, {node.id for node in path})
+        self._path = path
+        self._path_context = self.context
+        return path
+
+    def _follow(self, node: Optional[Node], path: List[Node], visited: set) -> None:
+        get_next = self.workflow.get_next
+        while node is not None and node.id not in visited:
+            path.append(node)
+            visited.add(node.id)
+            if node.type != 'fork':
+                node = get_next(node.id, self.context)
+                continue
+            for branch in node.branches:
+                step = self.workflow.get_node(branch)
+                while step is not None and step.type != 'join' and step.id not in visited:
+                    path.append(step)
+                    visited.add(step.id)
+                    step = get_next(step.id, self.context)
+            node = self.workflow.get_node(node.next)
+
+
+def config_hash(config: Any) -> str:
+    """Return a digest of a ``workflow_config`` that ignores key order."""
+    raw = json.dumps(config, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+class WorkflowCache:
+    """Compiled workflows, one per (template id, config hash).
+
+    Every instance of the same template version shares one
+    :class:`Workflow`. The config object last seen for a template is
+    remembered, so repeated lookups with an unchanged template skip the
+    hashing as well. Callers must :meth:`invalidate` a template whose
+    config they change in place.
+    """
+
+    def __init__(self):
+        self._workflows: Dict[tuple, Workflow] = {}
+        self._latest: Dict[Hashable, tuple] = {}
+        self._lock = threading.Lock()
+
+    def get(self, template_id: Hashable, config: Optional[Dict[str, Any]]) -> Optional[Workflow]:
+        """Return the workflow of ``config``, or ``None`` if it has no nodes.
+
+        Raises ``ValueError`` for an invalid config.
+        """
+        nodes = (config or {}).get('nodes')
+        if not nodes:
+            return None
+        with self._lock:
+            latest = self._latest.get(template_id)
+            if latest is not None and latest[0] is config:
+                return self._workflows[latest[1]]
+        key = (template_id, config_hash(config))
+        with self._lock:
+            workflow = self._workflows.get(key)
+        if workflow is None:
+            workflow = Workflow.from_template(nodes)
+        with self._lock:
+            workflow = self._workflows.setdefault(key, workflow)
+            self._latest[template_id] = (config, key)
+        return workflow
+
+    def invalidate(self, template_id: Hashable) -> None:
+        """Forget every compiled version of a template."""
+        with self._lock:
+            self._latest.pop(template_id, None)
+            for key in [k for k in self._workflows if k[0] == template_id]:
+                del self._workflows[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._latest.clear()
+            self._workflows.clear()
+
+    def __len__(self) -> int:
+        return len(self._workflows)
+
+
+class InstanceCache:
+    """Bounded LRU cache of rehydrated workflow instances.
+
+    Entries are stored with the version of the persisted state they were
+    built from. :meth:`get` only returns a cached instance if the caller's
+    version still matches, so an instance advanced elsewhere (another
+    worker process) is rebuilt instead of served stale.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, version: Any,
+            load: Callable[[], Optional[WorkflowInstance]]) -> Optional[WorkflowInstance]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                return entry[1]
+        inst = load()
+        if inst is not None:
+            self.put(key, version, inst)
+        return inst
+
+    def put(self, key: Hashable, version: Any, inst: WorkflowInstance) -> None:
+        with self._lock:
+            self._entries[key] = (version, inst)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
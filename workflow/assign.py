@@ -0,0 +1,135 @@
+"""Assignment of forms to one approver of an approval node.
+
+By default every approver of a node sees every form waiting there. A node
+with ``assign`` set gives each form to one of its approvers instead:
+
+* ``round_robin``: the approvers in turn;
+* ``least_pending``: the approver with the fewest forms waiting, across
+  all nodes and templates;
+* ``sticky``: the approver who had the applicant's last form at the node,
+  the least pending one the first time.
+
+:class:`ApproverPool` keeps the number of forms waiting per approver and,
+per node, a heap of ``[pending, order, approver]`` entries. Assigning or
+releasing a form pushes a fresh entry for the approver onto the heaps of
+the nodes they approve, O(k log n) for k such nodes; entries whose count
+is out of date are dropped when they reach the top. Picking the least
+pending approver looks at the top of one heap only.
+
+The pool is in memory; callers persist the assignments themselves and
+:meth:`ApproverPool.load` them back after a restart, or :meth:`ApproverPool.add`
+those made by other worker processes.
+"""
+
+import heapq
+import itertools
+import threading
+from collections import defaultdict
+from typing import Any, Dict, Hashable, Iterable, List, Sequence, Tuple
+
+POLICIES = ('round_robin', 'least_pending', 'sticky')
+
+
+class ApproverPool:
+    def __init__(self):
+        self._pending: Dict[int, int] = {}  # approver -> forms waiting
+        self._members: Dict[Hashable, Tuple[int, ...]] = {}  # node scope -> approvers
+        self._heaps: Dict[Hashable, List[list]] = {}  # node scope -> heap
+        self._scopes = defaultdict(set)  # approver -> node scopes
+        self._turns: Dict[Hashable, int] = {}  # node scope -> round-robin position
+        self._sticky: Dict[Tuple[Hashable, Any], int] = {}  # (node scope, applicant) -> approver
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+
+    def load(self, assignments: Iterable[Tuple[Hashable, int, Any]]) -> None:
+        """Replace the pool with ``(scope, approver, applicant)`` forms waiting."""
+        with self._lock:
+            self._pending = {}
+            self._members = {}
+            self._heaps = {}
+            self._scopes = defaultdict(set)
+            self._turns = {}
+            self._sticky = {}
+            for scope, approver, applicant in assignments:
+                self._pending[approver] = self._pending.get(approver, 0) + 1
+                if applicant is not None:
+                    self._sticky[scope, applicant] = approver
+
+    def assign(self, scope: Hashable, approvers: Sequence[int], policy: str, applicant: Any = None) -> int:
+        """Pick the approver of ``approvers`` a form waiting at node ``scope`` goes to.
+
+        The form counts as pending for that approver until :meth:`release`.
+        """
+        if policy not in POLICIES:
+            raise ValueError(f'unknown assignment policy {policy}')
+        if not approvers:
+            raise ValueError('approval node requires approvers')
+        with self._lock:
+            if policy == 'round_robin':
+                turn = self._turns.get(scope, 0)
+                approver = approvers[turn % len(approvers)]
+                self._turns[scope] = turn + 1
+            elif policy == 'sticky' and self._sticky.get((scope, applicant)) in approvers:
+                approver = self._sticky[scope, applicant]
+            else:
+                approver = self._least(scope, approvers)
+            if policy == 'sticky' and applicant is not None:
+                self._sticky[scope, applicant] = approver
+            self._change(approver, 1)
+            return approver
+
+    def add(self, scope: Hashable, approver: int, applicant: Any = None) -> None:
+        """Count a form assigned to ``approver`` at ``scope`` elsewhere.
+
+        For forms another worker process assigned; the round-robin turn
+        of ``scope`` moves on as if the form had been assigned here.
+        """
+        with self._lock:
+            self._turns[scope] = self._turns.get(scope, 0) + 1
+            if applicant is not None:
+                self._sticky[scope, applicant] = approver
+            self._change(approver, 1)
+
+    def release(self, approver: int) -> None:
+        """Count one form less as pending for ``approver``."""
+        with self._lock:
+            if self._pending.get(approver):
+                self._change(approver, -1)
+
+    def pending(self, approver: int) -> int:
+        return self._pending.get(approver, 0)
+
+    def _least(self, scope, approvers):
+        # called with the lock held
+        members = tuple(approvers)
+        heap = self._heaps.get(scope)
+        if heap is None or self._members[scope] != members or len(heap) > 2 * len(members) + 64:
+            # first use, changed approvers or too many stale entries
+            self._rebuild(scope, members)
+            heap = self._heaps[scope]
+        pending = self._pending
+        while heap[0][0] != pending.get(heap[0][2], 0):
+            heapq.heappop(heap)
+        return heap[0][2]
+
+    def _rebuild(self, scope, members):
+        for approver in self._members.get(scope, ()):
+            self._scopes[approver].discard(scope)
+        self._members[scope] = members
+        heap = []
+        for approver in dict.fromkeys(members):
+            self._scopes[approver].add(scope)
+            heap.append([self._pending.get(approver, 0), next(self._order), approver])
+        heapq.heapify(heap)
+        self._heaps[scope] = heap
+
+    def _change(self, approver, delta):
+        count = self._pending[approver] = self._pending.get(approver, 0) + delta
+        if not count:
+            del self._pending[approver]
+        for scope in self._scopes.get(approver, ()):
+            heapq.heappush(self._heaps[scope], [count, next(self._order), approver])
+
+    def __len__(self) -> int:
+        """Return the number of forms assigned and waiting."""
+        return sum(self._pending.values())
@@ -0,0 +1,351 @@
+"""Routing of many forms at once.
+
+:func:`next_nodes` and :func:`next_approvals` answer ``Workflow.get_next``
+and ``Workflow.next_approval`` for a whole batch of forms: rows are grouped
+by their current node and each condition is evaluated once per group over
+columns of the form data instead of once per form.
+
+With NumPy installed, conditions made of comparisons, ``in`` tests against
+literals of one type (numbers or strings), ``+ - *`` and
+``and``/``or``/``not`` are evaluated as array operations; numbers are
+compared as float64, so literals must lie within +-2**53. Rows the arrays
+cannot decide exactly (a missing field, a value that is neither a number
+nor a string, arithmetic that leaves +-2**53) and every other condition
+use the compiled per-row predicate, so the result always matches the
+one-form-at-a-time API.
+"""
+
+import ast
+import operator
+import weakref
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+from .conditions import _Index, compile_condition, parse_condition
+from .plan import PARALLEL_TYPES
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is optional
+    np = None
+
+# numbers beyond this are not exact as float64 and go row by row
+_EXACT = 2 ** 53
+
+_COMPARE = {
+    ast.Eq: operator.eq, ast.NotEq: operator.ne,
+    ast.Lt: operator.lt, ast.LtE: operator.le,
+    ast.Gt: operator.gt, ast.GtE: operator.ge,
+}
+_ARITHMETIC = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul}
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _path(node):
+    """Return the field path of ``a``, ``a.b`` or ``a['b']`` as a tuple."""
+    parts = []
+    while not isinstance(node, ast.Name):
+        if isinstance(node, ast.Attribute):
+            parts.append(node.attr)
+            node = node.value
+        elif isinstance(node, ast.Subscript):
+            key = node.slice.value if _Index is not None and isinstance(node.slice, _Index) else node.slice
+            if not isinstance(key, ast.Constant) or not isinstance(key.value, str):
+                raise _Unsupported
+            parts.append(key.value)
+            node = node.value
+        else:
+            raise _Unsupported
+    parts.append(node.id)
+    return tuple(reversed(parts))
+
+
+def _build(node, paths):
+    """Return ``(function of the columns, whether it yields booleans)``."""
+    if isinstance(node, ast.Expression):
+        return _build(node.body, paths)
+    if isinstance(node, ast.Constant):
+        value = node.value
+        if type(value) in (int, float) and not abs(value) < _EXACT:
+            # not exact as float64
+            raise _Unsupported
+        return (lambda cols: value), False
+    if isinstance(node, (ast.Name, ast.Attribute, ast.Subscript)):
+        path = _path(node)
+        paths.add(path)
+        return (lambda cols: cols[path]), False
+    if isinstance(node, ast.Compare):
+        parts = []
+        left, _ = _build(node.left, paths)
+        for op, comparator in zip(node.ops, node.comparators):
+            if isinstance(op, (ast.In, ast.NotIn)):
+                if not isinstance(comparator, (ast.Tuple, ast.List)) or \
+                        not all(isinstance(e, ast.Constant) for e in comparator.elts):
+                    raise _Unsupported
+                values = [e.value for e in comparator.elts]
+                kinds = {_kind(v) for v in values}
+                if len(kinds) != 1 or None in kinds:
+                    # NumPy would turn mixed literals into one type
+                    raise _Unsupported
+                parts.append(lambda cols, l=left, v=values, k=kinds.pop(), invert=isinstance(op, ast.NotIn):
+                             _isin(l(cols), v, k, invert))
+                # ``x in (...) < y`` chains are not worth supporting
+                left = None
+                continue
+            if left is None or type(op) not in _COMPARE:
+                raise _Unsupported
+            right, _ = _build(comparator, paths)
+            parts.append(lambda cols, f=_COMPARE[type(op)], l=left, r=right: f(l(cols), r(cols)))
+            left = right
+        return (lambda cols: np.logical_and.reduce([p(cols) for p in parts])), True
+    if isinstance(node, ast.BoolOp):
+        # ``a or 0`` returns an operand, not a boolean: only boolean operands
+        operands = []
+        for value in node.values:
+            fn, boolean = _build(value, paths)
+            if not boolean:
+                raise _Unsupported
+            operands.append(fn)
+        reduce = np.logical_and.reduce if isinstance(node.op, ast.And) else np.logical_or.reduce
+        return (lambda cols: reduce([f(cols) for f in operands])), True
+    if isinstance(node, ast.UnaryOp):
+        operand, boolean = _build(node.operand, paths)
+        if isinstance(node.op, ast.Not):
+            if not boolean:
+                raise _Unsupported
+            return (lambda cols: np.logical_not(operand(cols))), True
+        if isinstance(node.op, ast.USub):
+            return (lambda cols: -operand(cols)), False
+        return operand, False
+    if isinstance(node, ast.BinOp) and type(node.op) in _ARITHMETIC:
+        f = _ARITHMETIC[type(node.op)]
+        left, _ = _build(node.left, paths)
+        right, _ = _build(node.right, paths)
+        return (lambda cols: _exact(cols, f(left(cols), right(cols)))), False
+    raise _Unsupported
+
+
+def _isin(column, values, kind, invert):
+    column = np.asarray(column)
+    # a number is never equal to a string, which NumPy would compare as text
+    if (column.dtype.kind in 'OUS') == (kind == 'str'):
+        hits = np.isin(column, values)
+    else:
+        hits = np.zeros(column.shape, dtype=bool)
+    return ~hits if invert else hits
+
+
+# key of the rows in a columns dict whose arithmetic left the exact range
+_INEXACT = object()
+
+
+def _exact(cols, result):
+    """Note the rows where ``result`` is too large to be exact as float64."""
+    values = np.asarray(result)
+    if values.dtype.kind in 'fiu':
+        with np.errstate(invalid='ignore'):
+            big = ~(np.abs(values) < _EXACT)
+        if big.any():
+            cols[_INEXACT] = big if _INEXACT not in cols else big | cols[_INEXACT]
+    return result
+
+
+_MISSING = object()
+_NUMBERS = {int, float, bool}
+
+
+def _kind(value):
+    if type(value) in _NUMBERS and abs(value) < _EXACT:
+        return 'num'
+    if isinstance(value, str):
+        return 'str'
+    return None
+
+
+def _column(contexts, path):
+    """Return the column of ``path`` and the mask of rows it holds exactly."""
+    first = path[0]
+    values = [c.get(first, _MISSING) for c in contexts]
+    for key in path[1:]:
+        values = [v.get(key, _MISSING) if type(v) is dict else _MISSING for v in values]
+    types = set(map(type, values))
+    # the common cases: every row holds a plain number, or a string
+    if types <= _NUMBERS and max(values) < _EXACT and min(values) > -_EXACT:
+        return np.array(values, dtype=np.float64), None
+    if types == {str}:
+        return np.array(values, dtype=object), None
+    kinds = [_kind(v) for v in values]
+    kind = 'num' if kinds.count('num') >= kinds.count('str') else 'str'
+    valid = np.array([k == kind for k in kinds], dtype=bool)
+    if kind == 'num':
+        column = np.array([v if k == 'num' else 0 for v, k in zip(values, kinds)], dtype=np.float64)
+    else:
+        column = np.array([v if k == 'str' else '' for v, k in zip(values, kinds)], dtype=object)
+    return column, valid
+
+
+class FormBatch:
+    """The data of many forms, read column by column.
+
+    Each field path used by a condition is extracted into a column once
+    per batch, so one batch can be routed through several nodes, steps or
+    templates without reading the rows again.
+    """
+
+    def __init__(self, contexts: Sequence[Optional[Dict[str, Any]]]):
+        self.contexts = [c if isinstance(c, dict) else {} for c in contexts]
+        self._columns = {}
+
+    def __len__(self) -> int:
+        return len(self.contexts)
+
+    def column(self, path):
+        """Return the column of a field path and its exact-rows mask (or ``None``)."""
+        found = self._columns.get(path)
+        if found is None:
+            found = self._columns[path] = _column(self.contexts, path)
+        return found
+
+
+class BatchCondition:
+    """A condition evaluated over many forms at once."""
+
+    def __init__(self, expr: str):
+        self.predicate = compile_condition(expr)
+        self.paths = set()
+        self.vector = None
+        if np is not None:
+            try:
+                vector, boolean = _build(parse_condition(expr), self.paths)
+            except _Unsupported:
+                vector, boolean = None, False
+            if boolean:
+                self.vector = vector
+
+    def _one(self, context):
+        try:
+            return bool(self.predicate(context))
+        except Exception:
+            # a missing field or a type mismatch fails the condition
+            return False
+
+    def evaluate(self, batch: FormBatch, rows: Sequence[int]) -> Sequence[bool]:
+        """Return the value of the condition for the given rows of ``batch``."""
+        contexts = batch.contexts
+        if self.vector is None or not len(rows):
+            return [self._one(contexts[i]) for i in rows]
+        columns = {}
+        valid = None
+        for path in self.paths:
+            column, exact = batch.column(path)
+            columns[path] = column[rows]
+            if exact is not None:
+                valid = exact[rows] if valid is None else valid & exact[rows]
+        try:
+            with np.errstate(all='ignore'):
+                result = np.array(np.broadcast_to(self.vector(columns), (len(rows),)), dtype=bool)
+        except Exception:
+            return [self._one(contexts[i]) for i in rows]
+        inexact = columns.get(_INEXACT)
+        if inexact is not None:
+            inexact = np.broadcast_to(inexact, (len(rows),))
+            valid = ~inexact if valid is None else valid & ~inexact
+        if valid is not None:
+            for j in np.flatnonzero(~valid).tolist():
+                result[j] = self._one(contexts[rows[j]])
+        return result
+
+
+# workflow -> {node id: [(BatchCondition, target)]}; workflows are shared
+# per template version, so this is built once per version
+_routes = weakref.WeakKeyDictionary()
+
+
+def _batch_routes(workflow):
+    routes = _routes.get(workflow)
+    if routes is None:
+        routes = {
+            node.id: [
+                (BatchCondition(c['expr']), c['next'])
+                for c in node.conditions
+                if c.get('expr') is not None and c.get('next') is not None
+            ]
+            for node in workflow.nodes.values()
+        }
+        _routes[workflow] = routes
+    return routes
+
+
+def _route(workflow, batch, rows, node_ids):
+    """Return the next node id of each row in ``rows`` of ``batch``.
+
+    ``node_ids`` is the current node of each row, or one id for all rows.
+    """
+    if node_ids is None or isinstance(node_ids, str):
+        groups = {node_ids: list(rows)}
+    else:
+        groups = defaultdict(list)
+        for row, node_id in zip(rows, node_ids):
+            groups[node_id].append(row)
+    routes = _batch_routes(workflow)
+    result = {}
+    for node_id, members in groups.items():
+        node = workflow.get_node(node_id)
+        if node is None:
+            continue
+        remaining = np.asarray(members) if np is not None else members
+        for condition, target in routes.get(node_id, ()):
+            if not len(remaining):
+                break
+            hits = condition.evaluate(batch, remaining)
+            target = target if target in workflow.nodes else None
+            if np is not None:
+                hits = np.asarray(hits, dtype=bool)
+                result.update(dict.fromkeys(remaining[hits].tolist(), target))
+                remaining = remaining[~hits]
+            else:
+                result.update(dict.fromkeys([r for r, hit in zip(remaining, hits) if hit], target))
+                remaining = [r for r, hit in zip(remaining, hits) if not hit]
+        if node.next in workflow.nodes:
+            result.update(dict.fromkeys(list(remaining), node.next))
+    return [result.get(row) for row in rows]
+
+
+def _batch(forms):
+    return forms if isinstance(forms, FormBatch) else FormBatch(forms)
+
+
+def next_nodes(workflow, node_ids: Union[str, Sequence[Optional[str]], None],
+               forms: Union[FormBatch, Sequence[Optional[Dict[str, Any]]]]) -> List[Optional[str]]:
+    """Return ``workflow.get_next(node_id, data)`` ids for every form.
+
+    ``forms`` is a :class:`FormBatch` or a sequence of form data dicts;
+    ``node_ids`` is the current node of each form, or one id for all.
+    """
+    batch = _batch(forms)
+    return _route(workflow, batch, range(len(batch)), node_ids)
+
+
+def next_approvals(workflow, node_ids: Union[str, Sequence[Optional[str]], None],
+                   forms: Union[FormBatch, Sequence[Optional[Dict[str, Any]]]]) -> List[Optional[str]]:
+    """Return ``workflow.next_approval(node_id, data)`` ids for every form."""
+    batch = _batch(forms)
+    approvals = {node.id for node in workflow.nodes.values() if node.type == 'approval'}
+    # the search ends at approvals, and without a result at forks and joins
+    stops = approvals | {node.id for node in workflow.nodes.values() if node.type in PARALLEL_TYPES}
+    current = next_nodes(workflow, node_ids, batch)
+    active = [i for i, node_id in enumerate(current) if node_id is not None and node_id not in stops]
+    # Routing a form is deterministic, so a form still on a push node after
+    # passing as many push nodes as there are has entered a cycle, where
+    # next_approval gives up as well.
+    for _ in range(len(workflow.nodes) - len(approvals)):
+        if not active:
+            break
+        moved = _route(workflow, batch, active, [current[i] for i in active])
+        for i, node_id in zip(active, moved):
+            current[i] = node_id
+        active = [i for i in active if current[i] is not None and current[i] not in stops]
+    return [node_id if node_id in approvals else None for node_id in current]
@@ -0,0 +1,84 @@
+"""Restricted condition expressions for workflow nodes.
+
+A condition such as ``amount > 1000 and dept.name == 'ops'`` is parsed once
+when the workflow is built. Only literals, names of form fields, field
+access (``a.b`` and ``a['b']`` both look up a key), arithmetic,
+comparisons and boolean operators are accepted; calls, comprehensions,
+lambdas and anything else are rejected with :class:`ConditionError`. The
+checked expression is compiled to a code object that runs without
+builtins, so evaluating it costs no parsing and cannot reach arbitrary
+code.
+"""
+
+import ast
+import sys
+from typing import Any, Callable, Dict
+
+# ``ast.Index`` wraps subscripts before Python 3.9
+_Index = ast.Index if sys.version_info < (3, 9) else None
+
+_ALLOWED = (
+    ast.Expression, ast.Name, ast.Load, ast.Constant,
+    ast.Attribute, ast.Subscript, ast.Tuple, ast.List, ast.IfExp,
+    ast.BoolOp, ast.And, ast.Or,
+    ast.UnaryOp, ast.Not, ast.USub, ast.UAdd,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod,
+    ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+    ast.In, ast.NotIn, ast.Is, ast.IsNot,
+) + ((_Index,) if _Index is not None else ())
+
+_CONSTANTS = (str, int, float, bool, type(None))
+
+_GLOBALS = {'__builtins__': {}}
+
+
+class ConditionError(ValueError):
+    """A condition expression is malformed or uses a forbidden construct."""
+
+
+class _FieldAccess(ast.NodeTransformer):
+    # ``a.b`` reads the key ``b`` of the mapping ``a``
+    def visit_Attribute(self, node):
+        value = self.visit(node.value)
+        key = ast.Constant(node.attr)
+        if _Index is not None:
+            key = _Index(key)
+        return ast.copy_location(ast.Subscript(value=value, slice=key, ctx=ast.Load()), node)
+
+
+def _check(tree, expr):
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED):
+            raise ConditionError(f'{type(node).__name__} is not allowed in condition {expr!r}')
+        if isinstance(node, ast.Constant) and not isinstance(node.value, _CONSTANTS):
+            raise ConditionError(f'constant {node.value!r} is not allowed in condition {expr!r}')
+        name = node.id if isinstance(node, ast.Name) else getattr(node, 'attr', '')
+        if name.startswith('__'):
+            raise ConditionError(f'name {name!r} is not allowed in condition {expr!r}')
+
+
+def parse_condition(expr: str) -> ast.Expression:
+    """Parse ``expr`` and check it against the allowed constructs."""
+    if not isinstance(expr, str):
+        raise ConditionError('condition must be a string')
+    try:
+        tree = ast.parse(expr.strip(), mode='eval')
+    except SyntaxError as exc:
+        raise ConditionError(f'invalid condition {expr!r}: {exc.msg}') from None
+    _check(tree, expr)
+    return tree
+
+
+def compile_condition(expr: str) -> Callable[[Dict[str, Any]], Any]:
+    """Return a function evaluating ``expr`` against a context mapping.
+
+    Unknown field names raise ``NameError`` (or ``KeyError`` for nested
+    fields) when evaluated, like an ``eval`` of the expression would.
+    """
+    tree = ast.fix_missing_locations(_FieldAccess().visit(parse_condition(expr)))
+    code = compile(tree, '<condition>', 'eval')
+
+    def evaluate(context: Dict[str, Any]) -> Any:
+        return eval(code, _GLOBALS, context)  # nosec - restricted by _check
+
+    return evaluate
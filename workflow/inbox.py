@@ -0,0 +1,71 @@
+"""Index of the forms waiting for each user.
+
+:class:`Inbox` maps a user to the ids of the forms that user may act on
+now, kept sorted, and every form to its users. Moving a form through a
+workflow step changes only the users it leaves and enters, O(log n) to
+find the place plus shifting the rest of that user's list; reading a page
+of a user's inbox is a slice.
+
+The index is in memory; callers persist which users a form waits for and
+:meth:`Inbox.load` them back after a restart.
+"""
+
+import bisect
+import threading
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+
+class Inbox:
+    def __init__(self):
+        self._forms: Dict[Hashable, List[int]] = {}  # user -> sorted form ids
+        self._users: Dict[int, Tuple[Hashable, ...]] = {}  # form id -> users
+        self._lock = threading.Lock()
+
+    def load(self, entries: Iterable[Tuple[int, Iterable[Hashable]]]) -> None:
+        """Replace the index with ``(form id, users)`` entries in O(n log n)."""
+        with self._lock:
+            self._forms = {}
+            self._users = {}
+            for form_id, users in entries:
+                users = tuple(dict.fromkeys(users))
+                if users:
+                    self._users[form_id] = users
+                    for user in users:
+                        self._forms.setdefault(user, []).append(form_id)
+            for forms in self._forms.values():
+                forms.sort()
+
+    def set(self, form_id: int, users: Iterable[Hashable]) -> None:
+        """Make ``form_id`` wait for ``users`` (none: the form waits for nobody)."""
+        users = tuple(dict.fromkeys(users))
+        with self._lock:
+            previous = self._users.pop(form_id, ())
+            for user in previous:
+                if user not in users:
+                    forms = self._forms[user]
+                    i = bisect.bisect_left(forms, form_id)
+                    if i < len(forms) and forms[i] == form_id:
+                        del forms[i]
+                    if not forms:
+                        del self._forms[user]
+            for user in users:
+                if user not in previous:
+                    forms = self._forms.setdefault(user, [])
+                    i = bisect.bisect_left(forms, form_id)
+                    if i == len(forms) or forms[i] != form_id:
+                        forms.insert(i, form_id)
+            if users:
+                self._users[form_id] = users
+
+    def page(self, user: Hashable, start: int = 0, size: Optional[int] = None) -> List[int]:
+        """Return the ids of the forms waiting for ``user``, oldest form first."""
+        with self._lock:
+            forms = self._forms.get(user, ())
+            return list(forms[start:] if size is None else forms[start:start + size])
+
+    def count(self, user: Hashable) -> int:
+        return len(self._forms.get(user, ()))
+
+    def users(self, form_id: int) -> Tuple[Hashable, ...]:
+        """Return the users ``form_id`` waits for."""
+        return self._users.get(form_id, ())
@@ -0,0 +1,227 @@
+"""Static analysis of a workflow graph, done once per compiled workflow.
+
+A :class:`RoutingPlan` indexes the edges of every node (the ``next`` link
+plus the targets of its conditions) and derives:
+
+* the nodes reachable from the start node, and those that are not;
+* edges pointing at nodes that do not exist;
+* a cycle, if there is one (forms may pass its nodes more than once);
+* loops a form can never leave: cycles of ``next`` links through nodes
+  without conditions;
+* for every node whose way on does not depend on the form data, the next
+  approval node, so :meth:`Workflow.next_approval` becomes a lookup;
+* the nodes passed from the start before the first condition, the fixed
+  part of :meth:`WorkflowInstance.flow_state`;
+* for every fork, the nodes of its branches and how many of them its join
+  needs, so an instance keeps one pair of counters per open fork.
+"""
+
+from typing import Dict, Hashable, Iterable, List, Optional, Sequence, Union
+
+# marker for nodes whose next approval depends on conditions
+DYNAMIC = object()
+
+# node types that split or merge the way of a form
+PARALLEL_TYPES = ('fork', 'join')
+
+
+def valid_require(require) -> bool:
+    """Return whether ``require`` is ``None``, 'all', 'any' or a positive integer."""
+    if require is None or require in ('all', 'any'):
+        return True
+    return isinstance(require, int) and not isinstance(require, bool) and require > 0
+
+
+def required_count(require: Union[str, int, None], total: int, default: Union[str, int] = 'all') -> int:
+    """Return how many of ``total`` a ``require`` setting asks for.
+
+    'all' is every one, 'any' one, and a number at most ``total``.
+    """
+    if require is None:
+        require = default
+    if require == 'all':
+        return total
+    if require == 'any':
+        return min(1, total)
+    return min(require, total)
+
+
+def reachable(start: Optional[Hashable], edges: Dict[Hashable, Sequence[Hashable]]) -> set:
+    """Return the nodes reachable from ``start`` (itself included)."""
+    if start not in edges:
+        return set()
+    seen = {start}
+    stack = [start]
+    while stack:
+        for target in edges.get(stack.pop(), ()):
+            if target in edges and target not in seen:
+                seen.add(target)
+                stack.append(target)
+    return seen
+
+
+def find_cycle(edges: Dict[Hashable, Sequence[Hashable]]) -> Optional[List[Hashable]]:
+    """Return the nodes of one cycle of the graph, or ``None``."""
+    state = {}  # 1: on the current path, 2: done
+    for root in edges:
+        if root in state:
+            continue
+        path = [root]
+        todo = [iter(edges[root])]
+        state[root] = 1
+        while todo:
+            target = next(todo[-1], None)
+            if target is None:
+                state[path.pop()] = 2
+                todo.pop()
+            elif target not in edges or state.get(target) == 2:
+                continue
+            elif state.get(target) == 1:
+                return path[path.index(target):]
+            else:
+                state[target] = 1
+                path.append(target)
+                todo.append(iter(edges[target]))
+    return None
+
+
+class RoutingPlan:
+    def __init__(self, workflow):
+        nodes = workflow.nodes
+        self.edges: Dict[str, List[str]] = {}
+        self.missing: List[tuple] = []
+        for node in nodes.values():
+            targets = [c.get('next') for c in node.conditions if c.get('expr') is not None and c.get('next') is not None]
+            targets.extend(node.branches)
+            if node.next:
+                targets.append(node.next)
+            self.edges[node.id] = [t for t in dict.fromkeys(targets) if t in nodes]
+            self.missing.extend((node.id, t) for t in targets if t not in nodes)
+        self.reachable = reachable(workflow.start_id, self.edges)
+        self.unreachable = [n for n in nodes if n not in self.reachable]
+        self.cycle = find_cycle(self.edges)
+        self._analyse_forks(nodes)
+        # nodes left only through their ``next`` link
+        fixed = {n.id: n.next for n in nodes.values() if not workflow.routes.get(n.id) and n.type != 'fork'}
+        self.trap = find_cycle({n: [t] for n, t in fixed.items() if t in fixed})
+        self.next_approval = self._static_approvals(nodes, fixed)
+        # the nodes every form passes from the start, up to the first node
+        # with conditions or fork (included; ``start_open`` tells if there is one)
+        self.start_path = []
+        passed = set()
+        node = nodes.get(workflow.start_id)
+        while node is not None and node.id not in passed:
+            self.start_path.append(node)
+            passed.add(node.id)
+            if node.id not in fixed:
+                break
+            node = nodes.get(node.next)
+        self.start_open = bool(self.start_path) and self.start_path[-1].id not in fixed
+
+    def _analyse_forks(self, nodes):
+        """Index the branches of every fork and the approvals joins and countersigns need."""
+        self.join_of: Dict[str, str] = {}  # node in a branch -> join of its fork
+        self.branch_count: Dict[str, int] = {}  # join -> branches of its fork
+        self.required: Dict[str, int] = {}  # join or countersign node -> approvals needed
+        self.fork_problems: List[str] = []
+        closes: Dict[str, List[str]] = {}
+        for node in nodes.values():
+            if not valid_require(node.require):
+                self.fork_problems.append(f'node {node.id} has an invalid require value')
+            elif node.type == 'approval' and node.require is not None:
+                count = required_count(node.require, len(set(node.approvers)) or 1, 'any')
+                if count > 1:
+                    self.required[node.id] = count
+            if node.type != 'fork':
+                continue
+            join = nodes.get(node.next)
+            if not node.branches:
+                self.fork_problems.append(f'fork {node.id} has no branches')
+                continue
+            if join is None or join.type != 'join':
+                self.fork_problems.append(f'fork {node.id} must lead to a join node')
+                continue
+            closes.setdefault(join.id, []).append(node.id)
+            region = set()
+            stack = [b for b in node.branches if b in nodes and b != join.id]
+            while stack:
+                node_id = stack.pop()
+                if node_id in region:
+                    continue
+                region.add(node_id)
+                stack.extend(t for t in self.edges[node_id] if t != join.id)
+            for node_id in region:
+                if nodes[node_id].type in PARALLEL_TYPES:
+                    self.fork_problems.append(f'fork {node.id} contains {nodes[node_id].type} {node_id}')
+                self.join_of[node_id] = join.id
+            self.branch_count[join.id] = len(node.branches)
+        for node in nodes.values():
+            if node.type == 'join':
+                if len(closes.get(node.id, ())) != 1:
+                    self.fork_problems.append(f'join {node.id} must close exactly one fork')
+                elif valid_require(node.require):
+                    self.required[node.id] = required_count(node.require, self.branch_count[node.id])
+        # whether instances need more than one active node and a result per node
+        self.parallel = bool(self.required) or any(n.type in PARALLEL_TYPES for n in nodes.values())
+
+    @staticmethod
+    def _static_approvals(nodes, fixed):
+        """Map node ids to the id of their next approval node (or ``None``).
+
+        Only nodes whose way to that approval passes no condition are
+        included; the others map to DYNAMIC.
+        """
+        table = {}
+        for start in nodes:
+            path = []
+            node_id = start
+            result = DYNAMIC
+            while True:
+                if node_id not in fixed:
+                    break
+                if node_id in table:
+                    result = table[node_id]
+                    break
+                path.append(node_id)
+                target = nodes.get(fixed[node_id])
+                if target is None:
+                    result = None
+                    break
+                if target.type == 'approval':
+                    result = target.id
+                    break
+                if target.type in PARALLEL_TYPES:
+                    # see Workflow.next_approvals
+                    result = None
+                    break
+                if target.id in path:
+                    # a loop through push nodes never reaches an approval
+                    result = None
+                    break
+                node_id = target.id
+            for visited in path:
+                table[visited] = result
+            table.setdefault(start, DYNAMIC)
+        return table
+
+    def errors(self) -> List[str]:
+        """Return the problems that make the workflow unusable."""
+        problems = [f'node {node} links to unknown node {target}' for node, target in self.missing]
+        if self.trap:
+            problems.append(f"nodes {' -> '.join(self.trap)} form a loop that cannot be left")
+        return problems + self.fork_problems
+
+    def warnings(self) -> List[str]:
+        warnings = [f'node {node} is unreachable' for node in self.unreachable]
+        if self.cycle and not self.trap:
+            # a loop left through a condition, e.g. back to rework
+            warnings.append(f"nodes {' -> '.join(self.cycle)} form a loop")
+        return warnings
+
+
+def node_map(nodes: Iterable[dict]) -> Dict[Hashable, dict]:
+    """Index node dicts by their ``id`` (the first of duplicate ids wins)."""
+    found = {}
+    for node in nodes:
+        found.setdefault(node.get('id'), node)
+    return found
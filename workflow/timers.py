@@ -0,0 +1,86 @@
+"""Deadline queue for workflow SLA timers.
+
+:class:`TimerQueue` is a binary heap of ``(due, key)`` entries. Scheduling
+is O(log n); cancelling or rescheduling a key only marks its old entry
+dead, and dead entries are dropped when they reach the top or, once they
+outnumber the live ones, by rebuilding the heap in O(n). Finding what is
+due looks at the top of the heap only, never at every timer.
+
+The queue is in memory; callers persist the timers themselves and
+:meth:`TimerQueue.load` them back after a restart.
+"""
+
+import heapq
+import itertools
+import threading
+from typing import Any, Hashable, Iterable, List, Optional, Tuple
+
+
+class TimerQueue:
+    def __init__(self):
+        self._heap: List[list] = []
+        self._entries = {}  # key -> live heap entry
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+
+    def load(self, timers: Iterable[Tuple[Hashable, float, Any]]) -> None:
+        """Replace the queue with ``(key, due, payload)`` timers in O(n)."""
+        with self._lock:
+            self._entries = {}
+            for key, due, payload in timers:
+                self._entries[key] = [due, next(self._order), key, payload, True]
+            self._heap = list(self._entries.values())
+            heapq.heapify(self._heap)
+
+    def schedule(self, key: Hashable, due: float, payload: Any = None) -> None:
+        """Set the timer ``key`` to fire at ``due``, replacing any earlier one."""
+        entry = [due, next(self._order), key, payload, True]
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                old[4] = False
+            self._entries[key] = entry
+            heapq.heappush(self._heap, entry)
+            self._compact()
+
+    def cancel(self, key: Hashable) -> bool:
+        """Cancel the timer ``key``; return whether there was one."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return False
+            entry[4] = False
+            self._compact()
+            return True
+
+    def pop_due(self, now: float, limit: Optional[int] = None) -> List[Tuple[Hashable, float, Any]]:
+        """Remove and return the ``(key, due, payload)`` timers due at ``now``, earliest first."""
+        found = []
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][0] <= now and (limit is None or len(found) < limit):
+                due, _, key, payload, live = heapq.heappop(heap)
+                if live:
+                    del self._entries[key]
+                    found.append((key, due, payload))
+        return found
+
+    def next_due(self) -> Optional[float]:
+        """Return the earliest deadline, or ``None`` if no timer is set."""
+        with self._lock:
+            heap = self._heap
+            while heap and not heap[0][4]:
+                heapq.heappop(heap)
+            return heap[0][0] if heap else None
+
+    def _compact(self):
+        # called with the lock held
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._entries):
+            self._heap = [e for e in self._heap if e[4]]
+            heapq.heapify(self._heap)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries